@@ -0,0 +1,196 @@
+import os
+import re
+import sqlite3
+import hashlib
+import tempfile
+import pandas as pd
+
+# entities parsed into columns of the index, other key-value parts of the file names are ignored
+ENTITIES = ['sub', 'subs', 'ses', 'task', 'run', 'type', 'seed', 'contrast', 'mask', 'mot', 'mod', 'fwhm', 'stat',
+            'desc']
+# entities of a model permutation string, e.g. mask-mni152_mot-opt1_mod-CueMod_fwhm-3.6
+PERM_ENTITIES = ['mask', 'mot', 'mod', 'fwhm']
+_EXT = re.compile(r'\.(nii\.gz|nii|tsv|csv|h5|json|parquet|dat|txt)$')
+
+
+def parse_entities(name: str) -> dict:
+    """
+    Parses the BIDS-like key-value entities of a file name or model string, e.g.
+    'sub-01_ses-1_task-mid_run-01_contrast-Lgain-Neut_mask-mni152_mot-opt1_mod-CueMod_fwhm-3.6_stat-beta.nii.gz'
+    gives {'sub': '01', 'ses': '1', ..., 'contrast': 'Lgain-Neut', ..., 'stat': 'beta'}. Values are split from
+    their key at the first '-', so contrasts keep theirs. When a key repeats (e.g. the mask label and the
+    model mask of ICC maps), the first value is kept.
+
+    :param name: file name, path or model string
+    :return: dict of entity: value
+    """
+    entities = {}
+    for part in _EXT.sub('', os.path.basename(name)).split('_'):
+        key, sep, value = part.partition('-')
+        if sep:
+            entities.setdefault(key, value)
+    return entities
+
+
+def perm_name(name: str) -> str:
+    """
+    Model permutation of a file name (mask, mot, mod and fwhm parts in file order), e.g.
+    'mask-mni152_mot-opt1_mod-CueMod_fwhm-3.6', or '' if it has none
+
+    :param name: file name or path
+    :return: permutation string
+    """
+    return '_'.join(part for part in _EXT.sub('', os.path.basename(name)).split('_')
+                    if part.partition('-')[0] in PERM_ENTITIES)
+
+
+def default_index_path(root: str) -> str:
+    """
+    Default index of a folder: {TMPDIR}/file_index-{hash of the absolute folder path}.db, node local scratch on
+    most clusters. Pass an index_path on scratch to share an index between nodes.
+
+    :param root: indexed folder
+    :return: path to the SQLite index
+    """
+    root_hash = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f'file_index-{root_hash}.db')
+
+
+class FileIndex:
+    """
+    Persistent table of the files under a derivatives folder with their parsed entities, so inputs are found
+    with a query instead of globs over the tree. The index is a small SQLite file, by default in $TMPDIR (see
+    default_index_path()) so the shared derivatives tree isn't written to or locked.
+    refresh() only lists directories whose mtime changed since the last refresh (a file was added, removed or
+    renamed in it); unchanged directories cost one stat, their files and subdirectories come from the table.
+    """
+    def __init__(self, root: str, index_path: str = None, refresh: bool = True):
+        """
+        :param root: folder to index (recursively)
+        :param index_path: path to the SQLite index, default None (default_index_path(root))
+        :param refresh: update the index on load, default True
+        """
+        self.root = root.rstrip('/') or '/'
+        self.index_path = index_path or default_index_path(self.root)
+        # several jobs can share an index, writers wait on the lock
+        self._db = sqlite3.connect(self.index_path, timeout=600)
+        # a persistent journal file, so commits don't change the mtime of the folder the index is in
+        self._db.execute('PRAGMA journal_mode=PERSIST')
+        entity_cols = ', '.join(f'"{entity}" TEXT' for entity in ENTITIES)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)')
+            self._db.execute(f'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, name TEXT, '
+                             f'perm TEXT, {entity_cols})')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+        if refresh:
+            self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self) -> int:
+        """
+        Updates the index from the directories that changed since the last refresh
+
+        :return: N of directories (re)listed
+        """
+        n_listed = 0
+        stored = dict(self._db.execute('SELECT path, mtime_ns FROM dirs'))
+        stack, seen = [self.root], set()
+        with self._db:
+            while stack:
+                dir_path = stack.pop()
+                try:
+                    mtime_ns = os.stat(dir_path).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                seen.add(dir_path)
+                if stored.get(dir_path) == mtime_ns:
+                    stack.extend(row[0] for row in self._db.execute('SELECT path FROM dirs WHERE parent = ?',
+                                                                    (dir_path,)))
+                    continue
+                n_listed += 1
+                sub_dirs, file_rows = [], []
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir():
+                            sub_dirs.append(entry.path)
+                        else:
+                            entities = parse_entities(entry.name)
+                            file_rows.append([entry.path, dir_path, entry.name, perm_name(entry.name)] +
+                                             [entities.get(entity) for entity in ENTITIES])
+                self._db.execute('DELETE FROM files WHERE dir = ?', (dir_path,))
+                self._db.executemany(f'INSERT INTO files VALUES ({", ".join("?" * (4 + len(ENTITIES)))})',
+                                     file_rows)
+                self._db.execute('DELETE FROM dirs WHERE parent = ?', (dir_path,))
+                self._db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                                 (dir_path, None if dir_path == self.root else os.path.dirname(dir_path), mtime_ns))
+                # the listed subdirectories are checked next, with their stored mtime if they were indexed before
+                self._db.executemany('INSERT INTO dirs VALUES (?, ?, ?)',
+                                     [(sub_dir, dir_path, stored.get(sub_dir)) for sub_dir in sub_dirs])
+                stack.extend(sub_dirs)
+            # directories that were removed (or are no longer under an indexed folder)
+            for dir_path in set(stored) - seen:
+                self._db.execute('DELETE FROM dirs WHERE path = ?', (dir_path,))
+                self._db.execute('DELETE FROM files WHERE dir = ?', (dir_path,))
+        return n_listed
+
+    def frame(self, directory: str = None, **entities) -> pd.DataFrame:
+        """
+        Rows of the indexed files matching the entities, see query()
+
+        :return: DataFrame of path, dir, name, perm and the entity columns, sorted by path
+        """
+        where, params = [], []
+        if directory is not None:
+            where.append('dir = ?')
+            params.append(directory.rstrip('/'))
+        for entity, value in entities.items():
+            if entity not in ENTITIES + ['perm', 'name']:
+                raise ValueError(f"{entity} is not an indexed entity, options: {', '.join(ENTITIES)}, perm, name")
+            if isinstance(value, (list, tuple, set)):
+                where.append(f'"{entity}" IN ({", ".join("?" * len(value))})')
+                params.extend(str(v) for v in value)
+            else:
+                where.append(f'"{entity}" = ?')
+                params.append(str(value))
+        sql = 'SELECT * FROM files' + (f' WHERE {" AND ".join(where)}' if where else '') + ' ORDER BY path'
+        return pd.read_sql_query(sql, self._db, params=params)
+
+    def query(self, directory: str = None, **entities) -> list:
+        """
+        Paths of the indexed files matching every entity, e.g.
+        query(ses='1', task='mid', run='01', stat='beta', **parse_entities(model)). A value can be a list of
+        accepted values, perm matches the model permutation string (see perm_name()).
+
+        :param directory: only the files directly in this folder, default None (whole tree)
+        :param entities: entity=value filters
+        :return: sorted list of paths
+        """
+        return self.frame(directory=directory, **entities)['path'].tolist()
+
+
+def pair_by_subject(set1: pd.DataFrame, set2: pd.DataFrame) -> tuple:
+    """
+    Pairs two sets of index rows (e.g. run-01 and run-02 maps) by subject
+
+    :param set1: DataFrame of index rows, one per subject
+    :param set2: DataFrame of index rows, one per subject
+    :return: tuple of the two lists of paths in the same (sorted) subject order, and the list of subjects
+        found in only one of the sets
+    """
+    for set_df in [set1, set2]:
+        if set_df['sub'].duplicated().any():
+            raise ValueError(f"More than one map per subject: {set_df.loc[set_df['sub'].duplicated(), 'path'].tolist()}")
+    paired = set1[['sub', 'path']].merge(set2[['sub', 'path']], on='sub', suffixes=('_1', '_2')).sort_values('sub')
+    unpaired = sorted(set(set1['sub']) ^ set(set2['sub']))
+    return paired['path_1'].tolist(), paired['path_2'].tolist(), unpaired
@@ -0,0 +1,120 @@
+import numpy as np
+import nibabel as nib
+from collections import OrderedDict
+from nilearn.maskers import NiftiMasker
+
+
+def load_bold_run(nii_path: str, mask_img=None, dtype=None):
+    """
+    Loads a preprocessed BOLD run (e.g. fmriprep *desc-preproc_bold.nii.gz) into memory once, so that
+    the model permutations for the run reuse the decompressed data rather than re-reading the .nii.gz on each fit.
+    The brain mask is resolved once as well. If no mask is provided, it is computed from the BOLD
+    the same way FirstLevelModel does it when mask_img=None (NiftiMasker with mask_strategy='epi').
+
+    :param nii_path: path to the 4D BOLD .nii.gz
+    :param mask_img: path to a binarized brain mask or Nifti1Image, default None
+    :param dtype: dtype of the in-memory data, e.g. np.float32. Default None, as nibabel loads it
+    :return: tuple of the in-memory 4D Nifti1Image and the resolved 3D mask Nifti1Image
+    """
+    bold_img = nib.load(nii_path)
+    # np.asanyarray forces a single decompression/read of the data, scaling is applied as nibabel does on load
+    bold_dat = np.asanyarray(bold_img.dataobj) if dtype is None else bold_img.get_fdata(dtype=dtype)
+    bold_img = nib.Nifti1Image(bold_dat, bold_img.affine, bold_img.header)
+    if dtype is not None:
+        bold_img.set_data_dtype(dtype)
+
+    masker = NiftiMasker(mask_img=mask_img, mask_strategy='epi', standardize=False)
+    masker.fit(bold_img)
+
+    return bold_img, masker.mask_img_
+
+
+def masked_bold(bold_img, mask_img) -> np.ndarray:
+    """
+    Returns the masked BOLD as a 2D array (time x voxel), as used for the GLM fits.
+
+    :param bold_img: in-memory 4D Nifti1Image from load_bold_run()
+    :param mask_img: resolved 3D mask Nifti1Image from load_bold_run()
+    :return: 2D numpy array, time x voxel
+    """
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    return np.asanyarray(bold_img.dataobj)[mask].T
+
+
+def unmask_bold(data: np.ndarray, mask_img):
+    """
+    Puts masked data (voxel, or time x voxel) back into a 3D (or 4D) Nifti1Image in the mask space.
+    Same as nilearn.masking.unmask, without the mask checks that run on each call.
+
+    :param data: 1D array voxel or 2D array time x voxel
+    :param mask_img: resolved 3D mask Nifti1Image from load_bold_run()
+    :return: Nifti1Image
+    """
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    vol = np.zeros(mask.shape + data.shape[:-1], dtype=data.dtype)
+    vol[mask] = data.T
+    return nib.Nifti1Image(vol, mask_img.affine)
+
+
+def img_as_dtype(img, dtype):
+    """
+    Casts the data of a Nifti1Image, e.g. nilearn contrast maps to float32 before they're saved
+
+    :param img: Nifti1Image
+    :param dtype: numpy dtype, e.g. np.float32
+    :return: Nifti1Image with data + header dtype set to dtype
+    """
+    cast_img = nib.Nifti1Image(np.asanyarray(img.dataobj).astype(dtype, copy=False), img.affine, img.header)
+    cast_img.set_data_dtype(dtype)
+    return cast_img
+
+
+def smooth_masked_bold(bold_img, mask_img, fwhm: float) -> np.ndarray:
+    """
+    Smooths the 4D BOLD with a gaussian kernel and masks it, as FirstLevelModel does with smoothing_fwhm=fwhm
+    (smoothing in volume space, then masking).
+
+    :param bold_img: in-memory 4D Nifti1Image from load_bold_run()
+    :param mask_img: resolved 3D mask Nifti1Image from load_bold_run()
+    :param fwhm: smoothing kernel FWHM in mm
+    :return: 2D numpy array, time x voxel
+    """
+    if mask_img is None:
+        # a mask computed here would differ from the one the maps are saved in
+        raise ValueError("mask_img is required, use the mask resolved by load_bold_run()")
+    masker = NiftiMasker(mask_img=mask_img, smoothing_fwhm=fwhm, standardize=False)
+    return masker.fit().transform(bold_img)
+
+
+class SmoothedBoldCache:
+    """
+    Cache of smoothed + masked BOLD arrays (time x voxel) keyed by (run, fwhm, mask label), so each run
+    is smoothed once per kernel and shared across the motion x model type permutations.
+    Holds at most max_entries arrays, the oldest entry is evicted first.
+    """
+    def __init__(self, max_entries: int = 1):
+        if max_entries < 1:
+            raise ValueError(f"max_entries must be >= 1, {max_entries} provided")
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, run: str, fwhm: float, mask_label: str, bold_img, mask_img) -> np.ndarray:
+        """
+        Returns the smoothed + masked BOLD for (run, fwhm, mask_label), smoothing it only if it isn't cached.
+
+        :param run: run label, e.g. '01'
+        :param fwhm: smoothing kernel FWHM in mm
+        :param mask_label: label for the mask, e.g. mni152
+        :param bold_img: in-memory 4D Nifti1Image from load_bold_run()
+        :param mask_img: resolved 3D mask Nifti1Image from load_bold_run()
+        :return: 2D numpy array, time x voxel
+        """
+        key = (run, fwhm, mask_label)
+        if key not in self._entries:
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[key] = smooth_masked_bold(bold_img=bold_img, mask_img=mask_img, fwhm=fwhm)
+        return self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
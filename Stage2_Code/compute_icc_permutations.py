@@ -3,12 +3,68 @@ warnings.filterwarnings("ignore")
 warnings.filterwarnings("ignore", category=UserWarning, 
                         message="A NumPy version >=1.18.5 and <1.25.0 is required for this version of SciPy*")
 import os
+import sys
 import argparse
+import numpy as np
 import nibabel as nib
-from glob import glob
-from pyrelimri import brain_icc
 from nilearn import image, datasets
 
+try:
+    from pyrelimri import brain_icc
+except ImportError:
+    brain_icc = None
+
+# Getpath to Stage2 scripts
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_dir)
+from nilearn.maskers import NiftiMasker
+from Stage2_Code.icc_stream import voxelwise_icc_stream, voxelwise_icc_stream_many, load_session_maps, icc_bootstrap, icc_img_type, ICC_TYPES
+from Stage2_Code.bold_cache import unmask_bold
+from Stage2_Code.bids_index import FileIndex, pair_by_subject
+
+
+def index_icc_maps(file_index: FileIndex, ses: str, task: str, comp_type: str, strict: bool = False) -> dict:
+    """
+    Pairs every model permutation's maps by subject from the file index: run-01/run-02 _stat-beta maps of
+    ses-{ses} for run, the _stat-effect maps of the first two (sorted) sessions for session. Subjects without
+    both maps of a model are dropped, or raise an error with strict.
+
+    :param file_index: FileIndex of the input folder
+    :param ses: session label without 'ses-' (run type)
+    :param task: task label
+    :param comp_type: run or session
+    :param strict: raise an AssertionError for unpaired subjects instead of dropping them, default False
+    :return: dict of model permutation: [set1, set2], lists of paths in the same subject order
+    """
+    if comp_type == 'run':
+        set_rows = [file_index.frame(ses=ses, task=task, run=run, stat='beta') for run in ['01', '02']]
+    else:
+        session_list = sorted(file_index.frame(task=task, stat='effect')['ses'].dropna().unique())
+        assert len(session_list) >= 2, f"Two sessions of _stat-effect maps are required, found {session_list}"
+        set_rows = [file_index.frame(ses=sess, task=task, stat='effect') for sess in session_list[:2]]
+    for rows in set_rows:
+        rows['model'] = 'contrast-' + rows['contrast'] + '_' + rows['perm']
+
+    key_sessions = {}
+    for model_perm in sorted(set(set_rows[0]['model'].dropna()) | set(set_rows[1]['model'].dropna())):
+        set1, set2, unpaired = pair_by_subject(*[rows[rows['model'] == model_perm] for rows in set_rows])
+        if unpaired:
+            assert not strict, f"{model_perm}: subjects {', '.join(unpaired)} do not have both maps"
+            print(f"\t {model_perm}: {len(unpaired)} subjects without both maps dropped")
+        key_sessions[model_perm] = [set1, set2]
+    return key_sessions
+
+
+def save_icc_imgs(brain_models: dict, n_subs: int, model_perm: str):
+    for img_type in brain_models:
+        if mask_label is not None:
+            out_icc_path = f'{out_path}/subs-{n_subs}_type-{comp_type}_mask-{mask_label}_{model_perm}_stat-{img_type}.nii.gz'
+            nib.save(brain_models[img_type], out_icc_path)
+        else:
+            out_icc_path = f'{out_path}/subs-{n_subs}_type-{comp_type}_{model_perm}_stat-{img_type}.nii.gz'
+            nib.save(brain_models[img_type], out_icc_path)
+
+
 warnings.filterwarnings("ignore")
 
 parser = argparse.ArgumentParser(description="Script to run ICC permutations with PyReliMRI")
@@ -16,7 +72,10 @@ parser.add_argument("--sample", help="sample type, ahrb, abcd or mls?")
 parser.add_argument("--ses", help="session, include the session type without prefix, e.g., 1, 01, baselinearm1")
 parser.add_argument("--type", help="between runs or sessions, e.g., run, session")
 parser.add_argument("--model", help="model permutation, "
-                                    "e.g. contrast-Sgain-Neut_mask-mni152_mot-opt5_mod-FixMod_fwhm-6.0")
+                                    "e.g. contrast-Sgain-Neut_mask-mni152_mot-opt5_mod-FixMod_fwhm-6.0. A comma "
+                                    "separated list of permutations, or all (every permutation in --inp_path), runs "
+                                    "them in one job with the stream engine: subject folders are listed once and "
+                                    "each subject's maps are read once into per-model sums")
 parser.add_argument("--task", help="task mid, MID, or reward")
 parser.add_argument("--mask", help="path the to a binarized brain mask (e.g., MNI152 or "
                                    "constrained mask in MNI space, spec-network; default None",
@@ -25,6 +84,27 @@ parser.add_argument("--mask_label", help="label for mask, e.g. mni152, wilson-su
                     default=None)
 parser.add_argument("--inp_path", help="Path to the output directory for the fmriprep output")
 parser.add_argument("--output", help="output folder where to write out and save information")
+parser.add_argument("--file_index", help="path to the file index of --inp_path (SQLite, updated on each run for "
+                                         "the folders that changed), default in $TMPDIR",
+                    default=None)
+parser.add_argument("--engine", help="ICC engine: pyrelimri (voxelwise_icc, all maps in memory) or stream "
+                                     "(one subject at a time into running sums, memory independent of N)",
+                    choices=['pyrelimri', 'stream'], default='pyrelimri')
+parser.add_argument("--icc_type", help="ICC type(s): icc_3 (default), a comma separated list, e.g. icc_1,icc_3, "
+                                       "or all. icc_3 maps keep the stat-est/btwnsub/wthnsub labels, the others are "
+                                       "prefixed, e.g. stat-icc1est, stat-icc2btwnmeas. The stream engine computes "
+                                       "all types from one pass", default='icc_3')
+parser.add_argument("--model_batch", help="with several models, N of models accumulated at once (memory grows "
+                                          "with it), default 0 (all)", type=int, default=0)
+parser.add_argument("--bootstrap", help="N of bootstrap resamples for 95%% CI maps of the ICC estimate "
+                                        "(stat-bootlowbound / stat-bootupbound), default 0 (no bootstrap). "
+                                        "Requires --mask", type=int, default=0)
+parser.add_argument("--boot_weights", help="bootstrap resample weights, multinomial (resample subjects with "
+                                           "replacement) or poisson", choices=['multinomial', 'poisson'],
+                    default='multinomial')
+parser.add_argument("--boot_seed", help="seed of the bootstrap resamples, default None", type=int, default=None)
+parser.add_argument("--precision", help="float precision of the Wilson mask build, float64 (default, int masks) or "
+                                        "float32 (uint8 masks)", choices=['float64', 'float32'], default='float64')
 args = parser.parse_args()
 
 # Now you can access the arguments as attributes of the 'args' object.
@@ -37,6 +117,16 @@ mask = args.mask
 mask_label = args.mask_label
 inp_path = args.inp_path
 out_path = args.output
+if args.engine == 'pyrelimri' and brain_icc is None:
+    parser.error("pyrelimri is required for --engine pyrelimri, install it or use --engine stream")
+icc_types = ICC_TYPES if args.icc_type == 'all' else args.icc_type.split(',')
+if any(icc_type not in ICC_TYPES for icc_type in icc_types):
+    parser.error(f"--icc_type should be in {','.join(ICC_TYPES)} or all, {args.icc_type} entered")
+multi_model = model == 'all' or ',' in model
+if multi_model and (args.engine != 'stream' or args.bootstrap > 0):
+    parser.error("several models require --engine stream and no --bootstrap")
+if args.bootstrap > 0 and mask is None:
+    parser.error("--bootstrap requires --mask")
 
 
 # download neurovault mask if sub and suprathresh masks dont exist
@@ -51,46 +141,69 @@ if mask is not None and not os.path.exists(mask):
 
     # binarize masked image
     threshold = 3.1
+    wilson_dtype, mask_dtype = (np.float32, np.uint8) if args.precision == 'float32' else (np.float64, int)
 
     for thresh in ['supra', 'sub']:
         if thresh == 'supra':
-            thresh_bin = (wilson_resample.get_fdata() > threshold).astype(int)
+            thresh_bin = (wilson_resample.get_fdata(dtype=wilson_dtype) > threshold).astype(mask_dtype)
             thresh_mask_img = nib.Nifti1Image(thresh_bin, wilson_resample.affine)
             output_path = f'{mask_dir}/MNI152_wilson-{thresh}.nii.gz'
             nib.save(thresh_mask_img, output_path)
         else:
-            thresh_bin = (wilson_resample.get_fdata() < threshold).astype(int)
+            thresh_bin = (wilson_resample.get_fdata(dtype=wilson_dtype) < threshold).astype(mask_dtype)
             mni_mask = nib.load(mask)
-            thresh_bin *= mni_mask.get_fdata().astype(int)
+            thresh_bin *= mni_mask.get_fdata(dtype=wilson_dtype).astype(mask_dtype)
             thresh_mask_img = nib.Nifti1Image(thresh_bin, wilson_resample.affine)
             output_path = f'{mask_dir}/MNI152_wilson-{thresh}.nii.gz'
             nib.save(thresh_mask_img, output_path)
 
-if 'run' == comp_type:
-    set1 = sorted(glob(f'{inp_path}/ses-{ses}/**/*_ses-{ses}_task-{task}_run-01_{model}_stat-beta.nii.gz'))
-    set2 = sorted(glob(f'{inp_path}/ses-{ses}/**/*_ses-{ses}_task-{task}_run-02_{model}_stat-beta.nii.gz'))
-    assert len(set1) > 0 and len(set2) > 0, f'Length of set1 [{len(set1)}] and/or set2 [{len(set2)}] is zero.'
-    assert len(set1) == len(set2), f'Lengths of set1 [{len(set1)}] and set2 [{len(set2)}] are not equal.'
-    match_string_position = all(
-        a.split('_')[0:3] == b.split('_')[0:3] and a.split('_')[5:] == b.split('_')[5:] for a, b in zip(set1, set2))
-    assert match_string_position, "Values at path-positions 0:3 and 5: do not match. Subjects may be misaligned."
-elif 'session' == comp_type:
-    session_list = os.listdir(inp_path)
-    set1 = sorted(glob(f'{inp_path}/{session_list[0]}/**/*_{session_list[0]}_task-{task}_{model}_stat-effect.nii.gz'))
-    set2 = sorted(glob(f'{inp_path}/{session_list[1]}/**/*_{session_list[1]}_task-{task}_{model}_stat-effect.nii.gz'))
-    assert len(set1) == len(set2), f'Lengths of set1 [{len(set1)}] and set2 [{len(set2)}] are not equal.'
-else:
-    print("incorrect reliability type provided. Options run and session")
+file_index = FileIndex(root=inp_path, index_path=args.file_index)
+if multi_model:
+    if comp_type not in ['run', 'session']:
+        sys.exit("incorrect reliability type provided. Options run and session")
+    key_sessions = index_icc_maps(file_index=file_index, ses=ses, task=task, comp_type=comp_type)
+    if model != 'all':
+        missing = [model_perm for model_perm in model.split(',') if model_perm not in key_sessions]
+        assert not missing, f"No maps found for models: {', '.join(missing)}"
+        key_sessions = {model_perm: key_sessions[model_perm] for model_perm in model.split(',')}
+    model_perms = [model_perm for model_perm, (set1, _) in key_sessions.items() if len(set1) > 1]
+    batch_n = args.model_batch if args.model_batch > 0 else len(model_perms)
+    for batch_start in range(0, len(model_perms), batch_n):
+        batch_perms = model_perms[batch_start:batch_start + batch_n]
+        print(f"Running {', '.join(icc_types)} for {len(batch_perms)} models")
+        key_imgs = voxelwise_icc_stream_many(key_sessions={model_perm: key_sessions[model_perm]
+                                                           for model_perm in batch_perms},
+                                             mask=mask, icc_types=icc_types)
+        for model_perm, brain_models in key_imgs.items():
+            save_icc_imgs(brain_models, len(key_sessions[model_perm][0]), model_perm)
+    sys.exit(0)
 
+if comp_type not in ['run', 'session']:
+    sys.exit("incorrect reliability type provided. Options run and session")
+key_sessions = index_icc_maps(file_index=file_index, ses=ses, task=task, comp_type=comp_type, strict=True)
+assert model in key_sessions, f'No {comp_type} maps found for {model}'
+set1, set2 = key_sessions[model]
 
-print(f"Running ICC(3,1) on {len(set1)} subjects")
-brain_models = brain_icc.voxelwise_icc(multisession_list = [set1, set2],
-                                        mask=mask, icc_type='icc_3')
 
-for img_type in ['est', 'btwnsub', 'wthnsub']:
-    if mask_label is not None:
-        out_icc_path = f'{out_path}/subs-{len(set1)}_type-{comp_type}_mask-{mask_label}_{model}_stat-{img_type}.nii.gz'
-        nib.save(brain_models[img_type], out_icc_path)
-    else:
-        out_icc_path = f'{out_path}/subs-{len(set1)}_type-{comp_type}_{model}_stat-{img_type}.nii.gz'
-        nib.save(brain_models[img_type], out_icc_path)
+print(f"Running {', '.join(icc_types)} on {len(set1)} subjects")
+if args.engine == 'stream':
+    brain_models = voxelwise_icc_stream(multisession_list=[set1, set2], mask=mask, icc_types=icc_types)
+else:
+    brain_models = {}
+    for icc_type in icc_types:
+        icc_models = brain_icc.voxelwise_icc(multisession_list = [set1, set2],
+                                             mask=mask, icc_type=icc_type)
+        est_names = ['est', 'btwnsub', 'wthnsub'] + (['btwnmeas'] if icc_type == 'icc_2' else [])
+        brain_models.update({icc_img_type(icc_type, est_name): icc_models[est_name] for est_name in est_names})
+
+if args.bootstrap > 0:
+    print(f"Bootstrapping ICC(3,1) CIs with {args.bootstrap} {args.boot_weights} resamples")
+    mask_img = NiftiMasker(mask_img=mask).fit().mask_img_
+    icc_data = load_session_maps(multisession_list=[set1, set2], mask_img=mask_img)
+    boot_bounds = icc_bootstrap(data=icc_data, n_boot=args.bootstrap, weights=args.boot_weights,
+                                seed=args.boot_seed)
+    del icc_data
+    for bound, bound_est in boot_bounds.items():
+        brain_models[f'boot{bound}'] = unmask_bold(bound_est, mask_img)
+
+save_icc_imgs(brain_models, len(set1), model)
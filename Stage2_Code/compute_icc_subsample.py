@@ -1,10 +1,26 @@
+import os
+import sys
 import warnings
 import argparse
+import numpy as np
+import pandas as pd
 import nibabel as nib
 import random
-from pyrelimri import brain_icc
+from nilearn.maskers import NiftiMasker
 warnings.filterwarnings("ignore")
 
+try:
+    from pyrelimri import brain_icc
+except ImportError:
+    brain_icc = None
+
+# Getpath to Stage2 scripts
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_dir)
+from Stage2_Code.icc_stream import StreamingICC, load_session_maps, icc_batch, icc_img_type, ICC_TYPES
+from Stage2_Code.bold_cache import unmask_bold
+from Stage2_Code.bids_index import FileIndex, parse_entities, perm_name
+
 # running below after 100 random seeds are generated using
 # random.seed(100); [random.randint(1,10000) for _ in range(100)]
 
@@ -20,7 +36,26 @@ parser.add_argument("--mask", help="path the to a binarized brain mask (e.g., MN
                     default=None)
 parser.add_argument("--inp_path", help="Path to the output directory for the fmriprep derivatives")
 parser.add_argument("--output", help="output folder where to write out and save information")
-parser.add_argument("--seed", help="set seed for reproducibility of random choice")
+parser.add_argument("--file_index", help="path to the file index of {inp_path}/ses-{ses} (SQLite, updated on each "
+                                         "run for the folders that changed), default in $TMPDIR",
+                    default=None)
+parser.add_argument("--seed", help="set seed for reproducibility of random choice. The index engine takes a comma "
+                                   "separated list of seeds, e.g. 1,2,3, all run in one job on one data load")
+parser.add_argument("--n_seeds", help="index engine: use the first n_seeds of the seed list in the comment below "
+                                      "instead of --seed", type=int, default=None)
+parser.add_argument("--save_seed_maps", help="with several seeds, also save the maps of each seed x N "
+                                             "(default saves only the across-seed summaries)", action="store_true")
+parser.add_argument("--icc_type", help="ICC type(s): icc_3 (default), a comma separated list, e.g. icc_1,icc_3, "
+                                       "or all. icc_3 maps keep the stat-est/btwnsub/wthnsub labels, the others are "
+                                       "prefixed, e.g. stat-icc1est. The index engine computes all types at once",
+                    default='icc_3')
+parser.add_argument("--engine", help="pyrelimri (voxelwise_icc per N, files reloaded at each N) or index (each "
+                                     "subject loaded once into a masked subject x run x voxel array, subsamples "
+                                     "picked by index; requires --mask)",
+                    choices=['pyrelimri', 'index'], default='pyrelimri')
+parser.add_argument("--nested", help="index engine: draw max_n subjects once and use the first N of the draw for "
+                                     "each N, the curve is computed from running sums in one pass over max_n "
+                                     "subjects. Default draws a new subsample at each N", action="store_true")
 args = parser.parse_args()
 
 # Now you can access the arguments as attributes of the 'args' object.
@@ -33,7 +68,22 @@ subject_list = args.sub_list
 mask = args.mask
 inp_path = args.inp_path
 out_path = args.output
-seed = int(args.seed)
+if args.n_seeds is not None:
+    random.seed(100)
+    seeds = [random.randint(1, 10000) for _ in range(100)][:args.n_seeds]
+else:
+    seeds = [int(seed) for seed in args.seed.split(',')]
+icc_types = ICC_TYPES if args.icc_type == 'all' else args.icc_type.split(',')
+if any(icc_type not in ICC_TYPES for icc_type in icc_types):
+    parser.error(f"--icc_type should be in {','.join(ICC_TYPES)} or all, {args.icc_type} entered")
+if args.engine == 'pyrelimri' and brain_icc is None:
+    parser.error("pyrelimri is required for --engine pyrelimri, install it or use --engine index")
+if args.engine == 'index' and mask is None:
+    parser.error("--engine index requires --mask")
+if args.nested and args.engine != 'index':
+    parser.error("--nested requires --engine index")
+if len(seeds) > 1 and args.engine != 'index':
+    parser.error("several seeds require --engine index")
 
 # read in subject list
 with open(subject_list, "r") as file:
@@ -46,23 +96,97 @@ sublist_clean = [line.strip() for line in subj_ids]
 n_int = 50
 n_range = list(range(min_n, max_n+n_int, n_int))
 
+file_index = FileIndex(root=f'{inp_path}/ses-{ses}', index_path=args.file_index)
+# subject: path of the model's run-01 and run-02 maps
+run_maps = [dict(zip('sub-' + rows['sub'], rows['path']))
+            for rows in (file_index.frame(ses=ses, task=task, run=run, stat='beta', perm=perm_name(model),
+                                          contrast=parse_entities(model)['contrast']) for run in ['01', '02'])]
+
+
+def subsample_paths(subsample_id: list) -> tuple:
+    assert len(subsample_id) > 0, 'Subsample is empty.'
+    missing = [subj_id for subj_id in subsample_id if subj_id not in run_maps[0] or subj_id not in run_maps[1]]
+    assert not missing, f"No run-01 and run-02 {model} maps for {', '.join(sorted(set(missing)))}"
+    set1 = [run_maps[0][subj_id] for subj_id in subsample_id]
+    set2 = [run_maps[1][subj_id] for subj_id in subsample_id]
+    return set1, set2
+
+
+def save_icc_maps(brain_models: dict, n_subs: int, seed: int):
+    for img_type in brain_models:
+        out_icc_path = f'{out_path}/seed-{seed}_subs-{n_subs}_task-MID_type-run_{model}_stat-{img_type}.nii.gz'
+        nib.save(brain_models[img_type], out_icc_path)
+
+
+if args.engine == 'index':
+    # same draws per seed as the per-N loop (or one max_n draw when nested), then each drawn subject is loaded once
+    seed_subsamples = {}
+    for seed in seeds:
+        random.seed(seed)
+        if args.nested:
+            subsample_id = random.choices(sublist_clean, k=max(n_range))
+            seed_subsamples[seed] = [subsample_id[:subj_n] for subj_n in n_range]
+        else:
+            seed_subsamples[seed] = [random.choices(sublist_clean, k=subj_n) for subj_n in n_range]
+    pool_ids = sorted(set(subj_id for subsamples in seed_subsamples.values()
+                          for subsample_id in subsamples for subj_id in subsample_id))
+    print(f"Loading {len(pool_ids)} unique subjects once for {len(seeds)} seeds x {len(n_range)} subsample sizes")
+    mask_img = NiftiMasker(mask_img=mask).fit().mask_img_
+    pool_data = load_session_maps(multisession_list=list(subsample_paths(pool_ids)), mask_img=mask_img)
+    pool_row = {subj_id: row for row, subj_id in enumerate(pool_ids)}
+    # seed x N rows of pool_data per subsample size
+    index_sets = [np.array([[pool_row[subj_id] for subj_id in seed_subsamples[seed][n_i]] for seed in seeds])
+                  for n_i in range(len(n_range))]
+
+    if args.nested:
+        # running sums of every seed's draw at once, seeds stacked along the voxel axis
+        n_vox = pool_data.shape[2]
+        icc_model = StreamingICC(n_vox=len(seeds) * n_vox, n_sessions=pool_data.shape[1])
+        draw_rows = index_sets[-1]
+        n_estimates = []
+        for subj_i in range(draw_rows.shape[1]):
+            icc_model.update(np.moveaxis(pool_data[draw_rows[:, subj_i]], 1, 0).reshape(pool_data.shape[1], -1))
+            if subj_i + 1 in n_range:
+                n_estimates.append({est_name: est.reshape(len(seeds), n_vox)
+                                    for est_name, est in icc_model.estimates(icc_types).items()})
+    else:
+        n_estimates = (icc_batch(pool_data, index_sets[n_i], icc_types=icc_types) for n_i in range(len(n_range)))
+
+    curve_rows = []
+    for subj_n, estimates in zip(n_range, n_estimates):
+        print(f"Running {', '.join(icc_types)} on {subj_n} subjects for {len(seeds)} seeds")
+        for seed_i, seed in enumerate(seeds):
+            subsample_id = seed_subsamples[seed][n_range.index(subj_n)]
+            curve_rows.append(dict({'seed': seed, 'n': subj_n, 'n_unique': len(set(subsample_id))},
+                                   **{est_name: np.nanmean(est[seed_i]) for est_name, est in estimates.items()}))
+            if len(seeds) == 1 or args.save_seed_maps:
+                save_icc_maps({est_name: unmask_bold(est[seed_i], mask_img) for est_name, est in estimates.items()},
+                              subj_n, seed)
+        if len(seeds) > 1:
+            # voxelwise summary across seeds
+            for img_type, est in estimates.items():
+                for stat_name, stat_func in [('mean', np.nanmean), ('sd', np.nanstd)]:
+                    summary_path = f'{out_path}/seeds-{len(seeds)}_subs-{subj_n}_task-MID_type-run_{model}_' \
+                                   f'stat-{img_type}_summary-{stat_name}.nii.gz'
+                    nib.save(unmask_bold(stat_func(est, axis=0), mask_img), summary_path)
+
+    # in-mask mean ICC per seed x N, the reliability curves
+    curve_df = pd.DataFrame(curve_rows)
+    curve_df.to_csv(f'{out_path}/seeds-{len(seeds)}_task-MID_type-run_{model}_curve.tsv', sep='\t', index=False)
+    sys.exit(0)
+
+seed = seeds[0]
 random.seed(seed)
 for subj_n in n_range:
     subsample_id = random.choices(sublist_clean, k=subj_n)
     print(f"Of the {len(subsample_id)} subject IDs, n = {len(set(subsample_id))} are unique")
+    set1, set2 = subsample_paths(subsample_id)
 
-    set1 = [f'{inp_path}/ses-{ses}/{subj_id}/{subj_id}_ses-{ses}_task-{task}_run-01_{model}_stat-beta.nii.gz' for subj_id in subsample_id]
-    set2 = [f'{inp_path}/ses-{ses}/{subj_id}/{subj_id}_ses-{ses}_task-{task}_run-02_{model}_stat-beta.nii.gz' for subj_id in subsample_id]
-
-    assert len(set1) > 0 and len(set2) > 0, f'Length of set1 [{len(set1)}] and/or set2 [{len(set2)}] is zero.'
-    assert len(set1) == len(set2), f'Lengths of set1 [{len(set1)}] and set2 [{len(set2)}] are not equal.'
-    match_string_position = all(
-        a.split('_')[0:3] == b.split('_')[0:3] and a.split('_')[5:] == b.split('_')[5:] for a, b in zip(set1, set2))
-    assert match_string_position, "Values at path-positions 2:3 and 5: do not match."
-
-    print(f"Running ICC(3,1) on {len(set1)} subjects")
-    brain_models = brain_icc.voxelwise_icc(multisession_list=[set1, set2],
-                                           mask=mask, icc_type='icc_3')
-    for img_type in ['est', 'btwnsub', 'wthnsub']:
-        out_icc_path = f'{out_path}/seed-{seed}_subs-{len(set1)}_task-MID_type-run_{model}_stat-{img_type}.nii.gz'
-        nib.save(brain_models[img_type], out_icc_path)
+    print(f"Running {', '.join(icc_types)} on {len(set1)} subjects")
+    brain_models = {}
+    for icc_type in icc_types:
+        icc_models = brain_icc.voxelwise_icc(multisession_list=[set1, set2],
+                                             mask=mask, icc_type=icc_type)
+        est_names = ['est', 'btwnsub', 'wthnsub'] + (['btwnmeas'] if icc_type == 'icc_2' else [])
+        brain_models.update({icc_img_type(icc_type, est_name): icc_models[est_name] for est_name in est_names})
+    save_icc_maps(brain_models, len(set1), seed)
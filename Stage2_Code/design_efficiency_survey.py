@@ -0,0 +1,192 @@
+import warnings
+warnings.filterwarnings("ignore")
+import sys
+import os
+import argparse
+import pandas as pd
+from glob import glob
+from itertools import product
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# Getpath to Stage2 scripts
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_dir)
+from Stage2_Code.designmat_regressors_define import create_design_mid, pull_regressors, eff_estimator_batch
+from Stage2_Code.glm_batch import contrast_vectors
+
+# relabel column names to match templates code for ABCD/MLS
+dict_renamecols_abcd = {
+    'Cue.OnsetTime': 'CUE_ONSET',
+    'Cue.Duration': 'CUE_DURATION',
+    'Anticipation.OnsetTime': 'FIXATION_ONSET',
+    'Anticipation.Duration': 'FIXATION_DURATION',
+    'Feedback.OnsetTime': 'FEEDBACK_ONSET',
+    'FeedbackDuration': 'FEEDBACK_DURATION',
+    'Condition': 'TRIAL_TYPE',
+    'Result': 'TRIAL_RESULT'
+}
+
+dict_renamecols_mls = {
+    'Cue.OnsetTime': 'CUE_ONSET',
+    'Cue.Duration': 'CUE_DURATION',
+    'Fix.OnsetTime': 'FIXATION_ONSET',
+    'Fix.Duration': 'FIXATION_DURATION',
+    'Feedback.OnsetTime': 'FEEDBACK_ONSET',
+    'Feedback.Duration': 'FEEDBACK_DURATION',
+    'Condition': 'TRIAL_TYPE',
+    'Result': 'TRIAL_RESULT'
+}
+
+dict_rename_cuetype = {
+        'LgReward': 'LargeGain',
+        'LgPun': 'LargeLoss',
+        'Triangle': 'NoMoneyStake',
+        'SmallReward': 'SmallGain',
+        'SmallPun': 'SmallLoss'
+}
+
+# model design options, contrasts and weights setup
+model_types = {
+    "AntMod": ['CUE_ONSET', "ANTICIPATION_DURATION"],
+    "FixMod": ['FIXATION_ONSET', "FIXATION_DURATION"],
+    "CueMod": ['CUE_ONSET', 'CUE_DURATION']
+}
+
+contrast_weights = {
+    'Lgain-Neut': {'LargeGain': 1, 'NoMoneyStake': -1},
+    'Sgain-Neut': {'SmallGain': 1, 'NoMoneyStake': -1},
+    'Lgain-Base': {'LargeGain': 1},
+    'Sgain-Base': {'SmallGain': 1}
+}
+
+runs = ['01', '02']
+
+# only including 4; opt 5 is opt3 + subj mFD < .9 & opt6 is opt4 + subj mFD < .9
+motion_opt = ["opt1", "opt2", "opt3", "opt4"]
+modtype_opt = ["CueMod", "AntMod", "FixMod"]
+
+
+def subject_efficiency(subj: str, acompcor_excl: bool, sample: str, task: str, ses: str, stc, boldtr: float,
+                       numvols: int, beh_path: str, fmriprep_path: str) -> list:
+    """
+    Design efficiency of each run x motion x model type design for a subject, using only the events and
+    the fmriprep confounds files (no BOLD data). The designs are the same as in runs_withinrun_permutations.py.
+    Runs with missing events/confounds are skipped.
+
+    :param subj: subject label, including 'sub-' prefix
+    :param acompcor_excl: subject is flagged for aCompCor exclusion, opt3/opt4 designs are skipped
+    :param sample: sample type, abcd, AHRB or MLS
+    :param task: task label, e.g. mid
+    :param ses: session label without 'ses-' prefix
+    :param stc: slice time correction, passed to create_design_mid as in the first level scripts
+    :param boldtr: TR in seconds
+    :param numvols: N of volumes, if None the N of rows in the confounds file is used
+    :param beh_path: path to the behavioral (events .tsv) directory
+    :param fmriprep_path: path to the fmriprep directory with the confounds
+    :return: list of (subject, session, run, motion, model, con, eff_est) rows
+    """
+    rows = []
+    for run in runs:
+        events_path = f'{beh_path}/{subj}/ses-{ses}/func/{subj}_ses-{ses}_task-{task}_run-{run}_events.tsv'
+        conf_path = f'{fmriprep_path}/{subj}/ses-{ses}/func/{subj}_ses-{ses}_task-{task}_run-{run}' \
+                    f'_desc-confounds_timeseries.tsv'
+        if not (os.path.exists(events_path) and os.path.exists(conf_path)):
+            print(f"\t {subj} run-{run}: events or confounds file missing, skipping")
+            continue
+        events_df = pd.read_csv(events_path, sep='\t')
+        if sample == 'abcd':
+            events_df = events_df.rename(columns=dict_renamecols_abcd)
+            events_df['TRIAL_TYPE'] = events_df['TRIAL_TYPE'].replace(dict_rename_cuetype)
+        elif sample == 'MLS':
+            events_df = events_df.rename(columns=dict_renamecols_mls)
+            events_df['TRIAL_TYPE'] = events_df['TRIAL_TYPE'].replace(dict_rename_cuetype)
+
+        run_designs = {}
+        for motion, model in product(motion_opt, modtype_opt):
+            if acompcor_excl and motion in ["opt3", "opt4"]:
+                continue
+            conf_regressors = pull_regressors(confound_path=conf_path, regressor_type=motion, sample=sample)
+            run_designs[(motion, model)] = create_design_mid(
+                events_df=events_df, bold_tr=boldtr,
+                num_volumes=numvols if numvols is not None else len(conf_regressors),
+                onset_label=model_types[model][0], duration_label=model_types[model][1],
+                conf_regressors=conf_regressors, hrf_model='spm', stc=stc)
+
+        run_effs = eff_estimator_batch(desmats=list(run_designs.values()),
+                                       contrast_matrices=[contrast_vectors(design_matrix, contrast_weights)
+                                                          for design_matrix in run_designs.values()])
+        rows += [(subj, ses, run, motion, model, con_name, run_effs[des_i, con_i])
+                 for des_i, (motion, model) in enumerate(run_designs)
+                 for con_i, con_name in enumerate(contrast_weights)]
+    return rows
+
+
+def try_subject_efficiency(subj: str, acompcor_excl: bool, **kwargs) -> tuple:
+    # subject_efficiency() rows, or the error of a subject whose events / confounds couldn't be used, so one bad
+    # subject doesn't discard the cohort's results
+    try:
+        return subject_efficiency(subj, acompcor_excl, **kwargs), None
+    except Exception as e:
+        return [], f'{type(e).__name__}: {e}'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script to estimate design efficiency for all subjects x runs x "
+                                                 "motion/model permutations, from events + confounds only")
+    parser.add_argument("--sample", help="sample type, abcd, AHRB, MLS?")
+    parser.add_argument("--task", help="task type -- e.g., mid, reward, etc")
+    parser.add_argument("--ses", help="session, include the session type without prefix, e.g., 1, 01, baselinearm1")
+    parser.add_argument("--stc", help="slice time correction performed or not during preprocessing? "
+                                      "False (no), True (yes)")
+    parser.add_argument("--numvols", help="The number of volumes for BOLD file, e.g numeric. "
+                                          "Default None, N rows of each confounds file", default=None)
+    parser.add_argument("--boldtr", help="the tr value for the datasets in seconds, e.g. .800, 2.0, 3.0")
+    parser.add_argument("--beh_path", help="Path to the behavioral (.tsv) directory/files for the task")
+    parser.add_argument("--fmriprep_path", help="Path to the output directory for the fmriprep output")
+    parser.add_argument("--sub_list", help="subject list, one sub- ID per line. Default None, "
+                                           "all sub-* folders in beh_path", default=None)
+    parser.add_argument("--excl", help="TSV file with Subjects Inclusion(0)+exclusion for acompcor=1=",
+                        default=None)
+    parser.add_argument("--n_jobs", help="N of worker processes, default 1", type=int, default=1)
+    parser.add_argument("--output", help="output file, .parquet (columnar, requires pyarrow) or .tsv")
+    args = parser.parse_args()
+
+    numvols = int(args.numvols) if args.numvols is not None else None
+
+    if args.sub_list is not None:
+        with open(args.sub_list, "r") as file:
+            subjects = [line.strip() for line in file if line.strip()]
+    else:
+        subjects = sorted(os.path.basename(sub_dir) for sub_dir in glob(f'{args.beh_path}/sub-*'))
+
+    # check exclusions
+    if args.excl is not None:
+        excl_subs = pd.read_csv(args.excl, sep='\t', header=None)
+        excl_ids = set(excl_subs[excl_subs[1] == 1][0])
+    else:
+        excl_ids = set()
+
+    print(f"Estimating design efficiency for {len(subjects)} subjects with {args.n_jobs} workers")
+    subj_efficiency = partial(try_subject_efficiency, sample=args.sample, task=args.task, ses=args.ses, stc=args.stc,
+                              boldtr=float(args.boldtr), numvols=numvols, beh_path=args.beh_path,
+                              fmriprep_path=args.fmriprep_path)
+    with ProcessPoolExecutor(max_workers=args.n_jobs) as executor:
+        subj_results = list(executor.map(subj_efficiency, subjects, [subj in excl_ids for subj in subjects],
+                                         chunksize=max(1, len(subjects) // (args.n_jobs * 4))))
+    eff_df = pd.DataFrame([row for rows, _ in subj_results for row in rows],
+                          columns=['subject', 'session', 'run', 'motion', 'model', 'con', 'eff_est'])
+    failed = pd.DataFrame([(subj, error) for subj, (_, error) in zip(subjects, subj_results) if error is not None],
+                          columns=['subject', 'error'])
+
+    if args.output.endswith('.parquet'):
+        eff_df.to_parquet(args.output, index=False)
+    else:
+        eff_df.to_csv(args.output, sep='\t', index=False)
+    print(f"Saved {len(eff_df)} efficiency estimates to {args.output}")
+    if not failed.empty:
+        failed_path = f'{os.path.splitext(args.output)[0]}_failed.tsv'
+        failed.to_csv(failed_path, sep='\t', index=False)
+        for subj, error in failed.itertuples(index=False):
+            print(f"\t {subj} failed: {error}", file=sys.stderr)
+        print(f"{len(failed)} of {len(subjects)} subjects failed, listed in {failed_path}", file=sys.stderr)
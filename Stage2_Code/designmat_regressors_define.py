@@ -2,8 +2,9 @@ import os
 import pandas as pd
 import numpy as np
 from nilearn.glm.first_level import make_first_level_design_matrix
+from nilearn.glm._utils import full_rank
 from nipype.interfaces.fsl.model import SmoothEstimate
-from glob import glob
+from functools import lru_cache
 
 
 def smooth_estimate(img_paths, mask_path, out_path):
@@ -53,6 +54,77 @@ def eff_estimator(desmat, contrast_matrix):
     return 1/var_vec
 
 
+def eff_estimator_batch(desmats: list, contrast_matrices: list) -> np.ndarray:
+    """
+    Estimates the efficiency for a set of design matrices, each with its own contrast matrix, as eff_estimator
+    does for one design. Designs can differ in N of regressors (e.g. motion options / motion outliers) or
+    volumes; they are zero-padded to a common size and solved in one batch, using a Cholesky factor of X'X
+    rather than an explicit inverse: var = ||L^-1 c'||^2 where X'X = LL'.
+    :param desmats: list of design matrices (time x regressor), pandas dataframe or numpy array
+    :param contrast_matrices: list of contrast matrices (contrast x regressor), one per design,
+        same N of contrasts for each design
+    :return: numpy array design x contrast of efficiencies, in the order of desmats and contrast rows
+    """
+    if len(desmats) != len(contrast_matrices):
+        raise ValueError(f"N of designs [{len(desmats)}] and contrast matrices [{len(contrast_matrices)}] differ")
+    n_time = max(np.shape(desmat)[0] for desmat in desmats)
+    n_regs = max(np.shape(desmat)[1] for desmat in desmats)
+    n_cons = np.shape(contrast_matrices[0])[0]
+
+    X = np.zeros((len(desmats), n_time, n_regs))
+    C = np.zeros((len(desmats), n_cons, n_regs))
+    pad_diag = np.zeros((len(desmats), n_regs))
+    for i, (desmat, con_mat) in enumerate(zip(desmats, contrast_matrices)):
+        rows, cols = np.shape(desmat)
+        if np.shape(con_mat) != (n_cons, cols):
+            raise ValueError(f"Contrast matrix {i} shape {np.shape(con_mat)} does not match ({n_cons}, {cols})")
+        X[i, :rows, :cols] = np.asarray(desmat, dtype=np.float64)
+        C[i, :, :cols] = np.asarray(con_mat, dtype=np.float64)
+        pad_diag[i, cols:] = 1
+
+    # padded regressors get 1 on the diagonal, they're uncorrelated and have 0 contrast weight
+    xtx = np.transpose(X, (0, 2, 1)) @ X
+    xtx[:, np.arange(n_regs), np.arange(n_regs)] += pad_diag
+    try:
+        chol = np.linalg.cholesky(xtx)
+        var_vec = np.sum(np.linalg.solve(chol, np.transpose(C, (0, 2, 1))) ** 2, axis=1)
+    except np.linalg.LinAlgError:
+        # rank deficient design, no Cholesky factor
+        var_vec = np.einsum('dcp,dpc->dc', C, np.linalg.pinv(xtx) @ np.transpose(C, (0, 2, 1)))
+    return 1/var_vec
+
+
+# fmriprep confound regressors used for the opt1 to opt3 regressor sets, opt4 adds motion_outlier* columns
+confound_opts = {
+    "opt1": ['cosine00', 'cosine01', 'cosine02', 'cosine03'],
+    "opt2": ['cosine00', 'cosine01', 'cosine02', 'cosine03',
+             'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z',
+             'trans_x_derivative1', 'trans_y_derivative1', 'trans_z_derivative1',
+             'rot_x_derivative1', 'rot_y_derivative1', 'rot_z_derivative1'],
+    "opt3": ['cosine00', 'cosine01', 'cosine02', 'cosine03',
+             'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z',
+             'trans_x_derivative1', 'trans_y_derivative1', 'trans_z_derivative1',
+             'rot_x_derivative1', 'rot_y_derivative1', 'rot_z_derivative1',
+             "a_comp_cor_00", "a_comp_cor_01", "a_comp_cor_02", "a_comp_cor_03", "a_comp_cor_04",
+             "a_comp_cor_05", "a_comp_cor_06", "a_comp_cor_07"]
+}
+
+
+@lru_cache(maxsize=4)
+def load_confounds(confound_path: str) -> pd.DataFrame:
+    """
+    Reads a *confounds_timeseries.tsv file exported by fMRIprep, keeping only the columns used by
+    pull_regressors (see confound_opts) and the motion_outlier* columns. The file is parsed once and
+    the frame is cached for the following calls on the same path, so do not modify the returned frame in place.
+
+    :param confound_path: path to the *counfounds_timeseries.tsv
+    :return: pandas dataframe of the confounds, n/a filled with 0
+    """
+    header = pd.read_csv(confound_path, sep='\t', nrows=0).columns
+    keep_cols = [col for col in header if col in confound_opts['opt3'] or 'motion_outlier' in col]
+    return pd.read_csv(confound_path, sep='\t', usecols=keep_cols, na_values=['n/a']).fillna(0)
+
+
 def pull_regressors(confound_path: str, regressor_type: str = 'opt1', sample: str = None) -> pd.DataFrame:
     """
     This function is compatible with the *confounds_timeseries.tsv file exported by fMRIprep
@@ -73,40 +145,12 @@ def pull_regressors(confound_path: str, regressor_type: str = 'opt1', sample: st
     if not os.path.exists(confound_path):
         raise ValueError("Confounds file path not found. Check if {} exists".format(confound_path))
 
-    confound_df = glob(confound_path)[0]
-    confound_df = pd.read_csv(confound_df, sep='\t', na_values=['n/a']).fillna(0)
+    # file is read once per path (see load_confounds), each option selected from the cached frame
+    confound_df = load_confounds(confound_path)
 
     # Setting up dictionary from which to pull confound list
-    if regressor_type != 'opt4':
-        confound_dict = {
-            "opt1": ['cosine00', 'cosine01', 'cosine02', 'cosine03'],
-            "opt2": ['cosine00', 'cosine01', 'cosine02', 'cosine03',
-                     'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z',
-                     'trans_x_derivative1', 'trans_y_derivative1', 'trans_z_derivative1',
-                     'rot_x_derivative1', 'rot_y_derivative1', 'rot_z_derivative1'],
-            "opt3": ['cosine00', 'cosine01', 'cosine02', 'cosine03',
-                     'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z',
-                     'trans_x_derivative1', 'trans_y_derivative1', 'trans_z_derivative1',
-                     'rot_x_derivative1', 'rot_y_derivative1', 'rot_z_derivative1',
-                     "a_comp_cor_00", "a_comp_cor_01", "a_comp_cor_02", "a_comp_cor_03", "a_comp_cor_04",
-                     "a_comp_cor_05", "a_comp_cor_06", "a_comp_cor_07"]
-        }
-
-    else:
-        confound_dict = {
-            "opt1": ['cosine00', 'cosine01', 'cosine02', 'cosine03'],
-            "opt2": ['cosine00', 'cosine01', 'cosine02', 'cosine03',
-                     'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z',
-                     'trans_x_derivative1', 'trans_y_derivative1', 'trans_z_derivative1',
-                     'rot_x_derivative1', 'rot_y_derivative1', 'rot_z_derivative1'],
-            "opt3": ['cosine00', 'cosine01', 'cosine02', 'cosine03',
-                     'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z',
-                     'trans_x_derivative1', 'trans_y_derivative1', 'trans_z_derivative1',
-                     'rot_x_derivative1', 'rot_y_derivative1', 'rot_z_derivative1',
-                     "a_comp_cor_00", "a_comp_cor_01", "a_comp_cor_02", "a_comp_cor_03", "a_comp_cor_04",
-                     "a_comp_cor_05", "a_comp_cor_06", "a_comp_cor_07"]
-        }
-
+    confound_dict = {opt: list(cols) for opt, cols in confound_opts.items()}
+    if regressor_type == 'opt4':
         motion_outlier_columns = confound_df.filter(regex='motion_outlier')
         # append the motion outlier columns to in dict to opt3  as opt5
         confound_dict['opt4'] = confound_dict['opt3'] + list(motion_outlier_columns.columns)
@@ -158,15 +202,58 @@ def create_design_mid(events_df: pd.DataFrame, bold_tr: float, num_volumes: int,
                                   'onset': onsets,
                                   'duration': duration})
 
+    # convolved task regressors are cached, so the design for each motion option only adds the confounds
+    task_regressors = convolved_task_regressors(design_events=tuple(design_events.itertuples(index=False, name=None)),
+                                                bold_tr=bold_tr, num_volumes=num_volumes,
+                                                hrf_model=hrf_model, stc=stc)
+    # [task regressors, confounds, constant], as make_first_level_design_matrix(add_regs=..., drift_model=None)
+    matrix = [task_regressors.to_numpy()]
+    names = list(task_regressors.columns)
+    if conf_regressors is not None:
+        if conf_regressors.shape[0] != num_volumes:
+            raise ValueError(f"Incorrect specification of additional regressors: length of regressors "
+                             f"[{conf_regressors.shape[0]}] provided differs from num_volumes [{num_volumes}]")
+        matrix.append(np.asarray(conf_regressors))
+        names += list(conf_regressors.columns)
+    matrix.append(np.ones((num_volumes, 1)))
+    names.append('constant')
+    if len(np.unique(names)) != len(names):
+        raise ValueError("Design matrix columns do not have unique names")
+    matrix, _ = full_rank(np.hstack(matrix))
+
+    design_matrix_mid = pd.DataFrame(matrix, columns=names, index=task_regressors.index)
+
+    return design_matrix_mid
+
+
+@lru_cache(maxsize=16)
+def convolved_task_regressors(design_events: tuple, bold_tr: float, num_volumes: int,
+                              hrf_model: str = 'glover', stc: bool = False) -> pd.DataFrame:
+    """
+    HRF convolved task regressors for a set of events, without confounds or the constant.
+    These only depend on the events (and model type, which sets the onsets/durations), TR, num_volumes,
+    hrf model and stc, so they're cached and shared across the fwhm and motion permutations.
+    Do not modify the returned frame in place.
+
+    :param design_events: tuple of (trial_type, onset, duration) rows
+    :param bold_tr: TR for the BOLD volume,
+    :param num_volumes: volumes in the BOLD
+    :param hrf_model: select hrf model for design matrix, default glover
+    :param stc: whether slice time correction was done. To adjust the onsets/frame times in design matrix.
+            Default False, alt True
+    :return: pandas dataframe of the convolved task regressors, index frame times
+    """
+    events = pd.DataFrame(list(design_events), columns=['trial_type', 'onset', 'duration'])
+
     # Using the BOLD tr and volumes to generate the frame_times: acquisition time in seconds
     frame_times = np.arange(num_volumes) * bold_tr
 
-    design_matrix_mid = make_first_level_design_matrix(
+    design_matrix_task = make_first_level_design_matrix(
         # default modulation == '1'. Offset the times due to slice time correction, see blog post:
         # https://reproducibility.stanford.edu/slice-timing-correction-in-fmriprep-and-linear-modeling /
         frame_times=frame_times+(bold_tr/2) if stc else frame_times,
-        events=design_events,
-        hrf_model=hrf_model, drift_model=None, add_regs=conf_regressors
+        events=events,
+        hrf_model=hrf_model, drift_model=None
         )
 
-    return design_matrix_mid
+    return design_matrix_task.drop(columns='constant')
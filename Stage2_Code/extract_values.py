@@ -1,57 +1,71 @@
 import pandas as pd
+import numpy as np
 import json
 import sys
 import os
 
-# specify arguments
-input_dir=sys.argv[1]
-subject = sys.argv[2]
-ses = sys.argv[3]
-task = sys.argv[4]
-
-deriv_path = f'{input_dir}/{subject}/ses-{ses}/func'
-# read in list of IDs/ses to summarize
-if os.path.exists(f'{deriv_path}/task-{task}_summ-mot-acc-rt.csv'):
-    existing_df = pd.read_csv(f'{deriv_path}/task-{task}_summ-mot-acc-rt.csv')
-else:
-    # Create an empty DataFrame with the desired columns if the file doesn't exist
-    existing_df = pd.DataFrame(columns=['Subject', 'Session', 'mFD_run1', 'mFD_run2', 'acc_run1', 'acc_run2', 'mrt_run1', 'mrt_run2'])
-
-# Loop through subjects and sessions
-
-# assign dirs to pull from
-file_path_run1 = f'{deriv_path}/{subject}_ses-{ses}_task-{task}_run-01_desc-confounds_timeseries.tsv'
-file_path_run2 = f'{deriv_path}/{subject}_ses-{ses}_task-{task}_run-02_desc-confounds_timeseries.tsv'
-
-# Read the TSV files into pandas DataFrames
-df_run1 = pd.read_csv(file_path_run1, delimiter='\t')
-df_run2 = pd.read_csv(file_path_run2, delimiter='\t')
-
-# Calculate the mean framewise displacement for run-01/run-02
-mean_fd_run1 = df_run1['framewise_displacement'].mean()
-mean_fd_run2 = df_run2['framewise_displacement'].mean()
-
-# get json info
-j_file = f'{deriv_path}/{subject}_ses-{ses}_task-{task}_beh-descr.json'
-with open(j_file, 'r') as file:
-    data = json.load(file)
-run1_accuracy = data['Run 1']['Overall Accuracy']
-run1_mean_rt = data['Run 1']['Mean RT']
-run2_accuracy = data['Run 2']['Overall Accuracy']
-run2_mean_rt = data['Run 2']['Mean RT']
-
-
-# Append the results to the DataFrame
-result_df = pd.DataFrame({
-    'Subject': [subject],
-    'Session': [ses],
-    'mFD_run1': [mean_fd_run1],
-    'mFD_run2': [mean_fd_run2],
-    'acc_run1': [run1_accuracy],
-    'acc_run2': [run2_accuracy],
-    'mrt_run1': [run1_mean_rt],
-    'mrt_run2': [run2_mean_rt]
-    })
-
-existing_df = pd.concat([existing_df, result_df], ignore_index=True)
-existing_df.to_csv(f'{deriv_path}/task-{task}_summ-mot-acc-rt.csv',index = False)
+SUMMARY_COLS = ['Subject', 'Session', 'mFD_run1', 'mFD_run2', 'acc_run1', 'acc_run2', 'mrt_run1', 'mrt_run2']
+
+
+def mot_beh_summary(deriv_path: str, subject: str, ses: str, task: str, missing_ok: bool = False) -> dict:
+    """
+    Mean framewise displacement of run-01/run-02 from the fmriprep confounds (only the framewise_displacement
+    column is parsed) and the accuracy + mean RT of each run from the beh-descr.json
+
+    :param deriv_path: path to the subject's func folder with the confounds and beh-descr.json files
+    :param subject: subject label, including 'sub-' prefix
+    :param ses: session label without 'ses-' prefix
+    :param task: task label, e.g. mid
+    :param missing_ok: missing files give NaN values instead of an error, default False
+    :return: dict of the SUMMARY_COLS values
+    """
+    summary = {'Subject': subject, 'Session': ses}
+    for run in [1, 2]:
+        conf_path = f'{deriv_path}/{subject}_ses-{ses}_task-{task}_run-0{run}_desc-confounds_timeseries.tsv'
+        if missing_ok and not os.path.exists(conf_path):
+            summary[f'mFD_run{run}'] = np.nan
+            continue
+        conf_fd = pd.read_csv(conf_path, sep='\t', usecols=['framewise_displacement'])
+        summary[f'mFD_run{run}'] = conf_fd['framewise_displacement'].mean()
+
+    j_file = f'{deriv_path}/{subject}_ses-{ses}_task-{task}_beh-descr.json'
+    if missing_ok and not os.path.exists(j_file):
+        data = {}
+    else:
+        with open(j_file, 'r') as file:
+            data = json.load(file)
+    for run in [1, 2]:
+        run_data = data.get(f'Run {run}', {})
+        summary[f'acc_run{run}'] = run_data.get('Overall Accuracy', np.nan)
+        summary[f'mrt_run{run}'] = run_data.get('Mean RT', np.nan)
+    return summary
+
+
+def write_summary(summary_df: pd.DataFrame, out_path: str):
+    """
+    Writes the summary to a temporary file that is then renamed to out_path, so readers never see a partial file
+
+    :param summary_df: DataFrame of the summary
+    :param out_path: output file, .parquet (requires pyarrow), .tsv or .csv
+    :return: nothing returned, file is saved
+    """
+    tmp_path = f'{out_path}.tmp'
+    if out_path.endswith('.parquet'):
+        summary_df.to_parquet(tmp_path, index=False)
+    else:
+        summary_df.to_csv(tmp_path, sep='\t' if out_path.endswith('.tsv') else ',', index=False)
+    os.replace(tmp_path, out_path)
+
+
+if __name__ == "__main__":
+    # specify arguments
+    input_dir = sys.argv[1]
+    subject = sys.argv[2]
+    ses = sys.argv[3]
+    task = sys.argv[4]
+
+    deriv_path = f'{input_dir}/{subject}/ses-{ses}/func'
+    # one row summary of the subject, the cohort summary is built with summarize_mot_beh.py
+    result_df = pd.DataFrame([mot_beh_summary(deriv_path=deriv_path, subject=subject, ses=ses, task=task)],
+                             columns=SUMMARY_COLS)
+    write_summary(result_df, f'{deriv_path}/task-{task}_summ-mot-acc-rt.csv')
@@ -0,0 +1,60 @@
+import numpy as np
+import nibabel as nib
+
+
+def run_maps_mask(var_paths: list) -> np.ndarray:
+    """
+    Recovers the first level mask from run-level variance maps: the GLM variance is > 0 for every voxel in the
+    first level mask and 0 outside of it. The union over the runs is used.
+
+    :param var_paths: list of paths to the variance maps of the same model permutation, one per run
+    :return: 3D boolean array
+    """
+    mask = None
+    for path in var_paths:
+        var_dat = np.asanyarray(nib.load(path).dataobj)
+        var_mask = var_dat.reshape(var_dat.shape[:3]) != 0
+        mask = var_mask if mask is None else mask | var_mask
+    return mask
+
+
+def load_run_maps(map_paths: list, mask: np.ndarray, dtype=np.float64) -> np.ndarray:
+    """
+    Loads run-level maps in one pass into a run x map x voxel array of the in-mask voxels.
+
+    :param map_paths: list (runs) of lists (maps) of .nii.gz paths, each run lists the maps in the same order
+    :param mask: 3D boolean array, voxels to keep
+    :param dtype: dtype of the returned array, default np.float64
+    :return: 3D numpy array, run x map x voxel
+    """
+    n_runs, n_maps = len(map_paths), len(map_paths[0])
+    run_maps = np.empty((n_runs, n_maps, int(mask.sum())), dtype=dtype)
+    for run_i, run_paths in enumerate(map_paths):
+        if len(run_paths) != n_maps:
+            raise ValueError(f"Run {run_i} has {len(run_paths)} maps, expected {n_maps}")
+        for map_i, path in enumerate(run_paths):
+            map_dat = np.asanyarray(nib.load(path).dataobj)
+            run_maps[run_i, map_i] = map_dat.reshape(map_dat.shape[:3])[mask]
+    return run_maps
+
+
+def fixed_effects_batch(betas: np.ndarray, variances: np.ndarray) -> tuple:
+    """
+    Precision weighted fixed effects across runs for all maps at once, as nilearn's
+    compute_fixed_effects(precision_weighted=True): weights are 1/variance (variance floored at 1e-16),
+    the fixed effect variance is 1/sum(weights), the effect is sum(beta * weights) * variance and t is
+    effect / sqrt(variance).
+
+    :param betas: run x map x voxel array of the run-level effect sizes (e.g. contrast x permutation maps)
+    :param variances: run x map x voxel array of the run-level effect variances
+    :return: tuple of the effect, variance and t arrays, map x voxel
+    """
+    if betas.shape != variances.shape:
+        raise ValueError(f"betas {betas.shape} and variances {variances.shape} shapes differ")
+    weights = np.maximum(variances, 1e-16)
+    np.reciprocal(weights, out=weights)
+    fix_var = np.reciprocal(weights.sum(axis=0))
+    weights *= betas
+    fix_effect = weights.sum(axis=0) * fix_var
+    fix_tstat = fix_effect / np.sqrt(fix_var)
+    return fix_effect, fix_var, fix_tstat
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+from nilearn.glm.first_level.first_level import mean_scaling
+
+
+def contrast_vectors(design_matrix: pd.DataFrame, contrast_weights: dict) -> np.ndarray:
+    """
+    Creates the contrast matrix (contrast x regressor) for a design matrix from a dict of contrast weights,
+    where regressors not listed in the weights are set to 0.
+
+    :param design_matrix: pandas dataframe design matrix, e.g. from create_design_mid()
+    :param contrast_weights: dict of contrast name: {regressor: weight}, e.g. {'Lgain-Base': {'LargeGain': 1}}
+    :return: numpy array contrast x regressor, in order of contrast_weights
+    """
+    con_matrix = pd.DataFrame([con for con in contrast_weights.values()],
+                              columns=design_matrix.columns, index=list(contrast_weights.keys()))
+    return con_matrix.fillna(0).to_numpy(dtype=np.float64)
+
+
+def _mean_scaling(Y: np.ndarray) -> np.ndarray:
+    # percent signal change with nilearn's own mean_scaling, as FirstLevelModel does with signal_scaling=0
+    return mean_scaling(Y, axis=0)[0]
+
+
+def _ar1_whiten(X: np.ndarray, rho: float) -> np.ndarray:
+    # AR(1) prewhitening along time (rows), first sample kept as-is
+    wX = np.array(X, dtype=X.dtype)
+    wX[1:] -= rho * X[:-1]
+    return wX
+
+
+def _ar1_labels(resid: np.ndarray, resid_mean: float, bins: int) -> np.ndarray:
+    # yule-walker AR(1) estimate of each voxel (time x voxel residuals), binned as nilearn run_glm does.
+    # resid_mean is the mean of the residuals over all voxels, which nilearn removes before the estimate
+    n_time = resid.shape[0]
+    y = resid - resid_mean
+    r0 = np.einsum('tv,tv->v', y, y) / (n_time * n_time)
+    r1 = np.einsum('tv,tv->v', y[:-1], y[1:]) / ((n_time - 1) * n_time)
+    rho = r1 / r0
+    return (rho * bins).astype(int)
+
+
+def fit_batch_glm(Y: np.ndarray, design_matrices: list, contrast_weights: dict,
+                  noise_model: str = 'ar1', bins: int = 100, signal_scaling: bool = True,
+                  chunk_size: int = 20000, dtype=np.float64) -> dict:
+    """
+    Fits a set of design matrices that share the same data Y (e.g., the motion x model type permutations for
+    one run + fwhm) and returns the contrast effect size and variance for each design.
+    Estimates follow nilearn's FirstLevelModel(noise_model='ar1'|'ols', signal_scaling=0) + compute_contrast
+    (output_type='effect_size' | 'effect_variance'): OLS fit, AR(1) coefficient from OLS residuals binned
+    in 1/bins steps and the prewhitened refit per AR(1) bin. The OLS pass for all designs is one batched
+    pseudo-inverse and product with Y; the AR(1) refits reuse one whitened pseudo-inverse per (design, bin).
+    Voxels are processed in chunks of chunk_size to limit memory. With dtype=np.float32 the data, estimates and
+    outputs are float32, the (small) design pseudo-inverses are solved in float64 and cast to float32.
+
+    :param Y: 2D array time x voxel, the masked (and smoothed) BOLD data
+    :param design_matrices: list of pandas dataframe design matrices, same N of rows as Y. The N of
+        regressors can differ between designs
+    :param contrast_weights: dict of contrast name: {regressor: weight}, e.g. {'Lgain-Base': {'LargeGain': 1}}
+    :param noise_model: 'ar1' or 'ols', default ar1
+    :param bins: N of bins for AR(1) coefficients, default 100 (nilearn default)
+    :param signal_scaling: scale Y to percent signal change before fitting, default True
+    :param chunk_size: N of voxels per chunk
+    :param dtype: dtype of the data path and the outputs, np.float64 (default) or np.float32
+    :return: dict with 'effect' and 'variance' arrays, design x contrast x voxel
+    """
+    if noise_model not in ['ar1', 'ols']:
+        raise ValueError(f"noise_model options are ar1 or ols, {noise_model} provided")
+    n_time, n_vox = Y.shape
+    n_des = len(design_matrices)
+    n_con = len(contrast_weights)
+    for design in design_matrices:
+        if design.shape[0] != n_time:
+            raise ValueError(f"Design matrix rows [{design.shape[0]}] do not match Y time points [{n_time}]")
+
+    # pad designs to the same N of columns. Zero columns get zero pseudo-inverse rows, so estimates are unchanged
+    n_regs = np.array([design.shape[1] for design in design_matrices])
+    X = np.zeros((n_des, n_time, n_regs.max()))
+    C = np.zeros((n_des, n_con, n_regs.max()))
+    for i, design in enumerate(design_matrices):
+        X[i, :, :n_regs[i]] = design.to_numpy(dtype=np.float64)
+        C[i, :, :n_regs[i]] = contrast_vectors(design, contrast_weights)
+    df_resid = (n_time - n_regs).astype(np.float64)
+
+    pinv_X = np.linalg.pinv(X)  # design x regressor x time
+    # residual-forming rows for the grand mean of the OLS residuals: sum_t (I - X pinv(X)) Y
+    resid_sum_w = 1 - np.einsum('dtp,dps->ds', X, pinv_X)
+    X_d, pinv_d, C_d = X.astype(dtype), pinv_X.astype(dtype), C.astype(dtype)
+
+    if signal_scaling:
+        grand_mean = np.stack([resid_sum_w @ _mean_scaling(Y[:, v:v + chunk_size]).sum(axis=1)
+                               for v in range(0, n_vox, chunk_size)]).sum(axis=0) / (n_time * n_vox)
+    else:
+        grand_mean = resid_sum_w @ Y.sum(axis=1) / (n_time * n_vox)
+
+    effect = np.zeros((n_des, n_con, n_vox), dtype=dtype)
+    variance = np.zeros((n_des, n_con, n_vox), dtype=dtype)
+    ar1_fits = {}
+
+    for start in range(0, n_vox, chunk_size):
+        vox = slice(start, start + chunk_size)
+        y_chunk = (_mean_scaling(Y[:, vox]) if signal_scaling else Y[:, vox]).astype(dtype, copy=False)
+        betas = pinv_d @ y_chunk  # design x regressor x voxel
+        resid = y_chunk - X_d @ betas
+        if noise_model == 'ols':
+            dispersion = np.einsum('dtv,dtv->dv', resid, resid) / df_resid[:, None]
+            effect[:, :, vox] = C_d @ betas
+            cov_con = np.einsum('dcp,dpt->dct', C, pinv_X)
+            variance[:, :, vox] = np.einsum('dct,dct->dc', cov_con, cov_con)[:, :, None] * dispersion[:, None, :]
+            continue
+
+        for d in range(n_des):
+            labels = _ar1_labels(resid[d], grand_mean[d], bins)
+            for label in np.unique(labels):
+                if (d, label) not in ar1_fits:
+                    rho = label * 1.0 / bins
+                    w_design = _ar1_whiten(X[d, :, :n_regs[d]], rho)
+                    w_pinv = np.linalg.pinv(w_design)
+                    con_proj = C[d, :, :n_regs[d]] @ w_pinv
+                    ar1_fits[(d, label)] = (rho, w_design.astype(dtype), w_pinv.astype(dtype),
+                                            np.einsum('ct,ct->c', con_proj, con_proj).astype(dtype))
+                rho, w_design, w_pinv, con_cov = ar1_fits[(d, label)]
+                sel = np.flatnonzero(labels == label)
+                w_y = _ar1_whiten(y_chunk[:, sel], rho)
+                w_beta = w_pinv @ w_y
+                w_resid = w_y - w_design @ w_beta
+                dispersion = np.einsum('tv,tv->v', w_resid, w_resid) / df_resid[d]
+                effect[d][:, start + sel] = C_d[d, :, :n_regs[d]] @ w_beta
+                variance[d][:, start + sel] = con_cov[:, None] * dispersion[None, :]
+
+    return {'effect': effect, 'variance': variance}
+
+
+def compare_precision(Y: np.ndarray, design_matrices: list, contrast_weights: dict, dtype=np.float32,
+                      **glm_kwargs) -> dict:
+    """
+    Numeric equivalence check of the reduced precision path: fits the designs with fit_batch_glm() in float64
+    and in dtype, and returns the max relative difference of the effect and variance maps. Differences are
+    relative to the max absolute float64 value of each design x contrast map.
+
+    :param Y: 2D array time x voxel, the masked (and smoothed) BOLD data
+    :param design_matrices: list of pandas dataframe design matrices, as in fit_batch_glm()
+    :param contrast_weights: dict of contrast name: {regressor: weight}
+    :param dtype: reduced precision dtype to check, default np.float32
+    :param glm_kwargs: other fit_batch_glm() arguments, e.g. noise_model
+    :return: dict of 'effect' and 'variance': max relative difference
+    """
+    ref_est = fit_batch_glm(Y=Y, design_matrices=design_matrices, contrast_weights=contrast_weights,
+                            dtype=np.float64, **glm_kwargs)
+    low_est = fit_batch_glm(Y=Y, design_matrices=design_matrices, contrast_weights=contrast_weights,
+                            dtype=dtype, **glm_kwargs)
+    max_diff = {}
+    for out in ['effect', 'variance']:
+        abs_diff = np.abs(low_est[out].astype(np.float64) - ref_est[out]).max(axis=-1)
+        max_diff[out] = float((abs_diff / np.maximum(np.abs(ref_est[out]).max(axis=-1), 1e-12)).max())
+    return max_diff
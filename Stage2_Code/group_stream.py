@@ -0,0 +1,239 @@
+import gzip
+import numpy as np
+import nibabel as nib
+from nilearn.maskers import NiftiMasker
+from nilearn.masking import compute_background_mask
+
+
+class StreamingOneSample:
+    """
+    Intercept-only (one-sample) OLS group model accumulated one subject map at a time with Welford updates, so
+    memory does not grow with the N of subjects. Estimates match nilearn's SecondLevelModel with an intercept
+    design: effect is the mean, variance is the residual variance / (N - 1) / N and t is effect / sqrt(variance).
+    If residual_path is given, the subject maps are spilled to a (subject x voxel) memmap there and turned into
+    residuals (map - mean) by residuals(). With residual_out and residual_mask, the maps are spilled into the
+    in-mask voxels of a 4D (x, y, z, subject) array instead, e.g. an uncompressed NIfTI from nifti_memmap().
+    """
+    def __init__(self, n_vox: int, n_maps: int = None, residual_path: str = None, dtype=np.float64,
+                 residual_out: np.ndarray = None, residual_mask: np.ndarray = None):
+        """
+        :param n_vox: N of voxels of each (masked) map
+        :param n_maps: N of maps that will be added, required when residual_path is given
+        :param residual_path: path of the memmap file for the residuals, default None (no residuals)
+        :param dtype: dtype of the residual memmap, default np.float64
+        :param residual_out: 4D (x, y, z, map) array to spill the maps to, instead of residual_path
+        :param residual_mask: 3D boolean array of the n_vox voxels in residual_out, required with residual_out
+        """
+        self.n = 0
+        self.mean = np.zeros(n_vox)
+        self.m2 = np.zeros(n_vox)
+        self._resid = None
+        self._resid_mask = None
+        if residual_out is not None:
+            if residual_mask is None or int(residual_mask.sum()) != n_vox:
+                raise ValueError(f"residual_mask with {n_vox} voxels is required with residual_out")
+            self._resid = residual_out
+            self._resid_mask = residual_mask
+        elif residual_path is not None:
+            if n_maps is None:
+                raise ValueError("n_maps is required to spill residuals to a memmap")
+            self._resid = np.memmap(residual_path, dtype=dtype, mode='w+', shape=(n_maps, n_vox))
+
+    def update(self, y: np.ndarray):
+        """
+        Adds one subject map
+
+        :param y: 1D array of voxels
+        """
+        y = np.asarray(y, dtype=np.float64)
+        if self._resid_mask is not None:
+            self._resid[..., self.n][self._resid_mask] = y
+        elif self._resid is not None:
+            self._resid[self.n] = y
+        self.n += 1
+        delta = y - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (y - self.mean)
+
+    def estimates(self) -> dict:
+        """
+        :return: dict of 'effect', 'variance' and 'tstat' 1D arrays
+        """
+        if self.n < 2:
+            raise ValueError(f"A one-sample model requires at least two maps, {self.n} added")
+        variance = self.m2 / (self.n - 1) / self.n
+        # variance floor as in nilearn's Contrast, voxels without variance (e.g. all 0) get t = 0
+        tstat = self.mean / np.sqrt(np.maximum(variance, 1e-50))
+        return {'effect': self.mean.copy(), 'variance': variance, 'tstat': tstat}
+
+    def residuals(self, chunk_maps: int = 64) -> np.memmap:
+        """
+        Subtracts the group mean from the spilled maps in place, chunks of maps at a time
+
+        :param chunk_maps: N of maps per chunk
+        :return: (subject x voxel) memmap of the residuals, or the 4D (x, y, z, subject) residual_out
+        """
+        if self._resid is None:
+            raise ValueError("residuals were not spilled, set residual_path")
+        if self._resid_mask is not None:
+            for start in range(0, self.n, chunk_maps):
+                resid_chunk = self._resid[..., start:start + chunk_maps]
+                resid_chunk[self._resid_mask] -= self.mean.astype(self._resid.dtype)[:, np.newaxis]
+            if isinstance(self._resid, np.memmap):
+                self._resid.flush()
+            return self._resid[..., :self.n]
+        for start in range(0, self.n, chunk_maps):
+            self._resid[start:start + chunk_maps] -= self.mean.astype(self._resid.dtype)
+        self._resid.flush()
+        return self._resid[:self.n]
+
+
+def _nifti_header(shape: tuple, affine: np.ndarray, dtype) -> nib.Nifti1Header:
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+    hdr.set_qform(affine, code=1)
+    hdr.set_sform(affine, code=1)
+    hdr.set_xyzt_units('mm')
+    hdr.set_data_offset(352)
+    return hdr
+
+
+def write_maps_nifti(out_path: str, maps: np.ndarray, mask: np.ndarray, affine: np.ndarray, dtype=np.float64,
+                     cols: np.ndarray = None):
+    """
+    Writes a (map x voxel) array, e.g. a residual memmap, as a 4D NIfTI one volume at a time, so the 4D volume
+    is never built in memory.
+
+    :param out_path: path to .nii or .nii.gz
+    :param maps: 2D array map x in-mask voxel
+    :param mask: 3D boolean array
+    :param affine: 4x4 affine
+    :param dtype: dtype of the saved data
+    :param cols: boolean array to select the in-mask voxels from the columns of maps, default None (all columns)
+    :return: nothing returned, file is saved
+    """
+    hdr = _nifti_header(mask.shape + (maps.shape[0],), affine, dtype)
+    opener = gzip.open if out_path.endswith('.gz') else open
+    with opener(out_path, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\x00' * (352 - f.tell()))
+        vol = np.zeros(mask.shape, dtype=dtype)
+        for map_dat in maps:
+            vol[mask] = map_dat if cols is None else map_dat[cols]
+            f.write(vol.tobytes(order='F'))
+
+
+def nifti_memmap(out_path: str, shape: tuple, affine: np.ndarray, dtype=np.float64) -> np.memmap:
+    """
+    Creates an uncompressed 4D .nii filled with 0 and returns its data as a writable (x, y, z, map) memmap, so
+    maps can be written to the file as they are computed. The file is a regular NIfTI (nib.load() memory maps it)
+    and can be opened with load_nifti_memmap().
+
+    :param out_path: path to .nii
+    :param shape: 4D shape, (x, y, z, N of maps)
+    :param affine: 4x4 affine
+    :param dtype: dtype of the saved data
+    :return: np.memmap (x, y, z, map), Fortran ordered as the NIfTI data
+    """
+    if out_path.endswith('.gz'):
+        raise ValueError(f"{out_path} can't be memory mapped, use an uncompressed .nii")
+    hdr = _nifti_header(tuple(shape), affine, dtype)
+    n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(out_path, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\x00' * (352 - f.tell()))
+        f.truncate(352 + n_bytes)
+    return np.memmap(out_path, dtype=hdr.get_data_dtype(), mode='r+', offset=352, shape=tuple(shape), order='F')
+
+
+def load_nifti_memmap(nii_path: str, mode: str = 'r') -> np.memmap:
+    """
+    Opens the data of an uncompressed .nii (e.g. _stat-residuals.nii group outputs) as a np.memmap, without
+    reading or decompressing it. Scaled data (scl_slope) is returned unscaled.
+
+    :param nii_path: path to .nii
+    :param mode: np.memmap mode, 'r' (default) or 'r+'
+    :return: np.memmap with the NIfTI shape, e.g. (x, y, z, map)
+    """
+    with open(nii_path, 'rb') as f:
+        hdr = nib.Nifti1Header.from_fileobj(f)
+    return np.memmap(nii_path, dtype=hdr.get_data_dtype(), mode=mode, offset=int(hdr.get_data_offset()),
+                     shape=hdr.get_data_shape(), order='F')
+
+
+def onesample_stream(map_paths: list, mask=None, residual_path: str = None, dtype=np.float64) -> dict:
+    """
+    Streams the subject maps through StreamingOneSample. With mask=None the mask is computed from the mean map,
+    as SecondLevelModel does, so the maps are accumulated on the full volume.
+
+    :param map_paths: list of paths to subject maps (3D)
+    :param mask: path to mask or Nifti1Image, default None
+    :param residual_path: path of the memmap file for the residuals, default None (no residuals). A .nii path
+        writes the residuals straight to an uncompressed 4D NIfTI memmap as the maps are read (see nifti_memmap())
+    :param dtype: dtype of the residuals, default np.float64
+    :return: dict of 'effect', 'variance', 'tstat' (1D in-mask arrays), 'residuals' (memmap, 4D for .nii, or None),
+        'residual_cols' (columns of residuals in the mask, None if all), 'mask' (3D boolean array) and 'affine'
+    """
+    return onesample_stream_many(key_paths={'maps': map_paths}, mask=mask,
+                                 residual_paths={'maps': residual_path}, dtype=dtype)['maps']
+
+
+def onesample_stream_many(key_paths: dict, mask=None, residual_paths: dict = None, dtype=np.float64) -> dict:
+    """
+    Streams the subject maps of several one-sample models at once (e.g. every model permutation x contrast),
+    one StreamingOneSample per key. Maps are read subject by subject: the i-th map of every key, then the i+1-th,
+    so each file is read once and a subject's files are read together. See onesample_stream() for the outputs.
+
+    :param key_paths: dict of key: list of paths to subject maps (3D), all maps on the same grid
+    :param mask: path to mask or Nifti1Image, default None (background mask of the mean map of each key)
+    :param residual_paths: dict of key: path of the memmap file (or .nii) for the residuals, default None (no residuals)
+    :param dtype: dtype of the residuals, default np.float64
+    :return: dict of key: dict of estimates, as returned by onesample_stream()
+    """
+    residual_paths = residual_paths or {}
+    ref_img = nib.load(next(iter(key_paths.values()))[0])
+    shape, affine = ref_img.shape[:3], ref_img.affine
+    if mask is not None:
+        vox_mask = np.asarray(NiftiMasker(mask_img=mask).fit().mask_img_.dataobj).astype(bool)
+    else:
+        vox_mask = np.ones(shape, dtype=bool)
+
+    models = {}
+    for key, paths in key_paths.items():
+        resid_path = residual_paths.get(key)
+        if resid_path is not None and resid_path.endswith('.nii'):
+            resid_nii = nifti_memmap(out_path=resid_path, shape=shape + (len(paths),), affine=affine, dtype=dtype)
+            models[key] = StreamingOneSample(n_vox=int(vox_mask.sum()), dtype=dtype, residual_out=resid_nii,
+                                             residual_mask=vox_mask)
+        else:
+            models[key] = StreamingOneSample(n_vox=int(vox_mask.sum()), n_maps=len(paths), residual_path=resid_path,
+                                             dtype=dtype)
+    for map_i in range(max(len(paths) for paths in key_paths.values())):
+        for key, paths in key_paths.items():
+            if map_i < len(paths):
+                map_dat = np.asanyarray(nib.load(paths[map_i]).dataobj)
+                models[key].update(map_dat.reshape(shape)[vox_mask])
+
+    key_estimates = {}
+    for key, model in models.items():
+        estimates = model.estimates()
+        residuals = model.residuals() if residual_paths.get(key) is not None else None
+        residual_cols, key_mask = None, vox_mask
+        if mask is None:
+            # background mask of the mean map, then the full volume estimates are reduced to it
+            mean_vol = estimates['effect'].reshape(shape)
+            key_mask = np.asarray(compute_background_mask(nib.Nifti1Image(mean_vol, affine)).dataobj).astype(bool)
+            in_mask = key_mask.ravel()
+            estimates = {est_name: est[in_mask] for est_name, est in estimates.items()}
+            # residuals stay on the full volume memmap, in-mask columns are selected when written
+            residual_cols = in_mask
+            if residuals is not None and residuals.ndim == 4:
+                # written in place, voxels outside the mask are set to 0 as in nilearn's residuals
+                for map_i in range(residuals.shape[3]):
+                    residuals[..., map_i][~key_mask] = 0
+                residuals.flush()
+        estimates.update({'residuals': residuals, 'residual_cols': residual_cols, 'mask': key_mask,
+                          'affine': affine})
+        key_estimates[key] = estimates
+    return key_estimates
@@ -1,24 +1,35 @@
+import sys
 import os
 import warnings
 import argparse
+from functools import partial
 import pandas as pd
 import numpy as np
-from glob import glob
+import nibabel as nib
 from nilearn.image import new_img_like
 from nilearn.glm.second_level import SecondLevelModel
 warnings.filterwarnings("ignore")
 
+# Getpath to Stage2 scripts
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_dir)
+from Stage2_Code.resume_manifest import OutputManifest
+from Stage2_Code.bids_index import FileIndex
+from Stage2_Code.bold_cache import img_as_dtype, unmask_bold
+from Stage2_Code.group_stream import onesample_stream, onesample_stream_many, write_maps_nifti
 
-def nifti_tstat_to_cohensd(tstat_img, n):
+
+def nifti_tstat_to_cohensd(tstat_img, n, dtype=np.float64):
     """
     function converts NIfTI t-statistic image to Cohen's d.
 
     :param tstat_img: NIfTI image containing t-statistics, Nifti1Image.
     :param n: Sample size for calculating Cohen's d, Integer
+    :param dtype: float dtype of the Cohen's d data, np.float64 (default) or np.float32
     :return: NIfTI image containing Cohen's d.
     """
     # Get data array from the t-statistics image
-    t_data = tstat_img.get_fdata()
+    t_data = tstat_img.get_fdata(dtype=dtype)
     # Calculate Cohen's d using the t_stat / sqrt(n) formula
     d_data = t_data / np.sqrt(n)
     # Create a NIfTI image containing Cohen's d, with the same properties as the input image
@@ -29,7 +40,7 @@ def nifti_tstat_to_cohensd(tstat_img, n):
 
 def group_onesample(fixedeffect_paths: list, session: str, task_type: str,
                     contrast_type: str, group_outdir: str,
-                    model_permutation: str, level: str, mask: str = None):
+                    model_permutation: str, level: str, mask: str = None, dtype=np.float64):
     """
     This function takes in a list of fixed effect files for a select contrast and
     calculates a group (secondlevel) model by fitting an intercept to length of maps.
@@ -43,7 +54,8 @@ def group_onesample(fixedeffect_paths: list, session: str, task_type: str,
     :param level: run or group level map? e.g. run-01, run-02, ses-1 or ses-baselinearm1
     :param group_outdir: path to folder to save the group level models
     :param mask: path to mask, default none
-    :return: nothing return, files are saved
+    :param dtype: float dtype of the saved maps, np.float64 (default) or np.float32
+    :return: list of saved paths, residuals and cohen's d maps
     """
 
     if not os.path.exists(group_outdir):
@@ -70,17 +82,114 @@ def group_onesample(fixedeffect_paths: list, session: str, task_type: str,
 
     # calculate residuals for group map
     residuals_grp = sec_lvl_model.residuals
+    if dtype != np.float64:
+        residuals_grp = img_as_dtype(residuals_grp, dtype)
     residual_out = f'{group_outdir}/subs-{N_maps}_ses-{session}_task-{task_type}_type-{level}_' \
                    f'contrast-{contrast_type}_{model_permutation}_stat-residuals.nii.gz'
     residuals_grp.to_filename(residual_out)
 
     # calc cohens d
-    cohensd_map = nifti_tstat_to_cohensd(tstat_map, N_maps)
+    cohensd_map = nifti_tstat_to_cohensd(tstat_map, N_maps, dtype=dtype)
     # group out file, naming subs-N
     cohensd_out = f'{group_outdir}/subs-{N_maps}_ses-{session}_task-{task_type}_type-{level}_contrast-{contrast_type}' \
                   f'_{model_permutation}_stat-cohensd.nii.gz'
     cohensd_map.to_filename(cohensd_out)
 
+    return [residual_out, cohensd_out]
+
+
+def group_onesample_stream(fixedeffect_paths: list, session: str, task_type: str,
+                           contrast_type: str, group_outdir: str,
+                           model_permutation: str, level: str, mask: str = None, dtype=np.float64,
+                           save_residuals: bool = True, residual_format: str = 'nii.gz'):
+    """
+    Same model and outputs as group_onesample(), fit with the streaming one-sample engine (group_stream.py):
+    subject maps are read one at a time into running sums, memory doesn't grow with the N of maps.
+    Residuals are spilled to a memmap in group_outdir and written to the 4D .nii.gz one volume at a time.
+
+    :param fixedeffect_paths: a list of paths to the fixed effect models to be used
+    :param session: string session label, BIDS label e.g., ses-1
+    :param task_type: string task label, BIDS label e.g., mid
+    :param contrast_type: contrast type saved from fixed effect models
+    :param model_permutation: complete string of model permutation, e.g., 'fwhm-4_mot-opt1_mod-AntMod'
+    :param level: run or group level map? e.g. run-01, run-02, ses-1 or ses-baselinearm1
+    :param group_outdir: path to folder to save the group level models
+    :param mask: path to mask, default none
+    :param dtype: float dtype of the saved maps, np.float64 (default) or np.float32
+    :param save_residuals: save the residuals 4D image, default True
+    :param residual_format: 'nii.gz' (default) or 'nii', residuals written to an uncompressed .nii memmap as
+        the subject maps are read, which can be opened with group_stream.load_nifti_memmap()
+    :return: list of saved paths, residuals (if saved) and cohen's d maps
+    """
+    os.makedirs(group_outdir, exist_ok=True)
+    N_maps = len(fixedeffect_paths)
+    out_base = f'{group_outdir}/subs-{N_maps}_ses-{session}_task-{task_type}_type-{level}_' \
+               f'contrast-{contrast_type}_{model_permutation}'
+
+    resid_memmap = None
+    if save_residuals:
+        resid_memmap = f'{out_base}_stat-residuals.{"nii" if residual_format == "nii" else "dat"}'
+    group_est = onesample_stream(map_paths=fixedeffect_paths, mask=mask, residual_path=resid_memmap, dtype=dtype)
+    return save_stream_estimates(group_est=group_est, out_base=out_base, n_maps=N_maps, dtype=dtype)
+
+
+def save_stream_estimates(group_est: dict, out_base: str, n_maps: int, dtype=np.float64):
+    """
+    Saves the residuals (if spilled, the memmap is removed after) and cohen's d maps of a streamed one-sample model
+
+    :param group_est: dict of estimates returned by onesample_stream()
+    :param out_base: output path without the _stat-{stat}.nii.gz suffix
+    :param n_maps: N of subject maps in the model
+    :param dtype: float dtype of the saved maps, np.float64 (default) or np.float32
+    :return: list of saved paths, residuals (if saved) and cohen's d maps
+    """
+    saved = []
+    mask_img = nib.Nifti1Image(group_est['mask'].astype(np.uint8), group_est['affine'])
+    if group_est['residuals'] is not None and group_est['residuals'].ndim == 4:
+        # residuals were written in place to the uncompressed .nii
+        group_est['residuals'].flush()
+        del group_est['residuals']
+        saved.append(f'{out_base}_stat-residuals.nii')
+    elif group_est['residuals'] is not None:
+        residual_out = f'{out_base}_stat-residuals.nii.gz'
+        write_maps_nifti(out_path=residual_out, maps=group_est['residuals'], mask=group_est['mask'],
+                         affine=group_est['affine'], dtype=dtype, cols=group_est['residual_cols'])
+        resid_memmap = group_est['residuals'].filename
+        del group_est['residuals']
+        os.remove(resid_memmap)
+        saved.append(residual_out)
+
+    # calc cohens d from t-stat map
+    tstat_map = unmask_bold(group_est['tstat'], mask_img)
+    cohensd_map = nifti_tstat_to_cohensd(tstat_map, n_maps, dtype=dtype)
+    cohensd_out = f'{out_base}_stat-cohensd.nii.gz'
+    cohensd_map.to_filename(cohensd_out)
+    saved.append(cohensd_out)
+
+    return saved
+
+
+def index_group_maps(file_index: FileIndex, session: str, task_type: str, level_type: str, run: str = None) -> dict:
+    """
+    Groups the subject maps directly in the indexed input folder by (model permutation, contrast): run-0{run}
+    _stat-beta maps for run groups, _stat-effect maps for session groups.
+
+    :param file_index: FileIndex of the folder of the subject level maps
+    :param session: session label without 'ses-'
+    :param task_type: task label, e.g., mid
+    :param level_type: type of group, run or session
+    :param run: run label for run groups, e.g. 1
+    :return: dict of (model permutation, contrast): sorted list of map paths
+    """
+    if level_type == 'run':
+        map_rows = file_index.frame(directory=file_index.root, ses=session, task=task_type, run=f'0{run}', stat='beta')
+        map_rows = map_rows[map_rows['sub'].notna()]
+    else:
+        map_rows = file_index.frame(directory=file_index.root, ses=session, task=task_type, stat='effect')
+    map_rows = map_rows[map_rows['contrast'].notna() & (map_rows['perm'] != '')]
+    return {(perm, contrast): rows['path'].tolist()
+            for (perm, contrast), rows in map_rows.groupby(['perm', 'contrast'], sort=True)}
+
 
 parser = argparse.ArgumentParser(description="Script to run first level task models w/ nilearn")
 parser.add_argument("--sample", help="sample type, ahrb, abcd or mls?")
@@ -89,12 +198,32 @@ parser.add_argument("--run", help="Run lvl -- e.g., 1 or 2 (for 01 / 02)")
 parser.add_argument("--ses", help="session, include the session type without prefix 'ses', e.g., 1, 01, baselinearm1")
 parser.add_argument("--type", help="type of group -- run or session")
 parser.add_argument("--model", help="model permutation,"
-                                    " e.g. contrast-Sgain-Neut_mask-mni152_mot-opt5_mod-FixMod_fwhm-6.0")
+                                    " e.g. contrast-Sgain-Neut_mask-mni152_mot-opt5_mod-FixMod_fwhm-6.0. "
+                                    "A comma separated list of permutations, or all (every permutation in --input), "
+                                    "fits them in one job with the stream engine: the input folder is listed once "
+                                    "and each subject's maps are read once into per-(model, contrast) sums. "
+                                    "Use --mask to keep memory low, --model_batch models are held at once")
 parser.add_argument("--mask", help="path the to the binarized brain mask (e.g., MNI152 or "
                                    "constrained mask in MNI space, or None")
 parser.add_argument("--mask_label", help="label for mask, e.g. subtresh, suprathresh, yeo-network, or None")
 parser.add_argument("--input", help="input path to data")
 parser.add_argument("--output", help="output folder where to write out and save information")
+parser.add_argument("--file_index", help="path to the file index of --input (SQLite, updated on each run for the "
+                                         "folders that changed), default in $TMPDIR", default=None)
+parser.add_argument("--engine", help="group model engine: nilearn (SecondLevelModel) or stream (one-sample model "
+                                     "from running sums, memory independent of N)",
+                    choices=['nilearn', 'stream'], default='nilearn')
+parser.add_argument("--precision", help="float precision of the saved group maps, float64 (default) or float32",
+                    choices=['float64', 'float32'], default='float64')
+parser.add_argument("--residuals", help="stream engine residuals format: nii.gz (default) or nii, an uncompressed "
+                                        "4D NIfTI written as subjects are read, which opens as a np.memmap. "
+                                        "nii requires --engine stream (or several models)",
+                    choices=['nii.gz', 'nii'], default='nii.gz')
+parser.add_argument("--model_batch", help="with several models, N of model x contrast sets streamed at once, their "
+                                          "running sums and scratch residuals (N x voxel each) are held until "
+                                          "saved, default 16, 0 (all)", type=int, default=16)
+parser.add_argument("--resume", help="skip contrasts recorded as complete (size + sha256) for the same input maps "
+                                     "in the model's manifest, redo only missing or corrupt ones", action="store_true")
 
 args = parser.parse_args()
 
@@ -109,6 +238,15 @@ mask_label = args.mask_label
 model = args.model
 in_dir = args.input
 scratch_out = args.output
+precision = np.float32 if args.precision == 'float32' else np.float64
+if args.residuals == 'nii' and args.engine == 'nilearn' and not (model == 'all' or ',' in model):
+    parser.error("--residuals nii requires --engine stream, nilearn residuals are saved as .nii.gz")
+resid_ext = 'nii' if args.residuals == 'nii' else 'dat'
+group_model = partial(group_onesample_stream, residual_format=args.residuals) if args.engine == 'stream' \
+    else group_onesample
+manifest_base = f'{scratch_out}/ses-{ses}_task-{task}_type-{grptype}{run if grptype == "run" else ""}'
+manifest = OutputManifest(f'{manifest_base}_{model}_manifest.json') if args.resume else None
+file_index = FileIndex(root=in_dir, index_path=args.file_index)
 
 # contrasts
 contrasts = [
@@ -116,23 +254,69 @@ contrasts = [
     'Lgain-Base', 'Sgain-Base'
 ]
 
+if model == 'all' or ',' in model:
+    if grptype not in ['run', 'session']:
+        sys.exit("incorrect group type provided. Options run or session")
+    type_full = f'{grptype}0{run}' if grptype == 'run' else grptype
+    key_maps = index_group_maps(file_index=file_index, session=ses, task_type=task, level_type=grptype, run=run)
+    perm_list = None if model == 'all' else model.split(',')
+    key_maps = {(perm, contrast): paths for (perm, contrast), paths in key_maps.items()
+                if contrast in contrasts and (perm_list is None or perm in perm_list)}
+    print(f'	 Found {len(key_maps)} model x contrast maps sets, '
+          f'{len({perm for perm, _ in key_maps})} model permutations')
+
+    perm_manifests = {perm: OutputManifest(f'{manifest_base}_{perm}_manifest.json')
+                      for perm, _ in key_maps} if args.resume else {}
+    pending = {}
+    for (perm, contrast), paths in key_maps.items():
+        if args.resume and perm_manifests[perm].is_complete(f'contrast-{contrast}', inputs=paths):
+            print(f'		 {perm} {contrast} complete in manifest for {len(paths)} maps, skipping')
+            continue
+        if len(paths) < 2:
+            print(f'		 {perm} {contrast} has {len(paths)} maps, skipping')
+            continue
+        pending[(perm, contrast)] = paths
+    if not pending:
+        sys.exit(0)
+
+    os.makedirs(scratch_out, exist_ok=True)
+    out_bases = {(perm, contrast): f'{scratch_out}/subs-{len(paths)}_ses-{ses}_task-{task}_type-{type_full}_'
+                                   f'contrast-{contrast}_{perm}' for (perm, contrast), paths in pending.items()}
+    pending_keys = list(pending)
+    batch_n = args.model_batch if args.model_batch > 0 else len(pending_keys)
+    for batch_start in range(0, len(pending_keys), batch_n):
+        batch_keys = pending_keys[batch_start:batch_start + batch_n]
+        print(f'	 Streaming {len(batch_keys)} model x contrast sets')
+        group_ests = onesample_stream_many(key_paths={key: pending[key] for key in batch_keys}, mask=brainmask,
+                                           dtype=precision,
+                                           residual_paths={key: f'{out_bases[key]}_stat-residuals.{resid_ext}'
+                                                           for key in batch_keys})
+        for perm, contrast in batch_keys:
+            print(f'	 Saving {perm} contrast map: {contrast}')
+            # popped, so each scratch residual memmap is released once its 4D image is written
+            saved = save_stream_estimates(group_est=group_ests.pop((perm, contrast)),
+                                          out_base=out_bases[(perm, contrast)],
+                                          n_maps=len(pending[(perm, contrast)]), dtype=precision)
+            if args.resume:
+                perm_manifests[perm].record(f'contrast-{contrast}', saved, inputs=pending[(perm, contrast)])
+    sys.exit(0)
+
+if grptype in ['run', 'session']:
+    key_maps = index_group_maps(file_index=file_index, session=ses, task_type=task, level_type=grptype, run=run)
 for contrast in contrasts:
     print(f'\t Working on contrast map: {contrast}')
-    if 'run' == grptype:
-        type_full = f'{grptype}0{run}'
-        # find all contrast fixed effect maps for model permutation across subjects
-        list_maps = sorted(glob(f'{in_dir}/*_ses-{ses}_task-{task}'
-                                f'_run-0{run}_contrast-{contrast}_{model}_stat-beta.nii.gz'))
-        group_onesample(fixedeffect_paths=list_maps, session=ses, task_type=task,
-                        contrast_type=contrast, group_outdir=scratch_out,
-                        model_permutation=model, mask=brainmask, level=type_full)
+    if grptype not in ['run', 'session']:
+        print("incorrect group type provided. Options run or session")
+        continue
+    type_full = f'{grptype}0{run}' if grptype == 'run' else grptype
+    # contrast fixed effect maps for model permutation across subjects
+    list_maps = key_maps.get((model, contrast), [])
 
-    elif 'session' == grptype:
-        # find all contrast fixed effect maps for model permutation across subjects
-        list_maps = sorted(glob(f'{in_dir}/*_ses-{ses}_task-{task}_*'
-                                f'contrast-{contrast}_{model}_stat-effect.nii.gz'))
-        group_onesample(fixedeffect_paths=list_maps, session=ses, task_type=task,
+    if manifest is not None and manifest.is_complete(f'contrast-{contrast}', inputs=list_maps):
+        print(f'\t\t {contrast} complete in manifest for {len(list_maps)} maps, skipping')
+        continue
+    saved = group_model(fixedeffect_paths=list_maps, session=ses, task_type=task,
                         contrast_type=contrast, group_outdir=scratch_out,
-                        model_permutation=model, mask=brainmask, level=grptype)
-    else:
-        print("incorrect group type provided. Options run or session")
+                        model_permutation=model, mask=brainmask, level=type_full, dtype=precision)
+    if manifest is not None:
+        manifest.record(f'contrast-{contrast}', saved, inputs=list_maps)
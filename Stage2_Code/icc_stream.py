@@ -0,0 +1,294 @@
+import numpy as np
+import nibabel as nib
+from nilearn.maskers import NiftiMasker
+from nilearn.masking import compute_background_mask
+
+
+ICC_TYPES = ['icc_1', 'icc_2', 'icc_3']
+
+
+def icc_img_type(icc_type: str, est_name: str) -> str:
+    """
+    Output stat label of an ICC estimate: ICC(3,1) keeps the plain labels (est, btwnsub, wthnsub), the other
+    types are prefixed, e.g. icc1est, icc2btwnmeas
+
+    :param icc_type: icc_1, icc_2 or icc_3
+    :param est_name: est, btwnsub, wthnsub or btwnmeas
+    :return: stat label
+    """
+    return est_name if icc_type == 'icc_3' else f"{icc_type.replace('_', '')}{est_name}"
+
+
+class StreamingICC:
+    """
+    Voxelwise ICC(1), ICC(2,1) and ICC(3,1) accumulated one subject at a time, so memory does not grow with the
+    N of subjects.
+    Per voxel, the running means of each session and the co-moments between sessions are updated (Welford),
+    from which the sums of squares of pyrelimri's sumsq_icc() follow:
+    SS_C = n * sum_j (mean_j - grand mean)^2, SS_Btw = sum_jl C_jl / k and SS_Err = sum_j C_jj - SS_Btw,
+    with C_jl = sum_i (x_ij - mean_j) * (x_il - mean_l), n subjects and k sessions.
+    """
+    def __init__(self, n_vox: int, n_sessions: int = 2):
+        """
+        :param n_vox: N of voxels of each (masked) map
+        :param n_sessions: N of sessions (or runs) per subject
+        """
+        self.n = 0
+        self.k = n_sessions
+        self.mean = np.zeros((n_sessions, n_vox))
+        self.comoment = {(j, l): np.zeros(n_vox) for j in range(n_sessions) for l in range(j, n_sessions)}
+
+    def update(self, session_maps: list):
+        """
+        Adds one subject
+
+        :param session_maps: list of 1D arrays of voxels, one per session, in session order
+        """
+        if len(session_maps) != self.k:
+            raise ValueError(f"{len(session_maps)} session maps given, expected {self.k}")
+        y = np.asarray(session_maps, dtype=np.float64)
+        self.n += 1
+        delta = y - self.mean
+        self.mean += delta / self.n
+        for (j, l), c_jl in self.comoment.items():
+            c_jl += delta[j] * (y[l] - self.mean[l])
+
+    def sumsq(self) -> dict:
+        """
+        :return: dict of 'ss_btwn', 'ss_sess' and 'ss_err' (between-subject, session and error sums of squares)
+        """
+        return _sumsq(self.mean, self.comoment, self.n)
+
+    def estimates(self, icc_types: list = ('icc_3',)) -> dict:
+        """
+        ICCs and their variance components, as pyrelimri's sumsq_icc(): voxels without variance (e.g. all 0)
+        are nan. All types share the same sums of squares.
+
+        :param icc_types: list of icc_1, icc_2 and/or icc_3, default icc_3
+        :return: dict of stat label (see icc_img_type()): 1D array, e.g. 'est', 'btwnsub' and 'wthnsub' for icc_3
+        """
+        return _icc(self.sumsq(), self.n, self.k, icc_types)
+
+
+def _sumsq(mean: np.ndarray, comoment: dict, n: int) -> dict:
+    # sums of squares from the session means (session x voxel) and co-moments {(j, l): voxel}, see StreamingICC.
+    # n can be an array of (weighted) N per row, e.g. bootstrap resamples
+    if np.ndim(n) == 0 and n < 2:
+        raise ValueError(f"ICC requires at least two subjects, {n} added")
+    k = mean.shape[0]
+    grand_mean = mean.mean(axis=0)
+    ss_sess = n * ((mean - grand_mean) ** 2).sum(axis=0)
+    ss_diag = sum(comoment[(j, j)] for j in range(k))
+    ss_btwn = (ss_diag + 2 * sum(c_jl for (j, l), c_jl in comoment.items() if j != l)) / k
+    return {'ss_btwn': ss_btwn, 'ss_sess': ss_sess, 'ss_err': ss_diag - ss_btwn}
+
+
+def _icc(sumsq: dict, n, k: int, icc_types: list = ('icc_3',)) -> dict:
+    # mean squares and ICC estimates as pyrelimri's sumsq_icc(), keyed by icc_img_type()
+    for icc_type in icc_types:
+        if icc_type not in ICC_TYPES:
+            raise ValueError(f"ICC type should be in {','.join(ICC_TYPES)}, {icc_type} entered")
+    ms_btwn = sumsq['ss_btwn'] / (n - 1)
+    ms_err = sumsq['ss_err'] / ((n - 1) * (k - 1))
+    estimates = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'icc_1' in icc_types:
+            ms_wthn = (sumsq['ss_sess'] + sumsq['ss_err']) / (n * (k - 1))
+            estimates.update({'icc1est': (ms_btwn - ms_wthn) / (ms_btwn + (k - 1) * ms_wthn),
+                              'icc1btwnsub': (ms_btwn - ms_wthn) / k, 'icc1wthnsub': ms_wthn})
+        if 'icc_2' in icc_types:
+            ms_sess = sumsq['ss_sess'] / (k - 1)
+            estimates.update({'icc2est': (ms_btwn - ms_err) / (ms_btwn + (k - 1) * ms_err +
+                                                               k * (ms_sess - ms_err) / n),
+                              'icc2btwnsub': (ms_btwn - ms_err) / k, 'icc2wthnsub': ms_err,
+                              'icc2btwnmeas': (ms_sess - ms_err) / n})
+        if 'icc_3' in icc_types:
+            estimates.update({'est': (ms_btwn - ms_err) / (ms_btwn + (k - 1) * ms_err),
+                              'btwnsub': (ms_btwn - ms_err) / k, 'wthnsub': ms_err})
+    return estimates
+
+
+def load_session_maps(multisession_list: list, mask_img, dtype=np.float32) -> np.ndarray:
+    """
+    Loads subject maps once into a (subject x session x voxel) array of the in-mask voxels. float32 by default,
+    the precision pyrelimri's voxelwise_icc() uses (nilearn's concat_imgs).
+
+    :param multisession_list: list (sessions) of lists of paths to subject maps (3D), same subject order
+    :param mask_img: 3D mask Nifti1Image
+    :param dtype: dtype of the array, default np.float32
+    :return: 3D array subject x session x voxel
+    """
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    data = np.empty((len(multisession_list[0]), len(multisession_list), int(mask.sum())), dtype=dtype)
+    for sess_i, session_paths in enumerate(multisession_list):
+        for sub_i, path in enumerate(session_paths):
+            map_dat = np.asanyarray(nib.load(path).dataobj)
+            data[sub_i, sess_i] = map_dat.reshape(mask.shape)[mask]
+    return data
+
+
+def icc_array(data: np.ndarray, chunk_vox: int = 65536, icc_types: list = ('icc_3',)) -> dict:
+    """
+    ICCs of a (subject x session x voxel) array, e.g. rows of load_session_maps() picked for a subsample,
+    computed in float64 a chunk of voxels at a time. Same estimates as StreamingICC.
+
+    :param data: 3D array subject x session x voxel
+    :param chunk_vox: N of voxels per chunk
+    :param icc_types: list of icc_1, icc_2 and/or icc_3, default icc_3
+    :return: dict of stat label: 1D array, see StreamingICC.estimates()
+    """
+    estimates = icc_batch(data, np.arange(data.shape[0])[np.newaxis], icc_types=icc_types,
+                          chunk_bytes=chunk_vox * data[:, :, 0].size * 8)
+    return {est_name: est[0] for est_name, est in estimates.items()}
+
+
+def icc_batch(pool: np.ndarray, index_sets: np.ndarray, chunk_bytes: int = 1 << 28,
+              icc_types: list = ('icc_3',)) -> dict:
+    """
+    ICCs of several subsamples of the same (subject x session x voxel) pool at once, e.g. every seed's
+    subsample of size N. The rows of each subsample are gathered and reduced in batched float64 arrays,
+    a chunk of voxels at a time.
+
+    :param pool: 3D array subject x session x voxel, see load_session_maps()
+    :param index_sets: 2D int array subsample x N, rows of pool in each subsample
+    :param chunk_bytes: approximate bytes of the float64 (subsample x N x session x voxel) chunk
+    :param icc_types: list of icc_1, icc_2 and/or icc_3, default icc_3
+    :return: dict of stat label: 2D array subsample x voxel, see StreamingICC.estimates()
+    """
+    index_sets = np.asarray(index_sets)
+    n_sets, n = index_sets.shape
+    k, n_vox = pool.shape[1:]
+    chunk_vox = max(1, int(chunk_bytes // (n_sets * n * k * 8)))
+    estimates = {}
+    for start in range(0, n_vox, chunk_vox):
+        chunk = pool[:, :, start:start + chunk_vox][index_sets].astype(np.float64)
+        mean = chunk.mean(axis=1)
+        chunk -= mean[:, np.newaxis]
+        comoment = {(j, l): (chunk[:, :, j] * chunk[:, :, l]).sum(axis=1) for j in range(k) for l in range(j, k)}
+        sumsq = _sumsq(np.moveaxis(mean, 1, 0), comoment, n)
+        for est_name, est in _icc(sumsq, n, k, icc_types).items():
+            estimates.setdefault(est_name, np.empty((n_sets, n_vox)))[:, start:start + chunk_vox] = est
+    return estimates
+
+
+def icc_bootstrap(data: np.ndarray, n_boot: int = 1000, weights: str = 'multinomial', alpha: float = 0.05,
+                  seed: int = None, batch: int = 100, chunk_bytes: int = 1 << 28) -> dict:
+    """
+    Percentile bootstrap confidence intervals of ICC(3,1) from a (subject x session x voxel) array held in memory.
+    Each resample is a vector of subject weights, multinomial counts (the classic resample with replacement) or
+    Poisson(1) weights, and its ICC is computed from the weighted means and co-moments, batches of resamples at a
+    time as weight matrix products. The same resamples are used for every voxel, voxels are processed in chunks.
+
+    :param data: 3D array subject x session x voxel, see load_session_maps()
+    :param n_boot: N of bootstrap resamples
+    :param weights: 'multinomial' (default) or 'poisson'
+    :param alpha: CI level, default 0.05 (95% CI)
+    :param seed: seed of the resample weights, default None
+    :param batch: N of resamples per weight matrix product
+    :param chunk_bytes: approximate bytes held per chunk, the larger of the resample x voxel estimates and the
+        subject x session x voxel data with its co-moment products
+    :return: dict of 'lowbound' and 'upbound' 1D arrays (voxel), resamples without a defined ICC are ignored
+    """
+    n, k, n_vox = data.shape
+    rng = np.random.default_rng(seed)
+    if weights == 'multinomial':
+        boot_w = rng.multinomial(n, np.full(n, 1 / n), size=n_boot).astype(np.float64)
+    elif weights == 'poisson':
+        boot_w = rng.poisson(1.0, size=(n_boot, n)).astype(np.float64)
+    else:
+        raise ValueError(f"weights should be multinomial or poisson, {weights} entered")
+    boot_n = boot_w.sum(axis=1, keepdims=True)
+
+    # per voxel: n_boot estimates, or the centered data (n x k) and the k(k+1)/2 products (n each)
+    chunk_vox = max(1, int(chunk_bytes // (8 * max(n_boot, n * k * (k + 3) // 2))))
+    bounds = {'lowbound': np.empty(n_vox), 'upbound': np.empty(n_vox)}
+    for start in range(0, n_vox, chunk_vox):
+        chunk = data[:, :, start:start + chunk_vox].astype(np.float64)
+        # centered on the sample means, so the weighted co-moments from raw products don't lose precision
+        chunk -= chunk.mean(axis=0)
+        n_chunk = chunk.shape[2]
+        products = {(j, l): chunk[:, j] * chunk[:, l] for j in range(k) for l in range(j, k)}
+        boot_est = np.empty((n_boot, n_chunk))
+        for b_start in range(0, n_boot, batch):
+            w, w_n = boot_w[b_start:b_start + batch], boot_n[b_start:b_start + batch]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = (w @ chunk.reshape(n, -1)).reshape(-1, k, n_chunk) / w_n[:, :, np.newaxis]
+                comoment = {(j, l): w @ prod - w_n * mean[:, j] * mean[:, l] for (j, l), prod in products.items()}
+                boot_est[b_start:b_start + batch] = _icc(_sumsq(np.moveaxis(mean, 1, 0), comoment, w_n),
+                                                         w_n, k)['est']
+        bounds['lowbound'][start:start + chunk_vox] = np.nanpercentile(boot_est, 100 * alpha / 2, axis=0)
+        bounds['upbound'][start:start + chunk_vox] = np.nanpercentile(boot_est, 100 * (1 - alpha / 2), axis=0)
+    return bounds
+
+
+def voxelwise_icc_stream(multisession_list: list, mask=None, icc_types: list = ('icc_3',)) -> dict:
+    """
+    Voxelwise ICCs, same outputs as pyrelimri's brain_icc.voxelwise_icc() for 'est', 'btwnsub', 'wthnsub'
+    (and 'btwnmeas' for icc_2), with the maps of one subject (all sessions) read at a time. Every ICC type in
+    icc_types is computed from the same pass, labelled as in icc_img_type().
+    With mask=None the maps are accumulated on the full volume and the background mask of each session's mean
+    map is computed after, as NiftiMasker does; voxels in both session masks are kept.
+
+    :param multisession_list: list (sessions) of lists of paths to subject maps (3D), same subject order
+    :param mask: path to mask or Nifti1Image, default None
+    :param icc_types: list of icc_1, icc_2 and/or icc_3, default icc_3
+    :return: dict of stat label: Nifti1Image, e.g. 'est', 'btwnsub' and 'wthnsub' for icc_3
+    """
+    return voxelwise_icc_stream_many(key_sessions={'maps': multisession_list}, mask=mask,
+                                     icc_types=icc_types)['maps']
+
+
+def voxelwise_icc_stream_many(key_sessions: dict, mask=None, icc_types: list = ('icc_3',)) -> dict:
+    """
+    Voxelwise ICCs of several models at once (e.g. every model permutation), one StreamingICC per key.
+    Maps are read subject by subject: the i-th subject's maps of every key, then the i+1-th, so each file is
+    read once. See voxelwise_icc_stream() for the outputs.
+
+    :param key_sessions: dict of key: list (sessions) of lists of paths to subject maps, all maps on the same grid
+    :param mask: path to mask or Nifti1Image, default None
+    :param icc_types: list of icc_1, icc_2 and/or icc_3, default icc_3
+    :return: dict of key: dict of stat label: Nifti1Image
+    """
+    for key, multisession_list in key_sessions.items():
+        n_subs = [len(session_paths) for session_paths in multisession_list]
+        if len(set(n_subs)) != 1:
+            raise ValueError(f"{key}: not all sessions have the same N of maps: "
+                             f"{', '.join(str(n) for n in n_subs)}")
+    ref_img = nib.load(next(iter(key_sessions.values()))[0][0])
+    shape, affine = ref_img.shape[:3], ref_img.affine
+    if mask is not None:
+        vox_mask = np.asarray(NiftiMasker(mask_img=mask).fit().mask_img_.dataobj).astype(bool)
+    else:
+        vox_mask = np.ones(shape, dtype=bool)
+
+    models = {key: StreamingICC(n_vox=int(vox_mask.sum()), n_sessions=len(multisession_list))
+              for key, multisession_list in key_sessions.items()}
+    key_subjects = {key: list(zip(*multisession_list)) for key, multisession_list in key_sessions.items()}
+    for sub_i in range(max(len(sub_paths) for sub_paths in key_subjects.values())):
+        for key, sub_paths in key_subjects.items():
+            if sub_i < len(sub_paths):
+                sub_maps = []
+                for path in sub_paths[sub_i]:
+                    map_dat = np.asanyarray(nib.load(path).dataobj)
+                    sub_maps.append(map_dat.reshape(shape)[vox_mask])
+                models[key].update(sub_maps)
+
+    key_imgs = {}
+    for key, icc_model in models.items():
+        estimates = icc_model.estimates(icc_types)
+        key_mask = vox_mask
+        if mask is None:
+            key_mask = vox_mask.copy()
+            for sess_mean in icc_model.mean:
+                sess_img = nib.Nifti1Image(sess_mean.reshape(shape), affine)
+                key_mask &= np.asarray(compute_background_mask(sess_img).dataobj).astype(bool)
+            in_mask = key_mask.ravel()
+            estimates = {est_name: est[in_mask] for est_name, est in estimates.items()}
+
+        icc_imgs = {}
+        for est_name, est in estimates.items():
+            vol = np.zeros(shape)
+            vol[key_mask] = est
+            icc_imgs[est_name] = nib.Nifti1Image(vol, affine)
+        key_imgs[key] = icc_imgs
+    return key_imgs
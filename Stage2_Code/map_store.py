@@ -0,0 +1,138 @@
+import os
+import numpy as np
+import nibabel as nib
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class MaskedMapStore:
+    """
+    One HDF5 file of masked maps (e.g. all beta/var/residvar maps of a subject) instead of one .nii.gz per map.
+    The mask and affine are stored once and each map is a 1D float32 vector of the in-mask voxels, chunked,
+    compressed and checksummed (fletcher32). Maps are named as the NIfTI file would be, without .nii.gz, e.g.
+    'sub-01_ses-1_task-mid_run-01_contrast-Lgain-Neut_mask-mni152_mot-opt1_mod-CueMod_fwhm-3.6_stat-beta'.
+    Use read_img() to rebuild a Nifti1Image for a map on demand.
+    """
+    def __init__(self, path: str, mask_img=None, mode: str = 'a', dtype: str = 'float32',
+                 compression: str = 'gzip', chunk_vox: int = 65536):
+        """
+        :param path: path to .h5 store
+        :param mask_img: 3D mask Nifti1Image, required when the store is created
+        :param mode: h5py file mode, 'a' read/write (create if missing) or 'r' read only. In mode 'a', a store
+            that can't be opened (e.g. a job killed mid-write) is moved to {path}.corrupt and rebuilt empty
+        :param dtype: dtype of the saved maps, default float32
+        :param compression: h5py compression filter, default gzip
+        :param chunk_vox: N of voxels per chunk
+        """
+        if h5py is None:
+            raise ImportError("h5py is required for the hdf5 map store, e.g. pip install h5py")
+        self.path = path
+        self.dtype = dtype
+        self.compression = compression
+        if mode != 'r' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            self._h5 = h5py.File(path, mode)
+        except OSError:
+            if mode != 'a' or not os.path.exists(path):
+                raise
+            # its maps are lost, contains() is False for all of them so they are refit
+            print(f"\t {path} can't be opened, moved to {path}.corrupt and rebuilt")
+            os.replace(path, f'{path}.corrupt')
+            self._h5 = h5py.File(path, mode)
+        if 'mask' not in self._h5:
+            if mask_img is None:
+                raise ValueError(f"{path} has no mask stored, mask_img is required to create the store")
+            self._h5.create_dataset('mask', data=np.asarray(mask_img.dataobj).astype(np.uint8),
+                                    compression=compression)
+            self._h5['mask'].attrs['affine'] = mask_img.affine
+            self._h5.create_group('maps')
+        self.mask = self._h5['mask'][()].astype(bool)
+        self.affine = self._h5['mask'].attrs['affine']
+        self.n_vox = int(self.mask.sum())
+        self.chunk_vox = max(1, min(chunk_vox, self.n_vox))
+        if mask_img is not None and not np.array_equal(np.asarray(mask_img.dataobj).astype(bool), self.mask):
+            raise ValueError(f"mask_img does not match the mask stored in {path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._h5.close()
+
+    def names(self) -> list:
+        return list(self._h5['maps'].keys())
+
+    def contains(self, name: str) -> bool:
+        """
+        Whether map name was written completely (the 'complete' flag is set after the data is written)
+        """
+        return name in self._h5['maps'] and bool(self._h5['maps'][name].attrs.get('complete', False))
+
+    def write(self, name: str, data):
+        """
+        Saves a map to the store, replacing it if it exists.
+
+        :param name: map name
+        :param data: 1D array of the in-mask voxels (mask order) or a 3D Nifti1Image in the mask space
+        :return: nothing returned, map is saved
+        """
+        if isinstance(data, nib.Nifti1Image):
+            vol = np.asanyarray(data.dataobj)
+            data = vol.reshape(vol.shape[:3])[self.mask]
+        data = np.asarray(data, dtype=self.dtype).ravel()
+        if data.shape[0] != self.n_vox:
+            raise ValueError(f"{name} has {data.shape[0]} values, mask has {self.n_vox} voxels")
+        maps = self._h5['maps']
+        if name in maps:
+            del maps[name]
+        dset = maps.create_dataset(name, data=data, chunks=(self.chunk_vox,), compression=self.compression,
+                                   shuffle=True, fletcher32=True)
+        dset.attrs['complete'] = True
+
+    def write_many(self, maps: dict):
+        """
+        Saves a dict of map name: data, see write(), and flushes the file once
+
+        :param maps: dict of map name: 1D array of in-mask voxels or 3D Nifti1Image
+        :return: nothing returned, maps are saved
+        """
+        for name, data in maps.items():
+            self.write(name, data)
+        self._h5.flush()
+
+    def read_vector(self, name: str) -> np.ndarray:
+        """
+        :param name: map name
+        :return: 1D array of the in-mask voxels
+        """
+        return self._h5['maps'][name][()]
+
+    def read_img(self, name: str):
+        """
+        Rebuilds the 3D Nifti1Image of a map, voxels outside the mask are 0
+
+        :param name: map name
+        :return: Nifti1Image
+        """
+        vol = np.zeros(self.mask.shape, dtype=self.dtype)
+        vol[self.mask] = self.read_vector(name)
+        return nib.Nifti1Image(vol, self.affine)
+
+
+def load_map_img(store_path: str, name: str):
+    """
+    Reads one map from a MaskedMapStore file as a Nifti1Image, e.g. to pass it on to nilearn
+
+    :param store_path: path to .h5 store
+    :param name: map name
+    :return: Nifti1Image
+    """
+    with MaskedMapStore(store_path, mode='r') as store:
+        return store.read_img(name)
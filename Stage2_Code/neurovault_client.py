@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import threading
+import requests
+import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from Stage2_Code.resume_manifest import file_sha256
+
+NEUROVAULT_API = 'https://neurovault.org/api/'
+# rate limited or server side errors, retried with backoff
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# methods that can create a duplicate when resent, e.g. an upload that was saved before its response was lost.
+# They are only retried when the request wasn't sent (connection failed) or was rate limited (429)
+NON_IDEMPOTENT = {'post'}
+
+
+def _not_sent(error: requests.RequestException) -> bool:
+    # the connection couldn't be opened, so the server never got the request
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+
+class NeuroVaultSession:
+    """
+    NeuroVault API client with the pynv Client endpoints used here (create_collection, add_image, update_image,
+    delete_image, get_collection_images). All requests go through one keep-alive requests.Session whose
+    connection pool is shared by the worker threads. Connection errors, timeouts, 429 and 5xx responses are
+    retried with exponential backoff (or the server's Retry-After), other errors raise requests.HTTPError.
+    POST requests (e.g. uploads) are only retried on a failed connection or a 429, a read timeout, dropped
+    connection or 5xx may follow a saved upload and is raised instead of creating a duplicate image.
+    """
+    def __init__(self, token: str = None, base_url: str = NEUROVAULT_API, pool_size: int = 8, retries: int = 5,
+                 backoff: float = 1.0, timeout: float = 300):
+        """
+        :param token: NeuroVault access token, default None (read only requests)
+        :param base_url: API url, default https://neurovault.org/api/
+        :param pool_size: N of pooled connections, set to the N of worker threads
+        :param retries: N of retries of a transient error, default 5
+        :param backoff: seconds waited before the first retry, doubled at each retry, default 1
+        :param timeout: seconds to wait for a response, default 300
+        """
+        self.base_url = base_url.rstrip('/') + '/'
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def request(self, method: str, path: str, file: str = None, **kwargs) -> requests.Response:
+        """
+        Sends a request to {base_url}{path}/, retrying transient errors
+
+        :param method: HTTP method, e.g. 'get', 'post'
+        :param path: API path, e.g. 'collections/1/images'
+        :param file: path of a file to send as the 'file' field, reopened for each attempt
+        :param kwargs: passed to requests.Session.request, e.g. data, params
+        :return: requests.Response
+        """
+        url = f"{self.base_url}{path.strip('/')}/"
+        retry_status = {429} if method.lower() in NON_IDEMPOTENT else RETRY_STATUS
+        for attempt in range(self.retries + 1):
+            wait = self.backoff * 2 ** attempt
+            try:
+                if file is not None:
+                    with open(file, 'rb') as f:
+                        response = self.session.request(method, url, files={'file': (os.path.basename(file), f)},
+                                                        timeout=self.timeout, **kwargs)
+                else:
+                    response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries or (method.lower() in NON_IDEMPOTENT and not _not_sent(e)):
+                    raise
+            else:
+                if response.status_code not in retry_status or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    wait = int(retry_after)
+            time.sleep(wait)
+
+    def create_collection(self, name: str, **data) -> dict:
+        return self.request('post', 'collections', data=dict(data, name=name)).json()
+
+    def add_image(self, collection_id, file: str, **data) -> dict:
+        return self.request('post', f'collections/{collection_id}/images', file=file, data=data).json()
+
+    def update_image(self, image_id, file: str, **data) -> dict:
+        return self.request('patch', f'images/{image_id}', file=file, data=data).json()
+
+    def delete_image(self, image_id) -> requests.Response:
+        return self.request('delete', f'images/{image_id}')
+
+    def get_collection_images(self, collection_id, limit: int = None, offset: int = None) -> dict:
+        params = {key: val for key, val in [('limit', limit), ('offset', offset)] if val is not None}
+        return self.request('get', f'collections/{collection_id}/images', params=params).json()
+
+
+class RateLimiter:
+    """
+    Spaces out calls from several threads to at most rate per second: wait() blocks until the caller's slot
+    """
+    def __init__(self, rate: float = None):
+        """
+        :param rate: max N of calls per second, default None (no limit)
+        """
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            slot = max(self._next, time.monotonic())
+            self._next = slot + self.interval
+        time.sleep(max(0, slot - time.monotonic()))
+
+
+class UploadManifest:
+    """
+    Local record of the uploaded files: sha256 of the file -> NeuroVault image ID, per collection, so reruns skip
+    the files that are already up. Each upload is appended as one JSON line when it completes (safe to record
+    from worker threads), a line cut off by a killed job is ignored on reading.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            line = '\n'
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._entries[(str(entry['collection_id']), entry['sha256'])] = entry
+            if not line.endswith('\n'):
+                # end the cut off line, so the next record starts on its own line
+                with open(path, 'a') as f:
+                    f.write('\n')
+
+    def image_id(self, collection_id, sha256: str):
+        """
+        :return: NeuroVault image ID of the file with this sha256 in the collection, None if not uploaded
+        """
+        entry = self._entries.get((str(collection_id), sha256))
+        return entry['image_id'] if entry is not None else None
+
+    def record(self, collection_id, sha256: str, image_id, path: str):
+        """
+        Records an uploaded file and appends it to the manifest
+        """
+        entry = {'collection_id': str(collection_id), 'sha256': sha256, 'image_id': image_id, 'path': path}
+        with self._lock:
+            self._entries[(str(collection_id), sha256)] = entry
+            out_dir = os.path.dirname(self.path)
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+def upload_images(api: NeuroVaultSession, collection_id, uploads: list, manifest: UploadManifest = None,
+                  n_workers: int = 8) -> tuple:
+    """
+    Uploads images to a collection with a pool of n_workers threads. Files whose sha256 is in the manifest for
+    the collection are skipped, each completed upload is recorded in the manifest as it finishes. A failed
+    upload (after the retries of api) is reported and does not stop the others.
+
+    :param api: NeuroVaultSession
+    :param collection_id: NeuroVault collection ID
+    :param uploads: list of (path, dict of image fields, e.g. name, map_type, estimate_type)
+    :param manifest: UploadManifest, default None (nothing skipped or recorded)
+    :param n_workers: N of concurrent uploads, default 8
+    :return: tuple of dict of path: image ID (uploaded or skipped), and dict of path: error of failed uploads
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        hashes = dict(zip([path for path, _ in uploads], executor.map(file_sha256, [path for path, _ in uploads])))
+        image_ids, failed = {}, {}
+        pending = []
+        for path, data in uploads:
+            uploaded_id = manifest.image_id(collection_id, hashes[path]) if manifest is not None else None
+            if uploaded_id is not None:
+                image_ids[path] = uploaded_id
+            else:
+                pending.append((path, data))
+        print(f"\t {len(image_ids)} of {len(uploads)} images already uploaded, uploading {len(pending)} "
+              f"with {n_workers} workers")
+        futures = {executor.submit(api.add_image, collection_id, path, **data): path for path, data in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                image_ids[path] = future.result()['id']
+            except Exception as e:
+                print(f"\t Error uploading {path}: {e}")
+                failed[path] = e
+                continue
+            if manifest is not None:
+                manifest.record(collection_id, hashes[path], image_ids[path], path)
+    return image_ids, failed
+
+
+def collection_images(api: NeuroVaultSession, collection_id, limit: int = 100, offset_start: int = 0,
+                      n_workers: int = 8) -> pd.DataFrame:
+    """
+    Lists the images of a collection: the first page gives the image count, the remaining pages are fetched
+    concurrently and the results are combined into one DataFrame in page order.
+
+    :param api: NeuroVaultSession
+    :param collection_id: NeuroVault collection ID
+    :param limit: N of images per page, default 100
+    :param offset_start: offset of the first image, default 0
+    :param n_workers: N of concurrent page requests, default 8
+    :return: DataFrame of the images' fields (id, name, estimate_type, ...), one row per image
+    """
+    first_page = api.get_collection_images(collection_id=collection_id, limit=limit, offset=offset_start)
+    offsets = range(offset_start + limit, first_page['count'], limit)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pages = list(executor.map(lambda offset: api.get_collection_images(collection_id=collection_id,
+                                                                           limit=limit, offset=offset), offsets))
+    return pd.DataFrame([image for page in [first_page] + pages for image in page['results']])
+
+
+def delete_images(api: NeuroVaultSession, image_ids: list, n_workers: int = 8, rate: float = None,
+                  dry_run: bool = False) -> pd.DataFrame:
+    """
+    Deletes images with a pool of n_workers threads, starting at most rate deletes per second. A failed delete
+    (after the retries of api) is reported and does not stop the others.
+
+    :param api: NeuroVaultSession
+    :param image_ids: list of NeuroVault image IDs
+    :param n_workers: N of concurrent deletes, default 8
+    :param rate: max N of deletes started per second, default None (no limit)
+    :param dry_run: only report the images that would be deleted, default False
+    :return: DataFrame report of id, status ('deleted', 'failed' or 'dry_run') and error
+    """
+    if dry_run:
+        return pd.DataFrame({'id': list(image_ids), 'status': 'dry_run', 'error': None})
+    limiter = RateLimiter(rate)
+
+    def delete_one(image_id):
+        limiter.wait()
+        try:
+            api.delete_image(image_id=image_id)
+        except Exception as e:
+            print(f"\t Error deleting {image_id}: {e}")
+            return image_id, 'failed', str(e)
+        return image_id, 'deleted', None
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        report = list(executor.map(delete_one, image_ids))
+    return pd.DataFrame(report, columns=['id', 'status', 'error'])
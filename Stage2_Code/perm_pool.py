@@ -0,0 +1,52 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def share_array(arr: np.ndarray):
+    """
+    Copies an array into a shared memory block, so worker processes can read it without it being pickled.
+    The caller owns the block and has to close() + unlink() it once the workers are done.
+
+    :param arr: numpy array, e.g. the 4D BOLD data of a run
+    :return: tuple of the SharedMemory block and the spec (name, shape, dtype) used by attach_array()
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared_arr = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared_arr[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def attach_array(spec: tuple):
+    """
+    Attaches to an array shared by share_array() from a worker process, without copying it.
+    Keep the returned block referenced while the array is used and close() it after.
+
+    :param spec: (name, shape, dtype) spec returned by share_array()
+    :return: tuple of the SharedMemory block and the numpy array view (read-only)
+    """
+    name, shape, dtype = spec
+    # pool workers share the parent's resource tracker, so the block is unlinked once by the parent
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    arr.flags.writeable = False
+    return shm, arr
+
+
+def workers_for_budget(n_jobs: int, max_mem: float, worker_bytes: float, shared_bytes: float = 0) -> int:
+    """
+    N of worker processes that fit in a memory budget, given the estimated peak memory of one worker
+    and the memory of the arrays shared across workers (counted once).
+
+    :param n_jobs: requested N of workers
+    :param max_mem: memory budget in GB, None for no limit
+    :param worker_bytes: estimated peak bytes of one worker
+    :param shared_bytes: bytes of the shared arrays
+    :return: N of workers, between 1 and n_jobs
+    """
+    if max_mem is None:
+        return max(1, n_jobs)
+    n_fit = int((max_mem * 1024 ** 3 - shared_bytes) // max(worker_bytes, 1))
+    if n_fit < 1:
+        print(f"\t Memory budget {max_mem}GB is below the estimated need of one worker "
+              f"[{(shared_bytes + worker_bytes) / 1024 ** 3:.2f}GB], running 1 worker")
+    return int(min(max(n_fit, 1), max(1, n_jobs)))
@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """
+    sha256 hex digest of a file, read in blocks
+
+    :param path: path to file
+    :param block_size: bytes read per block
+    :return: hex digest string
+    """
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class OutputManifest:
+    """
+    Small JSON manifest of completed outputs, used to resume a permutation loop after a job was killed.
+    Each key (e.g. 'run-01_fwhm-3.6_mot-opt1_mod-CueMod_contrast-Lgain-Neut') records the files it saved
+    with their size and sha256, and optionally a fingerprint of the inputs used. A key is complete when
+    every recorded file still exists with the same size and hash (and the inputs match), so outputs that are
+    missing, truncated or corrupt are redone.
+    The manifest is rewritten atomically after each record, only the main process should record to it.
+    """
+    def __init__(self, path: str, check_hash: bool = True):
+        self.path = path
+        self.check_hash = check_hash
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                print(f"\t Manifest {path} could not be read, all outputs will be redone")
+                self._entries = {}
+
+    @staticmethod
+    def _inputs_id(inputs) -> str:
+        return hashlib.sha256('\n'.join(sorted(str(i) for i in inputs)).encode()).hexdigest()
+
+    def is_complete(self, key: str, inputs: list = None) -> bool:
+        """
+        Checks whether the outputs recorded for key are complete and unchanged.
+
+        :param key: output key
+        :param inputs: list of input paths/labels used to create the outputs, default None (not checked)
+        :return: True if complete, False if the outputs have to be (re)created
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if inputs is not None and entry.get('inputs') != self._inputs_id(inputs):
+            return False
+        for path, info in entry['files'].items():
+            if not os.path.exists(path) or os.path.getsize(path) != info['size']:
+                return False
+            if self.check_hash and file_sha256(path) != info['sha256']:
+                return False
+        return True
+
+    def record(self, key: str, paths: list, inputs: list = None):
+        """
+        Records the files saved for key and rewrites the manifest.
+
+        :param key: output key
+        :param paths: list of paths to the saved files
+        :param inputs: list of input paths/labels used to create the outputs, default None
+        :return: nothing returned, manifest is saved
+        """
+        self.record_many({key: paths}, inputs={key: inputs} if inputs is not None else None)
+
+    def record_many(self, saved: dict, inputs: dict = None):
+        """
+        Records several keys at once, rewriting the manifest once.
+
+        :param saved: dict of key: list of paths to the saved files
+        :param inputs: dict of key: list of input paths/labels, default None
+        :return: nothing returned, manifest is saved
+        """
+        for key, paths in saved.items():
+            entry = {'files': {path: {'size': os.path.getsize(path), 'sha256': file_sha256(path)}
+                               for path in paths}}
+            if inputs is not None and inputs.get(key) is not None:
+                entry['inputs'] = self._inputs_id(inputs[key])
+            self._entries[key] = entry
+        self._save()
+
+    def _save(self):
+        # write to a temporary file and replace, so a killed job never leaves a partial manifest
+        out_dir = os.path.dirname(self.path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=1)
+        os.replace(tmp_path, self.path)
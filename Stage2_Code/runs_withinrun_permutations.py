@@ -5,19 +5,28 @@ warnings.filterwarnings("ignore", category=UserWarning,
 import sys
 import os
 import argparse
+import multiprocessing
 import numpy as np
 import pandas as pd
 import nibabel as nib
 from glob import glob
-from itertools import product
+from itertools import product, groupby
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from nilearn.glm.first_level import FirstLevelModel
+from nilearn.maskers import NiftiMasker
 
 
 
 # Getpath to Stage2 scripts
 project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(project_dir)
-from Stage2_Code.designmat_regressors_define import create_design_mid, pull_regressors, eff_estimator
+from Stage2_Code.designmat_regressors_define import create_design_mid, pull_regressors, eff_estimator_batch
+from Stage2_Code.bold_cache import load_bold_run, masked_bold, unmask_bold, smooth_masked_bold, img_as_dtype, \
+    SmoothedBoldCache
+from Stage2_Code.perm_pool import share_array, attach_array, workers_for_budget
+from Stage2_Code.resume_manifest import OutputManifest
+from Stage2_Code.map_store import MaskedMapStore
+from Stage2_Code.glm_batch import fit_batch_glm, contrast_vectors, compare_precision
 
 # relabel column names to match templates code for ABCD/MLS
 dict_renamecols_abcd = {
@@ -69,6 +78,29 @@ parser.add_argument("--mask_label", help="label for mask, e.g. mni152, subtresh,
 parser.add_argument("--output", help="output folder where to write out and save information")
 parser.add_argument("--excl", help="TSV file with Subjects Inclusion(0)+exclusion for acompcor=1=",
                     default=None)
+parser.add_argument("--inmem", help="load + mask each BOLD run once and reuse it across the model permutations",
+                    action="store_true")
+parser.add_argument("--smooth_cache", help="N of smoothed BOLD runs to keep in memory; if > 0, each run is smoothed "
+                                           "once per FWHM and reused across motion/model permutations (implies --inmem)",
+                    type=int, default=0)
+parser.add_argument("--engine", help="GLM engine: nilearn (FirstLevelModel per permutation) or batch (all motion x "
+                                     "model designs of a run + fwhm fit at once, implies --smooth_cache)",
+                    choices=['nilearn', 'batch'], default='nilearn')
+parser.add_argument("--n_jobs", help="N of worker processes to spread the permutations of a run across, default 1",
+                    type=int, default=1)
+parser.add_argument("--max_mem", help="memory budget in GB that limits how many workers run at once, default None",
+                    type=float, default=None)
+parser.add_argument("--out_store", help="output format of the beta/var/residvar maps: nifti (one .nii.gz per map) or "
+                                        "hdf5 (masked float32 maps in one .h5 per subject, requires --mask + h5py)",
+                    choices=['nifti', 'hdf5'], default='nifti')
+parser.add_argument("--precision", help="float precision of the BOLD, GLM estimates and saved maps, "
+                                        "float64 (default) or float32 (half the memory of the BOLD arrays)",
+                    choices=['float64', 'float32'], default='float64')
+parser.add_argument("--check_precision", help="with --precision float32 + --engine batch, compare the float32 fit "
+                                              "of the first fwhm of each run to float64 and report the max "
+                                              "relative difference", action="store_true")
+parser.add_argument("--resume", help="skip outputs recorded as complete (size + sha256) in the subject's manifest, "
+                                     "redo only missing or corrupt ones", action="store_true")
 
 
 args = parser.parse_args()
@@ -87,6 +119,23 @@ brainmask = args.mask
 mask_label = args.mask_label
 scratch_out = args.output
 excl_list = args.excl
+engine = args.engine
+if engine == 'batch':
+    args.smooth_cache = max(args.smooth_cache, 1)
+n_jobs = args.n_jobs
+max_mem = args.max_mem
+out_store = args.out_store
+precision = np.float32 if args.precision == 'float32' else np.float64
+if out_store == 'hdf5' and brainmask is None:
+    parser.error("--out_store hdf5 requires --mask, maps of all runs are saved in the same mask space")
+inmem = args.inmem or args.smooth_cache > 0 or n_jobs > 1 or out_store == 'hdf5'
+smooth_cache = SmoothedBoldCache(max_entries=args.smooth_cache) if args.smooth_cache > 0 else None
+manifest = OutputManifest(f'{scratch_out}/{subj}_ses-{ses}_task-{task}_desc-firstlvl_manifest.json') \
+    if args.resume else None
+# maps are saved to the store by the main process, workers return them
+map_store = MaskedMapStore(f'{scratch_out}/{subj}_ses-{ses}_task-{task}_desc-firstlvl_maps.h5',
+                           mask_img=NiftiMasker(mask_img=brainmask).fit().mask_img_) \
+    if out_store == 'hdf5' else None
 
 # model design options, contrasts and weights setup
 model_types = {
@@ -138,95 +187,279 @@ else:
     # empty DataFrame with 2 columns
     excl_subs = pd.DataFrame(columns=[0, 1])
 
-for run in runs:
-    print(f'\tStarting {subj} {run}.')
-    # set-up combined efficieny df
-    comb_eff = pd.DataFrame(columns=[np.hstack(('model', 'run', list(contrast_weights.keys())))])
-    count = 0
-    for fwhm, motion, model in permutation_list:
-        count = count + 1
-        exclude_subject = (
-                (excl_subs[excl_subs[0] == subj][1].values == 1).any() and
-                motion in ["opt3", "opt4"]
-        )
-        if exclude_subject:
-            print("\t\t {} aCompCor ROI flag excluded for model {}, {}, {}".format(subj, fwhm, motion, model))
-        else:
-            print('\t\t {}. Running model using: {}, {}, {}'.format(count, fwhm, motion, model))
-            print('\t\t 1/5 Load Files & set paths')
-            # import behavior events .tsv from data path
-            events_df = pd.read_csv(f'{beh_path}/{subj}/ses-{ses}/func/{subj}_ses-{ses}_task-{task}_run-{run}_events.tsv',
-                                    sep='\t')
-            if sample == 'abcd':
-                events_df = events_df.rename(columns=dict_renamecols_abcd)
-                events_df['TRIAL_TYPE'] = events_df['TRIAL_TYPE'].replace(dict_rename_cuetype)
-            elif sample == 'MLS':
-                events_df = events_df.rename(columns=dict_renamecols_mls)
-                events_df['TRIAL_TYPE'] = events_df['TRIAL_TYPE'].replace(dict_rename_cuetype)
+
+def perm_key(run: str, fwhm: float, motion: str, model: str, con_name: str) -> str:
+    # manifest key of the beta, var and residvar maps of one run x permutation x contrast
+    return f'run-{run}_fwhm-{fwhm}_mot-{motion}_mod-{model}_contrast-{con_name}'
+
+
+def fit_fwhm_models(run: str, fwhm: float, fwhm_models: list, bold_inp, mask_inp,
+                    run_designs: dict, run_effs: np.ndarray):
+    """
+    Fits the motion x model designs of a run for one fwhm and saves the beta, var and residual variance
+    maps for each contrast.
+
+    :param run: run label, e.g. '01'
+    :param fwhm: smoothing kernel FWHM in mm
+    :param fwhm_models: list of (motion, model) permutations to fit
+    :param bold_inp: BOLD path or in-memory 4D Nifti1Image
+    :param mask_inp: mask path or resolved 3D mask Nifti1Image
+    :param run_designs: dict of (motion, model): design matrix for the run
+    :param run_effs: design x contrast efficiencies, rows in the order of run_designs
+    :return: tuple of a dict of perm_key(): list of the beta, var and residvar paths saved (nifti) and a dict of
+        map name: masked float32 map to save to the map store (hdf5)
+    """
+    print(f'\t\t 4/5 Mask Image, Fit GLM models ar1 autocorrelation, fwhm {fwhm}')
+    saved, maps = {}, {}
+    if smooth_cache is not None:
+        # smoothed data pulled from cache, smoothed once for the run + fwhm
+        smooth_dat = smooth_cache.get(run=run, fwhm=fwhm, mask_label=mask_label,
+                                      bold_img=bold_inp, mask_img=mask_inp)
+    elif engine == 'batch':
+        smooth_dat = smooth_masked_bold(bold_img=bold_inp, mask_img=mask_inp, fwhm=fwhm)
+    if engine == 'batch' and fwhm_models:
+        # all designs for fwhm fit at once to the shared smoothed BOLD
+        glm_est = fit_batch_glm(Y=smooth_dat, design_matrices=[run_designs[mod] for mod in fwhm_models],
+                                contrast_weights=contrast_weights, noise_model='ar1', dtype=precision)
+
+    for mod_i, (motion, model) in enumerate(fwhm_models):
+        if engine == 'nilearn':
+            if smooth_cache is not None:
+                fit_inp, fit_fwhm = unmask_bold(smooth_dat, mask_inp), None
             else:
-                print("Assuming AHRB sample, continuing")
-            # get path to confounds from fmriprep, func data + mask
-            # set image path
-            conf_path = f'{fmriprep_path}/{subj}/ses-{ses}/func/{subj}_ses-{ses}_task-{task}_run-{run}' \
-                    f'_desc-confounds_timeseries.tsv'
-            nii_path = glob(
-            f'{fmriprep_path}/{subj}/ses-{ses}/func/{subj}_ses-{ses}_task-{task}_run-{run}'
-            f'_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz')[0]
-            print('\t\t 2/5 Create Regressors & Design Matrix for GLM')
-            # get list of regressors
-            # run to create design matrix
-            conf_regressors = pull_regressors(confound_path=conf_path, regressor_type=motion, sample=sample)
-            design_matrix = create_design_mid(events_df=events_df, bold_tr=boldtr, num_volumes=numvols,
-                                              onset_label=model_types[model][0],
-                                              duration_label=model_types[model][1],
-                                              conf_regressors=conf_regressors,
-                                              hrf_model='spm', stc=stc)
-            print('\t\t 3/5 Estimate design efficiency')
-            # efficiency estimates
-            con_matrix = pd.DataFrame(columns=design_matrix.columns)
-            con_weight_series = []
-            for contrast_name, contrast_dict in contrast_weights.items():
-                df = pd.DataFrame([contrast_dict], columns=design_matrix.columns, index=[contrast_name])
-                con_weight_series.append(df)
-
-            # Concatenate series
-            con_matrix = pd.concat(con_weight_series)
-            con_matrix = con_matrix.fillna(0)
-
-            print(f'\t\t\t size of design matrix: {design_matrix.shape} & contrast matrix: {con_matrix.shape}')
-            series_eff = pd.DataFrame(
-                np.hstack((model, run, eff_estimator(np.array(design_matrix), np.array(con_matrix)))
-                          ).reshape(1, -1),
-                columns=[np.hstack(('model', 'run', list(contrast_weights.keys())))]
-            )
-            comb_eff = pd.concat([comb_eff, series_eff],ignore_index=True)
-            eff_out_path = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_efficiency.tsv'
-            comb_eff.to_csv(eff_out_path, index=False)
-            print('\t\t 4/5 Mask Image, Fit GLM model ar1 autocorrelation')
+                fit_inp, fit_fwhm = bold_inp, fwhm
             # using ar1 autocorrelation (FSL prewhitening), drift model
-            fmri_glm = FirstLevelModel(subject_label=subj, mask_img=brainmask,
-                                       t_r=boldtr, smoothing_fwhm=fwhm,
+            fmri_glm = FirstLevelModel(subject_label=subj, mask_img=mask_inp,
+                                       t_r=boldtr, smoothing_fwhm=fit_fwhm,
                                        standardize=False, noise_model='ar1', drift_model=None, high_pass=None
                                        # cosine 0:3 included from fmriprep in design mat based on 128s calc
                                        )
             # Run GLM model using set paths and calculate design matrix
-            run_fmri_glm = fmri_glm.fit(nii_path, design_matrices=design_matrix)
-            print('\t\t 5/5: From GLM model, create z-score contrast maps and save to output path')
-            # contrast names and associated contrasts in contrasts defined is looped over
-            # contrast name is used in saving file, the contrast is used in deriving z-score
-            for con_name, con in contrasts.items():
-                mod_name = f'contrast-{con_name}_mask-{mask_label}_mot-{motion}_mod-{model}_fwhm-{fwhm}'
-                beta_name = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_{mod_name}_stat-beta.nii.gz'
+            run_fmri_glm = fmri_glm.fit(fit_inp, design_matrices=run_designs[(motion, model)])
+        print(f'\t\t 5/5: {motion}, {model}: From GLM model, create contrast maps and save to output path')
+        des_i = list(run_designs).index((motion, model))
+        # contrast names and associated contrasts in contrasts defined is looped over
+        # contrast name is used in saving file, the contrast is used in deriving z-score
+        for con_i, (con_name, con) in enumerate(contrasts.items()):
+            mod_name = f'contrast-{con_name}_mask-{mask_label}_mot-{motion}_mod-{model}_fwhm-{fwhm}'
+            if out_store == 'hdf5':
+                if engine == 'batch':
+                    beta_vec, var_vec = glm_est['effect'][mod_i, con_i], glm_est['variance'][mod_i, con_i]
+                else:
+                    beta_vec = masked_bold(run_fmri_glm.compute_contrast(con, output_type='effect_size'),
+                                           mask_inp).ravel()
+                    var_vec = masked_bold(run_fmri_glm.compute_contrast(con, output_type='effect_variance'),
+                                          mask_inp).ravel()
+                map_name = f'{subj}_ses-{ses}_task-{task}_run-{run}_{mod_name}'
+                maps[f'{map_name}_stat-beta'] = beta_vec.astype(np.float32)
+                maps[f'{map_name}_stat-var'] = var_vec.astype(np.float32)
+                maps[f'{map_name}_stat-residvar'] = (var_vec * run_effs[des_i, con_i]).astype(np.float32)
+                continue
+            if engine == 'batch':
+                beta_est = unmask_bold(glm_est['effect'][mod_i, con_i], mask_inp)
+                var_est = unmask_bold(glm_est['variance'][mod_i, con_i], mask_inp)
+            else:
                 beta_est = run_fmri_glm.compute_contrast(con, output_type='effect_size')
-                beta_est.to_filename(beta_name)
-                # Calc: variance
-                var_name = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_{mod_name}_stat-var.nii.gz'
                 var_est = run_fmri_glm.compute_contrast(con, output_type='effect_variance')
-                var_est.to_filename(var_name)
-                # Calc: residual variance
-                # since eff is inverse 1/2, reverse multiple 2/1 for residual var
-                var_data = var_est.get_fdata()
-                est_resvar = var_data * float(series_eff[con_name].values[0])
-                resvar_nii = nib.Nifti1Image(est_resvar, var_est.affine)
-                resvar_name = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_{mod_name}_stat-residvar.nii.gz'
-                nib.save(resvar_nii, resvar_name)
+                if precision == np.float32:
+                    beta_est, var_est = img_as_dtype(beta_est, precision), img_as_dtype(var_est, precision)
+            beta_name = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_{mod_name}_stat-beta.nii.gz'
+            beta_est.to_filename(beta_name)
+            # Calc: variance
+            var_name = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_{mod_name}_stat-var.nii.gz'
+            var_est.to_filename(var_name)
+            # Calc: residual variance
+            # since eff is inverse 1/2, reverse multiple 2/1 for residual var
+            var_data = var_est.get_fdata(dtype=precision)
+            est_resvar = var_data * run_effs[des_i, con_i]
+            resvar_nii = nib.Nifti1Image(est_resvar, var_est.affine)
+            resvar_name = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_{mod_name}_stat-residvar.nii.gz'
+            nib.save(resvar_nii, resvar_name)
+            saved[perm_key(run, fwhm, motion, model, con_name)] = [beta_name, var_name, resvar_name]
+    return saved, maps
+
+
+def perm_complete(run: str, fwhm: float, motion: str, model: str) -> bool:
+    # all contrast maps of the permutation are verified in the manifest (nifti) or written to the map store (hdf5)
+    if map_store is not None:
+        return all(map_store.contains(f'{subj}_ses-{ses}_task-{task}_run-{run}_contrast-{con_name}_mask-{mask_label}_'
+                                      f'mot-{motion}_mod-{model}_fwhm-{fwhm}_stat-{stat}')
+                   for con_name in contrasts for stat in ['beta', 'var', 'residvar'])
+    return all(manifest.is_complete(perm_key(run, fwhm, motion, model, con_name)) for con_name in contrasts)
+
+
+def save_outputs(saved: dict, maps: dict):
+    # main process bookkeeping of a finished fit: maps to the store, saved files to the manifest
+    if map_store is not None and maps:
+        map_store.write_many(maps)
+    if manifest is not None and saved:
+        manifest.record_many(saved)
+
+
+def pool_fit_fwhm_models(run: str, fwhm: float, fwhm_models: list, bold_spec: tuple, bold_affine, bold_header,
+                         mask_inp, run_designs: dict, run_effs: np.ndarray):
+    """
+    Worker process wrapper of fit_fwhm_models(), the BOLD data is read from shared memory (see share_array).
+    """
+    shm, bold_dat = attach_array(bold_spec)
+    try:
+        return fit_fwhm_models(run=run, fwhm=fwhm, fwhm_models=fwhm_models,
+                               bold_inp=nib.Nifti1Image(bold_dat, bold_affine, bold_header), mask_inp=mask_inp,
+                               run_designs=run_designs, run_effs=run_effs)
+    finally:
+        del bold_dat
+        shm.close()
+
+
+for run in runs:
+    print(f'\tStarting {subj} {run}.')
+    # get path to confounds from fmriprep, func data + mask
+    # set image path
+    conf_path = f'{fmriprep_path}/{subj}/ses-{ses}/func/{subj}_ses-{ses}_task-{task}_run-{run}' \
+                f'_desc-confounds_timeseries.tsv'
+    nii_path = glob(
+        f'{fmriprep_path}/{subj}/ses-{ses}/func/{subj}_ses-{ses}_task-{task}_run-{run}'
+        f'_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz')[0]
+
+    print('\t 1/5 Load events')
+    # import behavior events .tsv from data path
+    events_df = pd.read_csv(f'{beh_path}/{subj}/ses-{ses}/func/{subj}_ses-{ses}_task-{task}_run-{run}_events.tsv',
+                            sep='\t')
+    if sample == 'abcd':
+        events_df = events_df.rename(columns=dict_renamecols_abcd)
+        events_df['TRIAL_TYPE'] = events_df['TRIAL_TYPE'].replace(dict_rename_cuetype)
+    elif sample == 'MLS':
+        events_df = events_df.rename(columns=dict_renamecols_mls)
+        events_df['TRIAL_TYPE'] = events_df['TRIAL_TYPE'].replace(dict_rename_cuetype)
+    else:
+        print("Assuming AHRB sample, continuing")
+
+    print('\t 2/5 Create Regressors & Design Matrix for GLM')
+    # design matrices only vary by motion x model type, so they're created once and shared across fwhm
+    run_designs = {}
+    for motion, model in product(motion_opt, modtype_opt):
+        exclude_subject = (
+                (excl_subs[excl_subs[0] == subj][1].values == 1).any() and
+                motion in ["opt3", "opt4"]
+        )
+        if exclude_subject:
+            continue
+        # get list of regressors
+        # run to create design matrix
+        conf_regressors = pull_regressors(confound_path=conf_path, regressor_type=motion, sample=sample)
+        run_designs[(motion, model)] = create_design_mid(events_df=events_df, bold_tr=boldtr, num_volumes=numvols,
+                                                         onset_label=model_types[model][0],
+                                                         duration_label=model_types[model][1],
+                                                         conf_regressors=conf_regressors,
+                                                         hrf_model='spm', stc=stc)
+
+    print('\t 3/5 Estimate design efficiency')
+    # efficiency estimates for all designs at once, one row per design x contrast
+    run_effs = eff_estimator_batch(desmats=list(run_designs.values()),
+                                   contrast_matrices=[contrast_vectors(design_matrix, contrast_weights)
+                                                      for design_matrix in run_designs.values()])
+    eff_out_path = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_efficiency.tsv'
+    eff_long_path = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_run-{run}_efficiency-long.tsv'
+    if manifest is not None and manifest.is_complete(f'run-{run}_efficiency'):
+        print(f'\t\t {os.path.basename(eff_out_path)} complete in manifest, skipping')
+    else:
+        # one row per fwhm x motion x model permutation (in permutation_list order), one column per contrast,
+        # comma separated as read in run-analyses.ipynb. Efficiencies don't depend on fwhm, rows repeat across fwhm
+        design_i = {design: des_i for des_i, design in enumerate(run_designs)}
+        comb_eff = pd.DataFrame(
+            [[model, run] + list(run_effs[design_i[(motion, model)]])
+             for _, motion, model in permutation_list if (motion, model) in design_i],
+            columns=['model', 'run'] + list(contrast_weights.keys())
+        )
+        comb_eff.to_csv(eff_out_path, index=False)
+        # tidy table, one row per design x contrast, the layout of the sample-level efficiency TSVs
+        long_eff = pd.DataFrame(
+            [(subj, run, motion, model, con_name, run_effs[des_i, con_i])
+             for des_i, (motion, model) in enumerate(run_designs)
+             for con_i, con_name in enumerate(contrast_weights)],
+            columns=['subject', 'run', 'motion', 'model', 'con', 'eff_est']
+        )
+        long_eff.to_csv(eff_long_path, sep='\t', index=False)
+        if manifest is not None:
+            manifest.record(f'run-{run}_efficiency', [eff_out_path, eff_long_path])
+
+    count = 0
+    run_tasks = []
+    for fwhm, fwhm_perms in groupby(permutation_list, key=lambda perm: perm[0]):
+        # all motion x model permutations of this fwhm are fit to the same smoothed BOLD
+        fwhm_models = []
+        for _, motion, model in fwhm_perms:
+            count = count + 1
+            if (motion, model) not in run_designs:
+                print("\t\t {} aCompCor ROI flag excluded for model {}, {}, {}".format(subj, fwhm, motion, model))
+                continue
+            if manifest is not None and perm_complete(run, fwhm, motion, model):
+                print('\t\t {}. Outputs complete, skipping: {}, {}, {}'.format(count, fwhm, motion, model))
+                continue
+            print('\t\t {}. Running model using: {}, {}, {}'.format(count, fwhm, motion, model))
+            print(f'\t\t\t size of design matrix: {run_designs[(motion, model)].shape}')
+            fwhm_models.append((motion, model))
+        if not fwhm_models:
+            continue
+        # designs sharing a smoothed BOLD (batch engine/smooth cache) are one task, otherwise one per permutation
+        if n_jobs > 1 and smooth_cache is None:
+            run_tasks += [(fwhm, [mod]) for mod in fwhm_models]
+        else:
+            run_tasks.append((fwhm, fwhm_models))
+
+    if not run_tasks:
+        print(f'\t All permutations of {subj} {run} are complete')
+        continue
+
+    if inmem:
+        # BOLD is decompressed + mask resolved once per run, instead of per permutation
+        print(f'\t Loading {os.path.basename(nii_path)} into memory')
+        bold_inp, mask_inp = load_bold_run(nii_path=nii_path, mask_img=brainmask,
+                                           dtype=precision if precision == np.float32 else None)
+    else:
+        bold_inp, mask_inp = nii_path, brainmask
+    if smooth_cache is not None:
+        smooth_cache.clear()
+
+    if args.check_precision and precision == np.float32 and engine == 'batch':
+        check_fwhm, check_models = run_tasks[0]
+        check_diff = compare_precision(Y=smooth_masked_bold(bold_img=bold_inp, mask_img=mask_inp, fwhm=check_fwhm),
+                                       design_matrices=[run_designs[mod] for mod in check_models],
+                                       contrast_weights=contrast_weights, dtype=precision, noise_model='ar1')
+        print(f'\t float32 vs float64 max relative difference, fwhm {check_fwhm}: '
+              f'effect {check_diff["effect"]:.2e}, variance {check_diff["variance"]:.2e}')
+        if max(check_diff.values()) > 1e-4:
+            print('\t WARNING: float32 estimates differ from float64 by more than 1e-4, consider --precision float64')
+
+    if n_jobs > 1:
+        # estimated peak per worker: smoothed copy of the 4D BOLD + masked data and GLM estimates
+        n_vox = int(np.asarray(mask_inp.dataobj).astype(bool).sum())
+        worker_bytes = bold_inp.dataobj.nbytes + np.dtype(precision).itemsize * n_vox * \
+            (3 * numvols + 2 * len(run_designs) * len(contrasts))
+        n_workers = workers_for_budget(n_jobs=n_jobs, max_mem=max_mem, worker_bytes=worker_bytes,
+                                       shared_bytes=bold_inp.dataobj.nbytes)
+        print(f'\t Running {len(run_tasks)} fits on {n_workers} workers')
+        shm, bold_spec = share_array(np.asanyarray(bold_inp.dataobj))
+        # the parent doesn't fit models, only the shared copy is kept so the BOLD is held once, as budgeted
+        bold_affine, bold_header = bold_inp.affine, bold_inp.header
+        bold_inp = None
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = [executor.submit(pool_fit_fwhm_models, run=run, fwhm=fwhm, fwhm_models=fwhm_models,
+                                           bold_spec=bold_spec, bold_affine=bold_affine,
+                                           bold_header=bold_header, mask_inp=mask_inp,
+                                           run_designs=run_designs, run_effs=run_effs)
+                           for fwhm, fwhm_models in run_tasks]
+                for future in as_completed(futures):
+                    save_outputs(*future.result())
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        for fwhm, fwhm_models in run_tasks:
+            save_outputs(*fit_fwhm_models(run=run, fwhm=fwhm, fwhm_models=fwhm_models, bold_inp=bold_inp,
+                                          mask_inp=mask_inp, run_designs=run_designs, run_effs=run_effs))
+
+if map_store is not None:
+    map_store.close()
@@ -2,19 +2,31 @@ import warnings
 warnings.filterwarnings("ignore")
 warnings.filterwarnings("ignore", category=UserWarning,
                         message="A NumPy version >=1.18.5 and <1.25.0 is required for this version of SciPy*")
+import sys
 import os
 import argparse
+import multiprocessing
 import numpy as np
 import pandas as pd
-from glob import glob
+import nibabel as nib
 from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from nilearn.glm import compute_fixed_effects
 
+# Getpath to Stage2 scripts
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_dir)
+from Stage2_Code.perm_pool import workers_for_budget
+from Stage2_Code.resume_manifest import OutputManifest
+from Stage2_Code.bold_cache import img_as_dtype, unmask_bold
+from Stage2_Code.fixedeff_batch import run_maps_mask, load_run_maps, fixed_effects_batch
+from Stage2_Code.map_store import MaskedMapStore
+from Stage2_Code.bids_index import FileIndex, parse_entities
 
 
 def fixed_effect(subject: str, session: str, task_type: str,
-                 contrast_list: list, firstlvl_indir: str, fixedeffect_outdir: str,
-                 model_permutation: str, save_beta=False, save_var=False, save_tstat=True):
+                 contrast_maps: dict, fixedeffect_outdir: str,
+                 model_permutation: str, save_beta=False, save_var=False, save_tstat=True, dtype=None):
     """
     This function takes in a subject, task label, set of computed contrasts using nilearn,
     the path to contrast estimates (beta maps), the output path for fixed effec tmodels and
@@ -25,21 +37,19 @@ def fixed_effect(subject: str, session: str, task_type: str,
     :param subject: string-Input subject label, BIDS leading label, e.g., sub-01
     :param session: string-Input session label, BIDS label e.g., ses-1
     :param task_type: string-Input task label, BIDS label e.g., mid
-    :param contrast_list: list of contrast types that are saved from first level
+    :param contrast_maps: dict of contrast: (list of run beta paths, list of run var paths) from first level,
+        resolved by the caller so worker processes don't query the file index
     :param model_permutation: complete string of model permutation, e.g., 'fwhm-4_mot-opt1_mod-AntMod'
-    :param firstlvl_indir: string-location of first level output files
     :param fixedeffect_outdir: string-location to save fixed effects
     :param save_beta: Whether to save 'effects' or beta values, default = False
     :param save_var: Whether to save 'variance' or beta values, default = False
     :param save_tstat: Whether to save 'tstat', default = True
-    :return: nothing return, files are saved
+    :param dtype: dtype of the saved maps, e.g. np.float32, default None (as returned by nilearn)
+    :return: dict of contrast: (list of saved paths, list of input beta + var paths)
     """
-    for contrast in contrast_list:
+    saved = {}
+    for contrast, (betas, var) in contrast_maps.items():
         print(f"\t\t\t Creating weighted fix-eff model for contrast: {contrast}")
-        betas = sorted(glob(f'{firstlvl_indir}/{subject}_ses-{session}_task-{task_type}_run-*_'
-                            f'contrast-{contrast}_{model_permutation}_stat-beta.nii.gz'))
-        var = sorted(glob(f'{firstlvl_indir}/{subject}_ses-{session}_task-{task_type}_run-*_'
-                          f'contrast-{contrast}_{model_permutation}_stat-var.nii.gz'))
         # conpute_fixed_effects options
         # (1) contrast map of the effect across runs;
         # (2) var map of between runs effect;
@@ -47,21 +57,30 @@ def fixed_effect(subject: str, session: str, task_type: str,
         fix_effect, fix_var, fix_tstat = compute_fixed_effects(contrast_imgs=betas,
                                                                variance_imgs=var,
                                                                precision_weighted=True)
+        if dtype is not None:
+            fix_effect, fix_var, fix_tstat = [img_as_dtype(img, dtype) for img in [fix_effect, fix_var, fix_tstat]]
         if not os.path.exists(fixedeffect_outdir):
-            os.makedirs(fixedeffect_outdir)
+            # exist_ok, permutations may run in parallel worker processes
+            os.makedirs(fixedeffect_outdir, exist_ok=True)
             print("Directory created:", fixedeffect_outdir)
+        out_paths = []
         if save_beta:
             fix_effect_out = f'{fixedeffect_outdir}/{subject}_ses-{session}_task-{task_type}_' \
                              f'contrast-{contrast}_{model_permutation}_stat-effect.nii.gz'
             fix_effect.to_filename(fix_effect_out)
+            out_paths.append(fix_effect_out)
         if save_var:
             fix_var_out = f'{fixedeffect_outdir}/{subject}_ses-{session}_task-{task_type}_' \
                           f'contrast-{contrast}_{model_permutation}_stat-var.nii.gz'
             fix_var.to_filename(fix_var_out)
+            out_paths.append(fix_var_out)
         if save_tstat:
             fix_tstat_out = f'{fixedeffect_outdir}/{subject}_ses-{session}_task-{task_type}_' \
                             f'contrast-{contrast}_{model_permutation}_stat-tstat.nii.gz'
             fix_tstat.to_filename(fix_tstat_out)
+            out_paths.append(fix_tstat_out)
+        saved[contrast] = (out_paths, betas + var)
+    return saved
 
 
 parser = argparse.ArgumentParser(description="Script to run first level task models w/ nilearn")
@@ -77,8 +96,24 @@ parser.add_argument("--mask", help="path the to a binarized brain mask (e.g., MN
 parser.add_argument("--mask_label", help="label for mask, e.g. mni152, subtresh, suprathresh, yeo-network",
                     default=None)
 parser.add_argument("--output", help="output folder where to write out and save information")
+parser.add_argument("--file_index", help="path to the file index of --firstlvl_inp (SQLite, updated on each run for "
+                                         "the folders that changed), default in $TMPDIR",
+                    default=None)
 parser.add_argument("--excl", help="TSV file with Subjects Inclusion(0)+exclusion for acompcor=1=",
                     default=None)
+parser.add_argument("--engine", help="fixed effects engine: nilearn (compute_fixed_effects per contrast x "
+                                     "permutation) or batch (all run-level maps loaded once, all contrasts x "
+                                     "permutations combined at once; reads the first level .h5 map store if present). "
+                                     "When the map store is present, batch is used",
+                    choices=['nilearn', 'batch'], default='nilearn')
+parser.add_argument("--n_jobs", help="N of worker processes to spread the permutations across, default 1",
+                    type=int, default=1)
+parser.add_argument("--max_mem", help="memory budget in GB that limits how many workers run at once, default None",
+                    type=float, default=None)
+parser.add_argument("--precision", help="float precision of the saved fixed effect maps, float64 (default) or float32",
+                    choices=['float64', 'float32'], default='float64')
+parser.add_argument("--resume", help="skip outputs recorded as complete (size + sha256) in the subject's manifest, "
+                                     "redo only missing or corrupt ones", action="store_true")
 
 args = parser.parse_args()
 
@@ -92,6 +127,12 @@ brainmask = args.mask
 mask_label = args.mask_label
 scratch_out = args.output
 excl_list = args.excl
+n_jobs = args.n_jobs
+max_mem = args.max_mem
+precision = np.float32 if args.precision == 'float32' else None
+engine = args.engine
+manifest = OutputManifest(f'{scratch_out}/{subj}_ses-{ses}_task-{task}_desc-fixedeff_manifest.json') \
+    if args.resume else None
 
 # contrast & permutation list
 contrasts = [
@@ -126,7 +167,97 @@ else:
     # empty DataFrame with 2 columns
     excl_subs = pd.DataFrame(columns=[0, 1])
 
+
+def record_saved(mod_name: str, saved: dict):
+    # records the fixed effect maps of each contrast with the run-level maps they were computed from
+    manifest.record_many({f'{mod_name}_contrast-{contrast}': out_paths for contrast, (out_paths, _) in saved.items()},
+                         inputs={f'{mod_name}_contrast-{contrast}': inputs
+                                 for contrast, (_, inputs) in saved.items()})
+
+
+# run-level maps of the subject, listed once: from the first level map store if present, else the .nii.gz files
+run_prefix = f'{subj}_ses-{ses}_task-{task}_run-'
+firstlvl_store = f'{firstlvl_inp}/{subj}_ses-{ses}_task-{task}_desc-firstlvl_maps.h5'
+if os.path.exists(firstlvl_store):
+    with MaskedMapStore(firstlvl_store, mode='r') as store:
+        firstlvl_maps = {name: name for name in store.names()}
+    if engine != 'batch':
+        # compute_fixed_effects reads .nii.gz files, the store's maps are only read by the batch engine
+        print(f'\t Run-level maps are in {firstlvl_store}, using the batch engine')
+        engine = 'batch'
+else:
+    firstlvl_store = None
+    with FileIndex(root=firstlvl_inp, index_path=args.file_index) as file_index:
+        sub_maps = file_index.frame(directory=file_index.root, sub=parse_entities(subj)['sub'], ses=ses, task=task)
+    sub_maps = sub_maps[sub_maps['run'].notna() & sub_maps['name'].str.endswith('.nii.gz')]
+    firstlvl_maps = dict(zip(sub_maps['name'].str[:-len('.nii.gz')], sub_maps['path']))
+run_labels = sorted({parse_entities(name)['run'] for name in firstlvl_maps})
+
+
+def run_stat_maps(mod_name: str, contrast: str, stat: str) -> list:
+    # run-level maps (paths or map store names) of a contrast x permutation x stat, over the runs found
+    names = [f'{run_prefix}{run}_contrast-{contrast}_{mod_name}_stat-{stat}' for run in run_labels]
+    return [firstlvl_maps[name] for name in names if name in firstlvl_maps]
+
+
+def run_map_inputs(mod_name: str, contrast: str) -> list:
+    # beta + var run-level maps of a contrast x permutation
+    return run_stat_maps(mod_name, contrast, 'beta') + run_stat_maps(mod_name, contrast, 'var')
+
+
+def contrast_run_maps(mod_name: str, contrasts: list) -> dict:
+    # fixed_effect() inputs: contrast: (run beta paths, run var paths)
+    return {contrast: (run_stat_maps(mod_name, contrast, 'beta'), run_stat_maps(mod_name, contrast, 'var'))
+            for contrast in contrasts}
+
+
+def pending_contrasts(mod_name: str) -> list:
+    # contrasts of the permutation that aren't complete in the manifest for the current run-level maps
+    if manifest is None:
+        return list(contrasts)
+    return [contrast for contrast in contrasts
+            if not manifest.is_complete(f'{mod_name}_contrast-{contrast}', inputs=run_map_inputs(mod_name, contrast))]
+
+
+def batch_fixed_effects(map_items: list) -> dict:
+    """
+    Loads the run-level beta + var maps of all contrast x permutation items once (run x map x voxel) and combines
+    them with fixed_effects_batch(). The effect and var maps are saved as fixed_effect() saves them.
+
+    :param map_items: list of (model permutation, contrast) with beta + var maps for every run
+    :return: dict of (model permutation, contrast): (list of saved paths, list of input maps)
+    """
+    dtype = np.float64 if precision is None else precision
+    names = {stat: [[f'{run_prefix}{run}_contrast-{contrast}_{mod_name}_stat-{stat}' for mod_name, contrast in map_items]
+                    for run in run_labels] for stat in ['beta', 'var']}
+    if firstlvl_store is not None:
+        with MaskedMapStore(firstlvl_store, mode='r') as store:
+            mask_img = nib.Nifti1Image(store.mask.astype(np.uint8), store.affine)
+            run_maps = {stat: np.stack([np.stack([store.read_vector(name) for name in run_names]).astype(dtype)
+                                        for run_names in names[stat]]) for stat in names}
+    else:
+        var_paths = [firstlvl_maps[run_names[0]] for run_names in names['var']]
+        mask = run_maps_mask(var_paths)
+        mask_img = nib.Nifti1Image(mask.astype(np.uint8), nib.load(var_paths[0]).affine)
+        run_maps = {stat: load_run_maps([[firstlvl_maps[name] for name in run_names] for run_names in names[stat]],
+                                        mask=mask, dtype=dtype) for stat in names}
+    print(f'\t Loaded {len(run_labels)} runs x {len(map_items)} beta + var maps, combining fixed effects')
+    fix_effect, fix_var, _ = fixed_effects_batch(betas=run_maps['beta'], variances=run_maps['var'])
+
+    os.makedirs(scratch_out, exist_ok=True)
+    saved = {}
+    for map_i, (mod_name, contrast) in enumerate(map_items):
+        out_paths = []
+        for stat, fix_dat in [('effect', fix_effect), ('var', fix_var)]:
+            out_path = f'{scratch_out}/{subj}_ses-{ses}_task-{task}_contrast-{contrast}_{mod_name}_stat-{stat}.nii.gz'
+            unmask_bold(fix_dat[map_i], mask_img).to_filename(out_path)
+            out_paths.append(out_path)
+        saved[(mod_name, contrast)] = (out_paths, run_map_inputs(mod_name, contrast))
+    return saved
+
+
 count = 0
+perm_names = []
 for fwhm, motion, model in permutation_list:
     count = count + 1
     exclude_subject = (
@@ -136,9 +267,53 @@ for fwhm, motion, model in permutation_list:
     if exclude_subject:
         print("\t\t {} aCompCor ROI flag excluded for model {}, {}, {}".format(subj, fwhm, motion, model))
     else:
+        mod_name = f'mask-{mask_label}_mot-{motion}_mod-{model}_fwhm-{fwhm}'
+        perm_contrasts = pending_contrasts(mod_name)
+        if not perm_contrasts:
+            print('\t\t {}. Complete in manifest, skipping: {}, {}, {}'.format(count, fwhm, motion, model))
+            continue
         print('\t\t {}. Running model using: {}, {}, {}'.format(count, fwhm, motion, model))
+        perm_names.append((mod_name, perm_contrasts))
 
-        mod_name = f'mask-{mask_label}_mot-{motion}_mod-{model}_fwhm-{fwhm}'
-        fixed_effect(subject=subj, session=ses, task_type=task,
-                     contrast_list=contrasts, firstlvl_indir=firstlvl_inp, fixedeffect_outdir=scratch_out,
-                     model_permutation=mod_name, save_beta=True, save_var=True, save_tstat=False)
+if engine == 'batch' and perm_names:
+    # contrasts x permutations with maps for all runs are combined at once, others use compute_fixed_effects
+    map_items = [(mod_name, contrast) for mod_name, perm_contrasts in perm_names for contrast in perm_contrasts
+                 if len(run_map_inputs(mod_name, contrast)) == 2 * len(run_labels)]
+    if map_items:
+        batch_saved = batch_fixed_effects(map_items)
+        if manifest is not None:
+            for mod_name, perm_contrasts in perm_names:
+                record_saved(mod_name, {contrast: batch_saved[(mod_name, contrast)] for contrast in perm_contrasts
+                                        if (mod_name, contrast) in batch_saved})
+    perm_names = [(mod_name, [contrast for contrast in perm_contrasts if (mod_name, contrast) not in map_items])
+                  for mod_name, perm_contrasts in perm_names]
+    perm_names = [(mod_name, perm_contrasts) for mod_name, perm_contrasts in perm_names if perm_contrasts]
+    if perm_names and firstlvl_store is not None:
+        print(f'\t {len(perm_names)} permutations have run-level maps missing in {firstlvl_store}, skipping')
+        perm_names = []
+
+if n_jobs > 1 and perm_names:
+    # estimated peak per worker: beta + var of each run and the three fixed effect maps, float64
+    first_beta = run_stat_maps(perm_names[0][0], contrasts[0], 'beta')
+    img_bytes = 8 * np.prod(nib.load(first_beta[0]).shape) if first_beta else 0
+    n_workers = workers_for_budget(n_jobs=n_jobs, max_mem=max_mem,
+                                   worker_bytes=img_bytes * (2 * max(len(first_beta), 1) + 3))
+    print(f'\t Running {len(perm_names)} fixed effect models on {n_workers} workers')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(fixed_effect, subject=subj, session=ses, task_type=task,
+                                   contrast_maps=contrast_run_maps(mod_name, perm_contrasts),
+                                   fixedeffect_outdir=scratch_out, model_permutation=mod_name,
+                                   save_beta=True, save_var=True, save_tstat=False, dtype=precision): mod_name
+                   for mod_name, perm_contrasts in perm_names}
+        for future in as_completed(futures):
+            saved = future.result()
+            if manifest is not None:
+                record_saved(futures[future], saved)
+else:
+    for mod_name, perm_contrasts in perm_names:
+        saved = fixed_effect(subject=subj, session=ses, task_type=task,
+                             contrast_maps=contrast_run_maps(mod_name, perm_contrasts),
+                             fixedeffect_outdir=scratch_out, model_permutation=mod_name,
+                             save_beta=True, save_var=True, save_tstat=False, dtype=precision)
+        if manifest is not None:
+            record_saved(mod_name, saved)
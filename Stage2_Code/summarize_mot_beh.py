@@ -0,0 +1,52 @@
+import sys
+import os
+import argparse
+import pandas as pd
+from glob import glob
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# Getpath to Stage2 scripts
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_dir)
+from Stage2_Code.extract_values import mot_beh_summary, write_summary, SUMMARY_COLS
+
+
+def subject_summary(subj: str, input_dir: str, ses: str, task: str) -> dict:
+    # summary row of a subject, missing confounds / beh-descr.json values are NaN
+    deriv_path = f'{input_dir}/{subj}/ses-{ses}/func'
+    if not os.path.isdir(deriv_path):
+        print(f"\t {subj}: {deriv_path} missing, values set to NaN")
+    return mot_beh_summary(deriv_path=deriv_path, subject=subj, ses=ses, task=task, missing_ok=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script to summarize mean FD, accuracy and mean RT of run-01/run-02 "
+                                                 "for all subjects into one table, as extract_values.py per subject")
+    parser.add_argument("--input", help="Path to the fmriprep output with {sub}/ses-{ses}/func confounds and "
+                                        "beh-descr.json files")
+    parser.add_argument("--task", help="task type -- e.g., mid, reward, etc")
+    parser.add_argument("--ses", help="session, include the session type without prefix, e.g., 1, 01, baselinearm1")
+    parser.add_argument("--sub_list", help="subject list, one sub- ID per line. Default None, "
+                                           "all sub-* folders in --input", default=None)
+    parser.add_argument("--n_jobs", help="N of worker processes, default 1", type=int, default=1)
+    parser.add_argument("--output", help="output file, .parquet (columnar, requires pyarrow), .tsv or .csv. "
+                                         "Written to a temporary file and renamed when complete")
+    args = parser.parse_args()
+
+    if args.sub_list is not None:
+        with open(args.sub_list, "r") as file:
+            subjects = [line.strip() for line in file if line.strip()]
+    else:
+        subjects = sorted(os.path.basename(sub_dir) for sub_dir in glob(f'{args.input}/sub-*')
+                          if os.path.isdir(sub_dir))
+
+    print(f"Summarizing motion and behavior for {len(subjects)} subjects with {args.n_jobs} workers")
+    subj_summary = partial(subject_summary, input_dir=args.input, ses=args.ses, task=args.task)
+    with ProcessPoolExecutor(max_workers=args.n_jobs) as executor:
+        summ_df = pd.DataFrame(list(executor.map(subj_summary, subjects,
+                                                 chunksize=max(1, len(subjects) // (args.n_jobs * 4)))),
+                               columns=SUMMARY_COLS)
+
+    write_summary(summ_df, args.output)
+    print(f"Saved {len(summ_df)} subject summaries to {args.output}")
@@ -1,30 +1,22 @@
 import argparse
 import os
-from pynv import Client
-import pandas as pd
-
-
-class NewClient(Client):
-    def update_image(self, image_id, file, **data):
-        files = {'file': open(file, 'rb')}
-        return self.request(
-            'patch',
-            f'images/{image_id}',
-            data=data,
-            files=files
-        ).json()
-    def delete_image(self, image_id):
-        return self.request(
-            'delete',
-            f'images/{image_id}'
-        )
+import sys
+
+# Getpath to Stage2 scripts
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_dir)
+from Stage2_Code.bids_index import parse_entities
+from Stage2_Code.neurovault_client import NeuroVaultSession, UploadManifest, upload_images, collection_images, \
+    delete_images, NEUROVAULT_API
 
 
 def del_collection_images(collection_number: int, est_type: list = None,
-                          offset_start: int = 0, limit_batch: int = 10):
+                          offset_start: int = 0, limit_batch: int = 100, n_workers: int = 8,
+                          rate: float = None, dry_run: bool = False, api_client: NeuroVaultSession = None):
     """
-    Fetches images from a collection, optionally filters by estimate types,
-    and deletes them using provided API methods.
+    Lists the images of a collection with collection_images() (pages fetched concurrently after
+    the first), optionally filters them by estimate types, and deletes them with delete_images()
+    (deletes run in parallel, rate limited).
 
     Args:
         collection_number (int): Identifier for the collection of images.
@@ -33,41 +25,33 @@ def del_collection_images(collection_number: int, est_type: list = None,
         offset_start (int, optional): Starting offset for fetching images in batches.
                                       Defaults to 0.
         limit_batch (int, optional): Number of images to fetch per batch.
-                                     Defaults to 10.
+                                     Defaults to 100.
+        n_workers (int, optional): Number of concurrent page fetches / deletes. Defaults to 8.
+        rate (float, optional): Max number of deletes started per second. Defaults to None (no limit).
+        dry_run (bool, optional): Only report the images that would be deleted. Defaults to False.
+        api_client (NeuroVaultSession, optional): Client to use. Defaults to None (the script's api).
 
     Returns:
         tuple: A tuple containing two DataFrames:
-            - dat_full (pd.DataFrame): DataFrame containing all fetched images & associated details.
-            - dat_sub (pd.DataFrame): DataFrame containing filtered images filted by est_type (if none, same as dat_full.
+            - dat_full: the collection_images() listing, one row per image (id, name, estimate_type, ...).
+            - dat_sub: the images selected by est_type (if none, all of dat_full), with the delete_images()
+              report columns status ('deleted', 'failed' or 'dry_run') and error.
     """
-    collection = collection_number
-    offset = offset_start
-    limit = limit_batch
-    dat_full = pd.DataFrame()
-    while True:
-        try:
-            i = api.get_collection_images(collection_id=collection, limit=limit, offset=offset)
-            # Convert the current batch of results to a DataFrame & concatenate with previous
-            batch_df = pd.DataFrame(i['results'])
-            dat_full = pd.concat([dat_full, batch_df], ignore_index=True)
-            # Update the offset for the next batch (running in batches of limit_batch)
-            offset += limit
-            # Check if all images have been fetched
-            if offset >= i['count']:
-                break  # Exit the loop if all images fetched
-        except Exception as e:
-            print(f"Error fetching images: {e}")
-            break
+    client = api_client if api_client is not None else api
+    dat_full = collection_images(client, collection_id=collection_number, limit=limit_batch,
+                                 offset_start=offset_start, n_workers=n_workers)
     dat_sub = dat_full.copy()
-    if est_type is not None:
+    if est_type is not None and not dat_sub.empty:
         dat_sub = dat_sub[dat_sub['estimate_type'].isin(est_type)]
-    for img_id in dat_sub['id']:
-        try:
-            api.delete_image(image_id=img_id)
-        except Exception as e:
-            print(f"Error for {img_id}: {e}")
+    report = delete_images(client, image_ids=dat_sub['id'].tolist() if not dat_sub.empty else [],
+                           n_workers=n_workers, rate=rate, dry_run=dry_run)
+    dat_sub = dat_sub.reset_index(drop=True)
+    dat_sub[['status', 'error']] = report[['status', 'error']]
+    status_counts = ', '.join(f'{n} {status}' for status, n in report['status'].value_counts().items())
+    print(f"{len(dat_sub)} of {len(dat_full)} images selected in collection {collection_number}: {status_counts}")
     return dat_full, dat_sub
 
+
 parser = argparse.ArgumentParser(description="Script to upload image maps to NeuroVault")
 
 parser.add_argument("--token", help="File with NeuroVault Token Information")
@@ -80,6 +64,21 @@ parser.add_argument("--new_coll", help="Whether to create new collection",
                     default=None)
 parser.add_argument("--coll_id", help="ID collection",
                     default=None)
+parser.add_argument("--n_jobs", help="N of concurrent uploads, default 8", type=int, default=8)
+parser.add_argument("--manifest", help="local record of uploaded file hashes -> image IDs, files already uploaded "
+                                       "to the collection are skipped on reruns, default "
+                                       "neurovault_upload_manifest.jsonl", default='neurovault_upload_manifest.jsonl')
+parser.add_argument("--retries", help="N of retries (with backoff) of connection errors, 429 and 5xx responses, "
+                                      "default 5", type=int, default=5)
+parser.add_argument("--api_url", help=f"NeuroVault API url, default {NEUROVAULT_API}", default=NEUROVAULT_API)
+parser.add_argument("--delete_est", help="delete the images of --coll_id instead of uploading: all, or a comma "
+                                         "separated list of estimate types, e.g. est,btwnsub", default=None)
+parser.add_argument("--dry_run", help="with --delete_est, only report the images that would be deleted",
+                    action="store_true")
+parser.add_argument("--delete_rate", help="max N of deletes per second, default None (no limit)", type=float,
+                    default=None)
+parser.add_argument("--report", help="with --delete_est, TSV report of the images and their delete status",
+                    default=None)
 
 args = parser.parse_args()
 
@@ -99,7 +98,7 @@ with open(nv_token, 'r') as file:
     # get token info
     token_info = file.read()
 
-api = Client(token_info.strip())
+api = NeuroVaultSession(token_info.strip(), base_url=args.api_url, pool_size=args.n_jobs, retries=args.retries)
 
 if create_coll is not None:
     collection_name = api.create_collection(f'{sample}: MNI152 3D maps for Multiverse Reliability')
@@ -107,64 +106,42 @@ if create_coll is not None:
 else:
     collection_id = args.coll_id
 
+if args.delete_est is not None:
+    _, delete_report = del_collection_images(collection_id, est_type=None if args.delete_est == 'all'
+                                             else args.delete_est.split(','), n_workers=args.n_jobs,
+                                             rate=args.delete_rate, dry_run=args.dry_run)
+    if args.report is not None:
+        delete_report.to_csv(args.report, sep='\t', index=False)
+    sys.exit(int((delete_report['status'] == 'failed').any()))
+
+
+def image_fields(img_basename: str, est_type: str, est: str = None) -> dict:
+    # NeuroVault fields of a group / ICC map, the estimate type is the stat- entity unless given
+    file_entities = parse_entities(img_basename)
+    return dict(name=f'{est_type}: {img_basename}', map_type='Other', modality='fMRI-BOLD', analysis='G',
+                sample_size=file_entities.get('subs'), target_template_image='GenericMNI',
+                type_design='event_related', cognitive_paradigm_cogatlas=task, task_paradigm=task_name,
+                estimate_type=est if est is not None else file_entities.get('stat'))
+
+
+uploads = []
 # add group images
 with open(grp_paths, 'r') as file:
-    est_type = 'Group'
-    est = 'cohens_d'
-    for img_path in file:
-        clean_path = img_path.strip()
-        img_basename = os.path.basename(clean_path)
-        file_details = img_basename.split('_')
-        subs = None
-        # Loop through each part of the path
-        for part in file_details:
-            if part.startswith('subs-'):
-                subs = part.split('-')[1]
-        image_name = f'{est_type}: {img_basename}'
-        image = api.add_image(collection_id, clean_path, name=image_name, map_type='Other',
-                              modality='fMRI-BOLD', analysis='G', sample_size={subs},
-                              target_template_image='GenericMNI', type_design='event_related',
-                              cognitive_paradigm_cogatlas=task, task_paradigm=task_name, estimate_type=est)
+    uploads += [(img_path.strip(), image_fields(os.path.basename(img_path.strip()), est_type='Group', est='cohens_d'))
+                for img_path in file if img_path.strip()]
 
 # Add ICC images
 with open(icc_paths, 'r') as file:
-    est_type = 'ICC'
-    for img_path in file:
-        clean_path = img_path.strip()
-        img_basename = os.path.basename(clean_path)
-        file_details = img_basename.split('_')
-        subs = None
-        stat = None
-        # Loop through each part of the path
-        for part in file_details:
-            if part.startswith('subs-'):
-                subs = part.split('-')[1]
-            if part.startswith('stat-'):
-                stat = part.split('-')[1]
-            image_name = f'{est_type}: {img_basename}'
-        image = api.add_image(collection_id, clean_path, name=image_name, map_type='Other',
-                              modality='fMRI-BOLD', analysis='G', sample_size={subs},
-                              target_template_image='GenericMNI', type_design='event_related',
-                              cognitive_paradigm_cogatlas=task, task_paradigm=task_name, estimate_type=stat)
+    uploads += [(img_path.strip(), image_fields(os.path.basename(img_path.strip()), est_type='ICC'))
+                for img_path in file if img_path.strip()]
 
 if subsample_paths is not None:
     with open(subsample_paths, 'r') as file:
-        est_type = 'SubsampleICC'
-        for img_path in file:
-            clean_path = img_path.strip()
-            img_basename = os.path.basename(clean_path)
-            file_details = img_basename.split('_')
-            subs = None
-            stat = None
-            # Loop through each part of the path
-            for part in file_details:
-                if part.startswith('subs-'):
-                    subs = part.split('-')[1]
-                if part.startswith('stat-'):
-                    stat = part.split('-')[1]
-                image_name = f'{est_type}: {img_basename}'
-            image = api.add_image(collection_id, clean_path, name=image_name, map_type='Other',
-                                  modality='fMRI-BOLD', analysis='G', sample_size={subs},
-                                  target_template_image='GenericMNI', type_design='event_related',
-                                  cognitive_paradigm_cogatlas=task, task_paradigm=task_name, estimate_type=stat)
-
+        uploads += [(img_path.strip(), image_fields(os.path.basename(img_path.strip()), est_type='SubsampleICC'))
+                    for img_path in file if img_path.strip()]
+
+image_ids, failed = upload_images(api, collection_id=collection_id, uploads=uploads,
+                                  manifest=UploadManifest(args.manifest), n_workers=args.n_jobs)
+print(f"{len(image_ids)} of {len(uploads)} images in collection {collection_id}, {len(failed)} failed")
+if failed:
+    sys.exit(1)
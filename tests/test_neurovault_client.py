@@ -0,0 +1,263 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pytest
+import requests
+
+# Getpath to Stage2 scripts
+project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_dir)
+from Stage2_Code.neurovault_client import NeuroVaultSession, RateLimiter, UploadManifest, upload_images, \
+    collection_images, delete_images
+
+
+class NeuroVaultStandIn(BaseHTTPRequestHandler):
+    """
+    Local stand-in of the NeuroVault endpoints used by neurovault_client. Each request takes the next scripted
+    failure of server.failures, if any: a status code (with an optional Retry-After) or 'drop' (the connection
+    is closed without a response).
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, obj=None, headers: dict = None):
+        body = json.dumps(obj).encode() if obj is not None else b''
+        self.send_response(code)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _failed(self) -> bool:
+        # logs the request, then sends its scripted failure
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path, time.monotonic()))
+            failure = server.failures.pop(0) if server.failures else None
+        if failure == 'drop':
+            self.close_connection = True
+            self.connection.close()
+        elif failure is not None:
+            status, retry_after = failure
+            self._send(status, {'detail': 'busy'}, {'Retry-After': retry_after} if retry_after else None)
+        return failure is not None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self._failed():
+            return
+        match = re.match(r'/api/collections/(\d+)/images/$', urlparse(self.path).path)
+        if match is None:
+            return self._send(404, {'detail': 'not found'})
+        name = re.search(rb'name="name"\r\n\r\n([^\r]*)', body).group(1).decode()
+        with self.server.lock:
+            image_id = len(self.server.images) + len(self.server.deleted) + 1
+            self.server.images[image_id] = {'id': image_id, 'collection': int(match.group(1)), 'name': name}
+        self._send(201, {'id': image_id, 'name': name})
+
+    def do_GET(self):
+        if self._failed():
+            return
+        url = urlparse(self.path)
+        match = re.match(r'/api/collections/(\d+)/images/$', url.path)
+        if match is None:
+            return self._send(404, {'detail': 'not found'})
+        query = parse_qs(url.query)
+        limit, offset = int(query.get('limit', [100])[0]), int(query.get('offset', [0])[0])
+        with self.server.lock:
+            images = sorted((image for image in self.server.images.values()
+                             if image['collection'] == int(match.group(1))), key=lambda image: image['id'])
+        self._send(200, {'count': len(images), 'results': images[offset:offset + limit]})
+
+    def do_DELETE(self):
+        if self._failed():
+            return
+        match = re.match(r'/api/images/(\d+)/$', urlparse(self.path).path)
+        with self.server.lock:
+            if match is not None and int(match.group(1)) in self.server.images:
+                self.server.deleted.append(self.server.images.pop(int(match.group(1))))
+                return self._send(204)
+        self._send(404, {'detail': 'not found'})
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), NeuroVaultStandIn)
+    srv.lock = threading.Lock()
+    srv.images, srv.deleted, srv.requests, srv.failures = {}, [], [], []
+    srv.base_url = f'http://127.0.0.1:{srv.server_address[1]}/api/'
+    thread = threading.Thread(target=srv.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def api(server):
+    client = NeuroVaultSession('token', base_url=server.base_url, pool_size=4, retries=3, backoff=0.01, timeout=10)
+    yield client
+    client.session.close()
+
+
+def requests_of(server, method: str) -> list:
+    return [path for req_method, path, _ in server.requests if req_method == method]
+
+
+def make_uploads(folder, n: int) -> list:
+    uploads = []
+    for i in range(n):
+        path = os.path.join(folder, f'sub-{i:02d}_stat-est.nii.gz')
+        with open(path, 'wb') as f:
+            f.write(f'map {i}'.encode())
+        uploads.append((path, {'name': os.path.basename(path), 'estimate_type': 'est'}))
+    return uploads
+
+
+def add_images(server, collection_id: int, n: int):
+    for i in range(n):
+        image_id = len(server.images) + 1
+        server.images[image_id] = {'id': image_id, 'collection': collection_id, 'name': f'map-{i}'}
+
+
+def test_rerun_skips_files_in_manifest(server, api, tmp_path):
+    uploads = make_uploads(tmp_path, 5)
+    manifest_path = str(tmp_path / 'manifest.jsonl')
+    image_ids, failed = upload_images(api, 7, uploads, UploadManifest(manifest_path), n_workers=4)
+    assert not failed and len(set(image_ids.values())) == 5
+    assert len(requests_of(server, 'POST')) == 5
+
+    rerun_ids, rerun_failed = upload_images(api, 7, uploads, UploadManifest(manifest_path), n_workers=4)
+    assert rerun_ids == image_ids and not rerun_failed
+    assert len(requests_of(server, 'POST')) == 5
+    # the manifest is per collection
+    other_ids, _ = upload_images(api, 8, uploads[:2], UploadManifest(manifest_path), n_workers=2)
+    assert len(requests_of(server, 'POST')) == 7 and not set(other_ids.values()) & set(image_ids.values())
+
+
+def test_retry_status_and_retry_after(server, api):
+    add_images(server, 7, 3)
+    server.failures = [(503, None), (429, '1')]
+    start = time.monotonic()
+    page = api.get_collection_images(7)
+    # backoff is 0.01 s, the wait after the 429 comes from its Retry-After
+    assert time.monotonic() - start >= 1
+    assert page['count'] == 3 and len(requests_of(server, 'GET')) == 3
+
+
+def test_post_retries_only_rate_limit(server, api, tmp_path):
+    uploads = make_uploads(tmp_path, 1)
+    server.failures = [(429, '0')]
+    image_ids, failed = upload_images(api, 7, uploads, n_workers=1)
+    assert not failed and len(requests_of(server, 'POST')) == 2 and len(server.images) == 1
+
+    # a 5xx can follow a saved upload, it isn't resent
+    server.failures = [(503, None)]
+    image_ids, failed = upload_images(api, 7, uploads, n_workers=1)
+    assert list(failed) == [uploads[0][0]] and len(requests_of(server, 'POST')) == 3
+
+
+def test_post_retries_failed_connection(monkeypatch, tmp_path):
+    # nothing listens on the port, the request is never sent so it's retried
+    waits = []
+    monkeypatch.setattr('Stage2_Code.neurovault_client.time.sleep', waits.append)
+    closed_api = NeuroVaultSession('token', base_url='http://127.0.0.1:9/api/', retries=2, backoff=0.01)
+    with pytest.raises(requests.ConnectionError):
+        closed_api.add_image(7, make_uploads(tmp_path, 1)[0][0], name='map')
+    assert len(waits) == 2
+
+
+def test_dropped_connection(server, api, tmp_path):
+    add_images(server, 7, 3)
+    server.failures = ['drop']
+    assert api.get_collection_images(7)['count'] == 3
+    assert len(requests_of(server, 'GET')) == 2
+
+    # the upload may have been saved before the connection dropped, it isn't resent
+    server.failures = ['drop']
+    image_ids, failed = upload_images(api, 7, make_uploads(tmp_path, 1), n_workers=1)
+    assert len(failed) == 1 and len(requests_of(server, 'POST')) == 1
+
+
+def test_truncated_manifest_line_reuploads_that_file(server, api, tmp_path):
+    uploads = make_uploads(tmp_path, 4)
+    manifest_path = str(tmp_path / 'manifest.jsonl')
+    image_ids, _ = upload_images(api, 7, uploads, UploadManifest(manifest_path), n_workers=1)
+    with open(manifest_path) as f:
+        lines = f.read().splitlines()
+    # job killed while writing the last record
+    with open(manifest_path, 'w') as f:
+        f.write('\n'.join(lines[:-1]) + '\n' + lines[-1][:20])
+    cut_path = json.loads(lines[-1])['path']
+
+    rerun_ids, _ = upload_images(api, 7, uploads, UploadManifest(manifest_path), n_workers=4)
+    assert len(requests_of(server, 'POST')) == 5
+    assert {path for path in rerun_ids if rerun_ids[path] != image_ids[path]} == {cut_path}
+    # the new record is read back on the next load
+    manifest = UploadManifest(manifest_path)
+    assert all(manifest.image_id(7, sha) is not None
+               for sha in [json.loads(line)['sha256'] for line in lines[:-1]])
+    assert len(open(manifest_path).read().splitlines()) == 5
+
+
+def test_collection_pages_in_order(server, api):
+    add_images(server, 7, 25)
+    add_images(server, 8, 4)
+    images = collection_images(api, 7, limit=10, n_workers=4)
+    assert images['id'].tolist() == sorted(image_id for image_id, image in server.images.items()
+                                           if image['collection'] == 7)
+    offsets = sorted(parse_qs(urlparse(path).query)['offset'][0] for path in requests_of(server, 'GET'))
+    assert offsets == ['0', '10', '20']
+
+
+def test_collection_pages_retry_rate_limit(server, api):
+    add_images(server, 7, 25)
+    server.failures = [None, (429, '0'), (429, None)]
+    images = collection_images(api, 7, limit=10, n_workers=4)
+    assert len(images) == 25 and images['id'].is_unique and images['id'].is_monotonic_increasing
+    assert len(requests_of(server, 'GET')) == 5
+
+
+def test_delete_dry_run_sends_no_delete(server, api):
+    add_images(server, 7, 5)
+    report = delete_images(api, list(server.images), dry_run=True)
+    assert (report['status'] == 'dry_run').all() and len(report) == 5
+    assert not requests_of(server, 'DELETE') and len(server.images) == 5
+
+
+def test_rate_limiter_spacing():
+    limiter = RateLimiter(rate=20)
+    calls, lock = [], threading.Lock()
+
+    def call():
+        for _ in range(3):
+            limiter.wait()
+            with lock:
+                calls.append(time.monotonic())
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    calls.sort()
+    assert len(calls) == 12
+    assert min(later - earlier for earlier, later in zip(calls, calls[1:])) >= 0.05 - 0.005
+
+
+def test_delete_missing_images_reported_failed(server, api):
+    add_images(server, 7, 2)
+    report = delete_images(api, [1, 999, 2], n_workers=2, rate=50).set_index('id')
+    assert report.loc[[1, 2], 'status'].tolist() == ['deleted', 'deleted']
+    assert report.loc[999, 'status'] == 'failed' and '404' in report.loc[999, 'error']
+    # a 404 isn't retried
+    assert len(requests_of(server, 'DELETE')) == 3 and not server.images